@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0010_auto_20180618_0340'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='replication',
+            name='repl_compression_level',
+            field=models.IntegerField(blank=True, help_text='Compression level from 0 (fastest) to 9 (best compression). Leave empty to use the compressor default.', null=True, verbose_name='Replication Stream Compression Level'),
+        ),
+    ]
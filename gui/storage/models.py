@@ -520,6 +520,14 @@ class Replication(Model):
         default="lz4",
         verbose_name=_("Replication Stream Compression"),
     )
+    repl_compression_level = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_("Replication Stream Compression Level"),
+        help_text=_(
+            "Compression level from 0 (fastest) to 9 (best compression). "
+            "Leave empty to use the compressor default."),
+    )
     repl_limit = models.IntegerField(
         default=0,
         verbose_name=_("Limit (kbps)"),
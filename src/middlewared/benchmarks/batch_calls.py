@@ -0,0 +1,53 @@
+#!/usr/local/bin/python3
+"""
+Measures round trips and time saved by `Client.call_many` (core.batch) over
+sequential `Client.call` on a `disk.query`/`pool.query` heavy workload.
+
+Needs a running middlewared.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from middlewared.client import Client  # noqa
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--uri')
+    parser.add_argument('-U', '--username')
+    parser.add_argument('-P', '--password')
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--methods', nargs='+', default=['disk.query', 'pool.query'])
+    args = parser.parse_args()
+
+    calls = [(args.methods[i % len(args.methods)], []) for i in range(args.calls)]
+
+    with Client(uri=args.uri) as c:
+        if args.username and args.password:
+            if not c.call('auth.login', args.username, args.password):
+                raise ValueError('Invalid username or password')
+
+        start = time.monotonic()
+        for method, params in calls:
+            c.call(method, *params)
+        sequential = time.monotonic() - start
+
+        start = time.monotonic()
+        round_trips = 0
+        for i in range(0, len(calls), args.batch_size):
+            c.call_many(calls[i:i + args.batch_size])
+            round_trips += 1
+        batched = time.monotonic() - start
+
+    print(f'sequential: {len(calls):6d} round trips, {sequential:8.3f}s')
+    print(f'   batched: {round_trips:6d} round trips, {batched:8.3f}s')
+    print(f'     saved: {len(calls) - round_trips:6d} round trips, {sequential - batched:8.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/local/bin/python3
+"""
+Compares per-row `django_modelobj_serialize` with the prefetching
+`django_queryset_serialize` on a synthetic table with ForeignKey and
+ManyToMany relations, reporting time and number of SQL queries.
+
+Uses an in-memory SQLite database, needs django and freenasUI available.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.append('/usr/local/www')
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+settings.configure(
+    DEBUG=True,
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=[],
+)
+django.setup()
+
+from django.db import connection, models, reset_queries  # noqa
+
+from middlewared.utils import django_modelobj_serialize, django_queryset_serialize  # noqa
+
+
+class Group(models.Model):
+    name = models.CharField(max_length=120)
+
+    class Meta:
+        app_label = 'benchmark'
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=120)
+
+    class Meta:
+        app_label = 'benchmark'
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=120)
+    size = models.IntegerField()
+    group = models.ForeignKey(Group, null=True, on_delete=models.CASCADE)
+    tags = models.ManyToManyField(Tag)
+
+    class Meta:
+        app_label = 'benchmark'
+
+
+def populate(rows, groups, tags):
+    with connection.schema_editor() as editor:
+        for model in (Group, Tag, Item):
+            editor.create_model(model)
+
+    Group.objects.bulk_create([Group(name=f'group{i}') for i in range(groups)])
+    Tag.objects.bulk_create([Tag(name=f'tag{i}') for i in range(tags)])
+    group_ids = list(Group.objects.values_list('id', flat=True))
+    tag_ids = list(Tag.objects.values_list('id', flat=True))
+
+    Item.objects.bulk_create([
+        Item(name=f'item{i}', size=i, group_id=group_ids[i % len(group_ids)] if i % 10 else None)
+        for i in range(rows)
+    ])
+    Through = Item.tags.through
+    Through.objects.bulk_create([
+        Through(item_id=item_id, tag_id=tag_ids[(item_id + j) % len(tag_ids)])
+        for item_id in Item.objects.values_list('id', flat=True)
+        for j in range(2)
+    ])
+
+
+def measure(name, func, reference=None):
+    reset_queries()
+    start = time.monotonic()
+    result = func()
+    elapsed = time.monotonic() - start
+    print(f'{name:>12}: {elapsed:8.3f}s {len(connection.queries):8d} queries')
+    if reference is not None:
+        assert result == reference, 'Results differ'
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--tags', type=int, default=20)
+    args = parser.parse_args()
+
+    populate(args.rows, args.groups, args.tags)
+
+    print(f'Serializing {args.rows} rows')
+    reference = measure('per-row', lambda: [
+        django_modelobj_serialize(None, obj) for obj in Item.objects.all()
+    ])
+    measure('prefetching', lambda: django_queryset_serialize(None, Item.objects.all()), reference)
+
+
+if __name__ == '__main__':
+    main()
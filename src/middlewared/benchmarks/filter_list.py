@@ -0,0 +1,90 @@
+#!/usr/local/bin/python3
+"""
+Micro-benchmarks of `filter_list` over synthetic snapshot and dataset lists
+shaped like `zfs.snapshot.query` and `pool.dataset.query` results.
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from middlewared.utils import filter_list, IndexedList  # noqa
+
+
+def snapshots(count):
+    rv = []
+    for i in range(count):
+        dataset = f'tank/dataset{i % 500}'
+        name = f'auto-{20180101 + i // 500}.{i % 24:02d}00-2w'
+        rv.append({
+            'id': f'{dataset}@{name}',
+            'name': f'{dataset}@{name}',
+            'dataset': dataset,
+            'snapshot_name': name,
+            'pool': 'tank',
+            'type': 'SNAPSHOT',
+            'properties': {
+                'used': {'parsed': random.randint(0, 1 << 30), 'value': ''},
+                'creation': {'parsed': i, 'value': ''},
+            },
+        })
+    return rv
+
+
+def datasets(count):
+    rv = []
+    for i in range(count):
+        name = f'tank/dataset{i // 100}/child{i % 100}'
+        rv.append({
+            'id': name,
+            'name': name,
+            'pool': 'tank',
+            'type': 'FILESYSTEM' if i % 10 else 'VOLUME',
+            'compression': {'value': 'LZ4' if i % 3 else 'OFF'},
+            'used': {'parsed': random.randint(0, 1 << 40)},
+            'children': [],
+        })
+    return rv
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    snaps = snapshots(args.entries)
+    indexed_snaps = IndexedList(snaps, ['id', 'dataset'])
+    dsets = datasets(args.entries)
+    some_ids = [snaps[i]['id'] for i in range(0, args.entries, args.entries // 10)]
+
+    cases = [
+        ('snapshot id =', lambda: filter_list(snaps, [('id', '=', snaps[-1]['id'])])),
+        ('snapshot id = (indexed)', lambda: filter_list(indexed_snaps, [('id', '=', snaps[-1]['id'])])),
+        ('snapshot id in (indexed)', lambda: filter_list(indexed_snaps, [('id', 'in', some_ids)])),
+        ('snapshot dataset = (indexed)', lambda: filter_list(indexed_snaps, [('dataset', '=', 'tank/dataset7')])),
+        ('snapshot get', lambda: filter_list(snaps, [('dataset', '=', 'tank/dataset7')], {'get': True})),
+        ('snapshot regex', lambda: filter_list(snaps, [('snapshot_name', '~', r'auto-2018.*\.1200-2w')])),
+        ('snapshot dotted >', lambda: filter_list(snaps, [('properties.used.parsed', '>', 1 << 29)])),
+        ('snapshot order_by 2 keys', lambda: filter_list(snaps, [], {'order_by': ['dataset', '-snapshot_name']})),
+        ('snapshot page', lambda: filter_list(
+            snaps, [('pool', '=', 'tank')], {'order_by': ['name'], 'offset': 5000, 'limit': 100},
+        )),
+        ('dataset 2 filters count', lambda: filter_list(
+            dsets, [('type', '=', 'FILESYSTEM'), ('compression.value', '=', 'LZ4')], {'count': True},
+        )),
+        ('dataset select', lambda: filter_list(dsets, [('type', '=', 'VOLUME')], {'select': ['id', 'used']})),
+    ]
+
+    print(f'{args.entries} entries, best of {args.repeat}')
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f'{name:>30}: {best * 1000:10.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/local/bin/python3
+"""
+Stress benchmark of the `JobsQueue` scheduler: queues `--jobs` jobs shaped like a burst of
+`disk.sync` (one lock per disk), `cloudsync.sync` (one lock per task, `lock_queue_size=1`)
+and lock-less jobs, then drains the queue, finishing jobs as soon as they are dispatched.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from mock import Mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from middlewared.job import Job, JobsQueue  # noqa
+
+
+def method_body(job):
+    pass
+
+
+def make_job(middleware, i, disks):
+    options = {
+        'lock': None,
+        'lock_queue_size': None,
+        'priority': 0,
+        'max_concurrency': None,
+        'logs': False,
+        'process': False,
+        'pipes': [],
+        'check_pipes': True,
+        'transient': True,
+    }
+    kind = i % 3
+    if kind == 0:
+        method = 'disk.sync'
+        options['lock'] = f'disk.sync:ada{i % disks}'
+    elif kind == 1:
+        method = 'cloudsync.sync'
+        options['lock'] = f'cloud_sync:{i % 10}'
+        options['lock_queue_size'] = 1
+    else:
+        method = 'pool.dataset.query'
+        options['max_concurrency'] = 8
+    return Job(middleware, method, None, method_body, [], options, None)
+
+
+async def bench(jobs, disks, running):
+    middleware = Mock()
+    queue = JobsQueue(middleware)
+    queue.deque.maxlen = jobs
+
+    submitted = [make_job(middleware, i, disks) for i in range(jobs)]
+
+    start = time.monotonic()
+    for job in submitted:
+        queue.add(job)
+    added = time.monotonic() - start
+    queued = len(queue.all())
+
+    start = time.monotonic()
+    dispatched = []
+    while queue.ready or dispatched:
+        while queue.ready and len(dispatched) < running:
+            job = await queue.__next__()
+            job.set_state('RUNNING')
+            dispatched.append(job)
+        job = dispatched.pop(0)
+        job.set_state('SUCCESS')
+        queue.release(job)
+    drained = time.monotonic() - start
+
+    return queued, added, drained
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=50000)
+    parser.add_argument('--disks', type=int, default=100)
+    parser.add_argument('--running', type=int, default=16)
+    args = parser.parse_args()
+
+    queued, added, drained = asyncio.get_event_loop().run_until_complete(bench(args.jobs, args.disks, args.running))
+    print(f'{args.jobs} jobs submitted, {queued} queued')
+    print(f'{"add":>10}: {added * 1000:10.3f} ms ({args.jobs / added:10.0f} jobs/sec)')
+    print(f'{"dispatch":>10}: {drained * 1000:10.3f} ms ({queued / drained:10.0f} jobs/sec)')
+
+
+if __name__ == '__main__':
+    main()
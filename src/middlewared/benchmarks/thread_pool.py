@@ -0,0 +1,69 @@
+#!/usr/local/bin/python3
+"""
+Compares calls/sec of `Middleware.run_in_thread` strategies:
+
+  - per-call: a new single worker ThreadPoolExecutor for every call (old behaviour)
+  - io-pool: shared IoThreadPoolExecutor
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from middlewared.utils.thread_pool import IoThreadPoolExecutor  # noqa
+
+
+async def per_call(method, *args):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        return await asyncio.get_event_loop().run_in_executor(executor, functools.partial(method, *args))
+    finally:
+        executor.shutdown(wait=False)
+
+
+def io_pool(executor):
+    async def run_in_thread(method, *args):
+        return await asyncio.get_event_loop().run_in_executor(executor, functools.partial(method, *args))
+    return run_in_thread
+
+
+async def bench(run_in_thread, calls, concurrency, sleep):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await run_in_thread(time.sleep, sleep)
+
+    start = time.monotonic()
+    await asyncio.gather(*[one() for i in range(calls)])
+    return calls / (time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--sleep', type=float, default=0)
+    parser.add_argument('--io-threads', type=int, default=128)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    executor = IoThreadPoolExecutor('IoThread', max_workers=args.io_threads)
+
+    for name, run_in_thread in (
+        ('per-call', per_call),
+        ('io-pool', io_pool(executor)),
+    ):
+        rate = loop.run_until_complete(bench(run_in_thread, args.calls, args.concurrency, args.sleep))
+        print(f'{name:>10}: {rate:10.0f} calls/sec')
+
+    print(f'io-pool stats: {executor.stats()}')
+
+
+if __name__ == '__main__':
+    main()
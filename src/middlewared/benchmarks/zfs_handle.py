@@ -0,0 +1,61 @@
+#!/usr/local/bin/python3
+"""
+Measures latency of dataset lookups by id opening a new libzfs handle per call
+(as `zfs.*` methods used to) and reusing the shared handle of the thread.
+
+With `--uri` (or on a system running middlewared when `--rpc` is given) latency of
+`zfs.dataset.query` with an id filter is measured as well.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import libzfs  # noqa
+
+from middlewared.client import Client  # noqa
+from middlewared.utils.zfs_handle import zfs_handle  # noqa
+
+
+def measure(name, func, count):
+    latencies = []
+    for i in range(count):
+        start = time.monotonic()
+        func()
+        latencies.append(time.monotonic() - start)
+    latencies.sort()
+    print(f'{name:>24}: median {statistics.median(latencies) * 1000:8.3f} ms, '
+          f'p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:8.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--uri')
+    parser.add_argument('--rpc', action='store_true')
+    parser.add_argument('--dataset', required=True)
+    parser.add_argument('--count', type=int, default=1000)
+    args = parser.parse_args()
+
+    def new_handle():
+        with libzfs.ZFS() as zfs:
+            zfs.get_dataset(args.dataset).properties['used'].value
+
+    def shared_handle():
+        with zfs_handle() as zfs:
+            zfs.get_dataset(args.dataset).properties['used'].value
+
+    measure('new handle per call', new_handle, args.count)
+    measure('shared handle', shared_handle, args.count)
+
+    if args.uri or args.rpc:
+        with Client(uri=args.uri) as c:
+            measure('zfs.dataset.query id', lambda: c.call(
+                'zfs.dataset.query', [('id', '=', args.dataset)], {'get': True},
+            ), args.count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/local/bin/python3
+"""
+Measures `zfs.snapshot.query` full, scoped and property-selective queries.
+
+With `--create` a synthetic layout of `--datasets` datasets holding
+`--snapshots` snapshots each is created under `--pool`
+(e.g. a scratch pool backed by a file: `truncate -s 2G /tmp/bench.img; zpool create bench /tmp/bench.img`).
+
+Needs a running middlewared.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from middlewared.client import Client  # noqa
+
+
+def create_layout(pool, datasets, snapshots):
+    for i in range(datasets):
+        dataset = f'{pool}/bench/group{i % 10}/dataset{i}'
+        subprocess.run(['zfs', 'create', '-p', dataset], check=True)
+        for j in range(snapshots):
+            subprocess.run(['zfs', 'snapshot', f'{dataset}@snap{j}'], check=True)
+
+
+def measure(c, name, filters, options, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.monotonic()
+        result = c.call('zfs.snapshot.query', filters, options, timeout=3600)
+        elapsed = time.monotonic() - start
+        best = elapsed if best is None else min(best, elapsed)
+    count = result if isinstance(result, int) else len(result) if isinstance(result, list) else 1
+    print(f'{name:>32}: {best:8.3f}s {count:8d} results')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--uri')
+    parser.add_argument('--pool', required=True)
+    parser.add_argument('--create', action='store_true')
+    parser.add_argument('--datasets', type=int, default=100)
+    parser.add_argument('--snapshots', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.create:
+        create_layout(args.pool, args.datasets, args.snapshots)
+
+    dataset = f'{args.pool}/bench/group0/dataset0'
+    names_only = {'extra': {'properties': []}}
+    with Client(uri=args.uri) as c:
+        measure(c, 'all', [], {}, args.repeat)
+        measure(c, 'all, names only', [], names_only, args.repeat)
+        measure(c, 'all, count', [], {'count': True, **names_only}, args.repeat)
+        measure(c, 'pool', [('pool', '=', args.pool)], names_only, args.repeat)
+        measure(c, 'subtree prefix', [('name', '^', f'{args.pool}/bench/group0/')], names_only, args.repeat)
+        measure(c, 'dataset', [('dataset', '=', dataset)], {}, args.repeat)
+        measure(c, 'dataset, used only', [('dataset', '=', dataset)], {
+            'extra': {'properties': ['used']},
+        }, args.repeat)
+        measure(c, 'id', [('id', '=', f'{dataset}@snap0')], {'get': True}, args.repeat)
+        measure(c, 'first page', [], {'limit': 50, **names_only}, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
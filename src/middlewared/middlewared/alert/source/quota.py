@@ -5,10 +5,10 @@ import socket
 
 from bsd import getmntinfo
 import humanfriendly
-import libzfs
 
 from middlewared.alert.base import Alert, AlertLevel, ThreadedAlertSource
 from middlewared.alert.schedule import IntervalSchedule
+from middlewared.utils.zfs_handle import zfs_handle
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +22,7 @@ class QuotaAlertSource(ThreadedAlertSource):
     def check_sync(self):
         alerts = []
 
-        with libzfs.ZFS() as zfs:
+        with zfs_handle() as zfs:
             datasets = [
                 {
                     k: v.__getstate__()
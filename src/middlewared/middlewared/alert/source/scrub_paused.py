@@ -1,7 +1,6 @@
-import libzfs
-
 from middlewared.alert.base import Alert, AlertLevel, ThreadedAlertSource
 from middlewared.alert.schedule import CrontabSchedule
+from middlewared.utils.zfs_handle import zfs_handle
 
 
 class ScrubPausedAlertSource(ThreadedAlertSource):
@@ -12,7 +11,7 @@ class ScrubPausedAlertSource(ThreadedAlertSource):
 
     def check_sync(self):
         alerts = []
-        with libzfs.ZFS() as zfs:
+        with zfs_handle() as zfs:
             for pool in zfs.pools:
                 if pool.scrub.pause is not None:
                     alerts.append(Alert(title="Scrub for pool %r is paused",
@@ -0,0 +1,350 @@
+"""
+asyncio counterpart of `middlewared.client.Client`.
+
+Every connection is handled by a single reader task so any number of
+concurrent calls can be multiplexed over it from one event loop.
+"""
+from . import ejson as json
+from . import emsgpack
+from .client import CALL_TIMEOUT, CallTimeout, ClientException, ValidationErrors, get_exception
+
+from base64 import b64decode
+from collections import defaultdict
+import asyncio
+import pickle
+import urllib.parse
+import uuid
+
+import aiohttp
+
+
+class AsyncClient(object):
+
+    def __init__(self, uri=None, py_exceptions=False, msgpack=False, compress=False):
+        """
+        Arguments:
+           :uri(str): ws://, wss:// or ws+unix:// URI, defaults to middlewared unix socket
+           :py_exceptions(bool): whether errors should be raised as the original python exception
+           :msgpack(bool): whether messages should be exchanged using binary msgpack encoding instead of JSON
+           :compress(bool): whether permessage-deflate should be requested
+        """
+        if uri is None:
+            uri = 'ws+unix:///var/run/middlewared.sock'
+        self.uri = uri
+        self._py_exceptions = py_exceptions
+        self._msgpack = msgpack
+        self._compress = compress
+
+        self._session = None
+        self._ws = None
+        self._reader = None
+        self._connected = None
+        self._calls = {}
+        self._pings = {}
+        self._subscriptions = {}
+        self._event_callbacks = defaultdict(list)
+        self._jobs = defaultdict(dict)
+        self._jobs_subscribed = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, typ, value, traceback):
+        await self.close()
+
+    @property
+    def closed(self):
+        return self._ws is None or self._ws.closed
+
+    @property
+    def pending(self):
+        """Number of calls waiting for a result."""
+        return len(self._calls)
+
+    async def connect(self, timeout=10):
+        parsed = urllib.parse.urlparse(self.uri)
+        if parsed.scheme == 'ws+unix':
+            connector = aiohttp.UnixConnector(path=parsed.path)
+            url = 'ws://localhost/websocket'
+        else:
+            connector = None
+            url = self.uri
+
+        self._session = aiohttp.ClientSession(connector=connector)
+        try:
+            self._ws = await asyncio.wait_for(
+                self._session.ws_connect(url, compress=15 if self._compress else 0), timeout,
+            )
+            self._connected = asyncio.get_event_loop().create_future()
+            self._reader = asyncio.ensure_future(self._read())
+
+            features = []
+            if self._py_exceptions:
+                features.append('PY_EXCEPTIONS')
+            if self._msgpack:
+                features.append('MSGPACK')
+            await self._send({
+                'msg': 'connect',
+                'version': '1',
+                'support': ['1'],
+                'features': features,
+            })
+            await asyncio.wait_for(asyncio.shield(self._connected), timeout)
+        except Exception as e:
+            await self.close()
+            if isinstance(e, asyncio.TimeoutError):
+                raise ClientException('Failed connection handshake')
+            raise
+
+    async def close(self):
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+        self._ws = self._reader = self._session = None
+
+    async def _send(self, data):
+        if self._msgpack:
+            await self._ws.send_bytes(emsgpack.dumps(data))
+        else:
+            await self._ws.send_str(json.dumps(data))
+
+    async def _read(self):
+        try:
+            async for msg in self._ws:
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    message = emsgpack.loads(msg.data)
+                elif msg.type == aiohttp.WSMsgType.TEXT:
+                    message = json.loads(msg.data)
+                else:
+                    break
+                self._recv(message)
+        finally:
+            exc = ClientException('Connection closed')
+            for fut in (
+                [self._connected] + list(self._calls.values()) + list(self._pings.values()) +
+                [sub['ready'] for sub in self._subscriptions.values()] +
+                [job['__ready'] for job in self._jobs.values() if '__ready' in job]
+            ):
+                if fut is not None and not fut.done():
+                    fut.set_exception(exc)
+
+    def _recv(self, message):
+        _id = message.get('id')
+        msg = message.get('msg')
+        if msg == 'connected':
+            if not self._connected.done():
+                self._connected.set_result(True)
+        elif msg == 'failed':
+            if not self._connected.done():
+                self._connected.set_exception(ClientException('Unsupported protocol version'))
+        elif msg == 'pong' and _id is not None:
+            fut = self._pings.pop(_id, None)
+            if fut and not fut.done():
+                fut.set_result(True)
+        elif _id is not None and msg == 'result':
+            fut = self._calls.pop(_id, None)
+            if fut and not fut.done():
+                if 'error' in message:
+                    fut.set_exception(self._get_exception(message['error']))
+                else:
+                    fut.set_result(message.get('result'))
+        elif msg in ('added', 'changed', 'removed'):
+            for name in ('*', message['collection']):
+                for callback in list(self._event_callbacks.get(name, [])):
+                    rv = callback(msg.upper(), **message)
+                    if asyncio.iscoroutine(rv):
+                        asyncio.ensure_future(rv)
+        elif msg == 'ready':
+            for subid in message['subs']:
+                sub = self._subscriptions.get(subid)
+                if sub and not sub['ready'].done():
+                    sub['ready'].set_result(True)
+        elif msg == 'nosub':
+            sub = self._subscriptions.pop(_id, None)
+            if sub and not sub['ready'].done():
+                sub['ready'].set_exception(ClientException((message.get('error') or {}).get('error')))
+
+    def _get_exception(self, error):
+        py_exception = error.get('py_exception')
+        if self._py_exceptions and py_exception:
+            py_exception = pickle.loads(b64decode(py_exception))
+        else:
+            py_exception = None
+        return get_exception(
+            error.get('error'), error.get('reason'), error.get('trace'), error.get('type'),
+            error.get('extra'), py_exception,
+        )
+
+    def _jobs_callback(self, mtype, **message):
+        fields = message.get('fields')
+        if not fields:
+            return
+        job = self._jobs[fields['id']]
+        job.update(fields)
+        if job.get('__callback'):
+            job['__callback'](job)
+        if mtype == 'CHANGED' and job['state'] in ('SUCCESS', 'FAILED', 'ABORTED'):
+            # Event may arrive before the call returned the job id
+            ready = job.get('__ready')
+            if ready is None:
+                ready = job['__ready'] = asyncio.get_event_loop().create_future()
+            if not ready.done():
+                ready.set_result(True)
+
+    async def call(self, method, *params, timeout=CALL_TIMEOUT, job=False, callback=None):
+        # We need to make sure we are subscribed to receive job updates
+        if job:
+            if self._jobs_subscribed is None:
+                self._jobs_subscribed = asyncio.ensure_future(self.subscribe('core.get_jobs', self._jobs_callback))
+            await asyncio.shield(self._jobs_subscribed)
+
+        _id = str(uuid.uuid4())
+        fut = self._calls[_id] = asyncio.get_event_loop().create_future()
+        try:
+            await self._send({
+                'msg': 'method',
+                'method': method,
+                'id': _id,
+                'params': list(params),
+            })
+            result = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise CallTimeout('Call timeout')
+        finally:
+            self._calls.pop(_id, None)
+
+        if not job:
+            return result
+
+        job = self._jobs[result]
+        job['__callback'] = callback
+        ready = job.get('__ready')
+        if ready is None:
+            ready = job['__ready'] = asyncio.get_event_loop().create_future()
+        # Wait indefinitely for the job event with state SUCCESS/FAILED/ABORTED
+        await ready
+        job = self._jobs.pop(result)
+        if job['state'] != 'SUCCESS':
+            if job['exc_info'] and job['exc_info']['type'] == 'VALIDATION':
+                raise ValidationErrors(job['exc_info']['extra'])
+            raise ClientException(job['error'], trace=job['exception'])
+        return job['result']
+
+    async def call_many(self, calls, timeout=CALL_TIMEOUT, return_exceptions=False):
+        """
+        Call many methods in a single round trip using `core.batch`.
+        See `Client.call_many`.
+        """
+        results = []
+        for rv in await self.call('core.batch', [
+            {'method': method, 'params': list(params)} for method, params in calls
+        ], timeout=timeout):
+            if 'error' in rv:
+                exc = self._get_exception(rv['error'])
+                if not return_exceptions:
+                    raise exc
+                results.append(exc)
+            else:
+                results.append(rv['result'])
+        return results
+
+    async def subscribe(self, name, callback):
+        """
+        Subscribe to event `name`. `callback(event_type, **message)` can be a plain
+        function or a coroutine function.
+        Returns the subscription id.
+        """
+        _id = str(uuid.uuid4())
+        ready = asyncio.get_event_loop().create_future()
+        self._subscriptions[_id] = {'name': name, 'ready': ready}
+        self._event_callbacks[name].append(callback)
+        try:
+            await self._send({
+                'msg': 'sub',
+                'id': _id,
+                'name': name,
+            })
+            await ready
+        except Exception:
+            self._subscriptions.pop(_id, None)
+            self._event_callbacks[name].remove(callback)
+            raise
+        self._subscriptions[_id]['callback'] = callback
+        return _id
+
+    async def unsubscribe(self, _id):
+        sub = self._subscriptions.pop(_id)
+        self._event_callbacks[sub['name']].remove(sub['callback'])
+        await self._send({
+            'msg': 'unsub',
+            'id': _id,
+        })
+
+    async def ping(self, timeout=10):
+        _id = str(uuid.uuid4())
+        fut = self._pings[_id] = asyncio.get_event_loop().create_future()
+        await self._send({
+            'msg': 'ping',
+            'id': _id,
+        })
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._pings.pop(_id, None)
+        return True
+
+
+class AsyncClientPool(object):
+    """
+    Pool of `AsyncClient` connections keyed by URI.
+
+    Up to `size` connections are opened per URI; calls are routed to the
+    connection with fewer pending calls. Closed connections are replaced.
+    `connect_hook` coroutine function (e.g. to log in) is awaited with every new client.
+    """
+
+    def __init__(self, size=4, connect_hook=None, **client_kwargs):
+        self.size = size
+        self.connect_hook = connect_hook
+        self.client_kwargs = client_kwargs
+        self._clients = defaultdict(list)
+        self._lock = asyncio.Lock()
+
+    async def get(self, uri=None):
+        async with self._lock:
+            clients = self._clients[uri] = [c for c in self._clients[uri] if not c.closed]
+            idle = [c for c in clients if c.pending == 0]
+            if idle:
+                return idle[0]
+
+            if len(clients) < self.size:
+                client = AsyncClient(uri, **self.client_kwargs)
+                await client.connect()
+                if self.connect_hook:
+                    try:
+                        await self.connect_hook(client)
+                    except Exception:
+                        await client.close()
+                        raise
+                clients.append(client)
+                return client
+
+            return min(clients, key=lambda c: c.pending)
+
+    async def call(self, method, *params, uri=None, **kwargs):
+        return await (await self.get(uri)).call(method, *params, **kwargs)
+
+    async def call_many(self, calls, uri=None, **kwargs):
+        return await (await self.get(uri)).call_many(calls, **kwargs)
+
+    async def close(self):
+        async with self._lock:
+            clients = sum(self._clients.values(), [])
+            self._clients.clear()
+        await asyncio.gather(*[c.close() for c in clients], return_exceptions=True)
@@ -1,4 +1,5 @@
 from . import ejson as json
+from . import emsgpack
 from .protocol import DDPProtocol
 from .utils import ProgressBar
 from collections import defaultdict, namedtuple, Callable
@@ -201,7 +202,10 @@ class WSClient(WebSocketClient):
         return super().close_connection()
 
     def received_message(self, message):
-        self.protocol.on_message(message.data.decode('utf8'))
+        if message.is_binary:
+            self.protocol.on_message(message.data)
+        else:
+            self.protocol.on_message(message.data.decode('utf8'))
 
     def on_open(self):
         self.client.on_open()
@@ -279,16 +283,28 @@ class CallTimeout(ClientException):
     pass
 
 
+def get_exception(errno, error, trace, type, extra, py_exception):
+    """
+    Exception to be raised for a call error received from middlewared.
+    """
+    if py_exception:
+        return py_exception
+    if trace and type == 'VALIDATION':
+        return ValidationErrors(extra)
+    return ClientException(error, errno, trace, extra)
+
+
 class Client(object):
 
     def __init__(
         self, uri=None, reserved_ports=False, reserved_ports_blacklist=None,
-        py_exceptions=False,
+        py_exceptions=False, msgpack=False,
     ):
         """
         Arguments:
            :reserved_ports(bool): whether the connection should origin using a reserved port (<= 1024)
            :reserved_ports_blacklist(list): list of ports that should not be used as origin
+           :msgpack(bool): whether messages should be exchanged using binary msgpack encoding instead of JSON
         """
         self._calls = {}
         self._jobs = defaultdict(dict)
@@ -296,6 +312,7 @@ class Client(object):
         self._jobs_watching = False
         self._pings = {}
         self._py_exceptions = py_exceptions
+        self._msgpack = msgpack
         self._event_callbacks = {}
         if uri is None:
             uri = 'ws+unix:///var/run/middlewared.sock'
@@ -328,7 +345,10 @@ class Client(object):
             raise
 
     def _send(self, data):
-        self._ws.send(json.dumps(data))
+        if self._msgpack:
+            self._ws.send(emsgpack.dumps(data), binary=True)
+        else:
+            self._ws.send(json.dumps(data))
 
     def _recv(self, message):
         _id = message.get('id')
@@ -380,6 +400,8 @@ class Client(object):
         features = []
         if self._py_exceptions:
             features.append('PY_EXCEPTIONS')
+        if self._msgpack:
+            features.append('MSGPACK')
         self._send({
             'msg': 'connect',
             'version': '1',
@@ -447,11 +469,7 @@ class Client(object):
             raise CallTimeout("Call timeout")
 
         if c.errno:
-            if c.py_exception:
-                raise c.py_exception
-            if c.trace and c.type == 'VALIDATION':
-                raise ValidationErrors(c.extra)
-            raise ClientException(c.error, c.errno, c.trace, c.extra)
+            raise get_exception(c.errno, c.error, c.trace, c.type, c.extra, c.py_exception)
 
         if job:
             job_id = c.result
@@ -481,6 +499,38 @@ class Client(object):
 
         return c.result
 
+    def call_many(self, calls, timeout=CALL_TIMEOUT, return_exceptions=False):
+        """
+        Call many methods in a single round trip using `core.batch`.
+        Calls are run concurrently by the server.
+
+        Arguments:
+           :calls(list): list of (method, params) tuples
+           :return_exceptions(bool): whether exceptions of failed calls should be returned in
+               place of their result instead of raising the first one
+
+        Returns a list of results in the same order as `calls`.
+        """
+        results = []
+        for rv in self.call('core.batch', [
+            {'method': method, 'params': list(params)} for method, params in calls
+        ], timeout=timeout):
+            if 'error' in rv:
+                error = rv['error']
+                py_exception = error.get('py_exception')
+                if self._py_exceptions and py_exception:
+                    py_exception = pickle.loads(b64decode(py_exception))
+                exc = get_exception(
+                    error.get('error'), error.get('reason'), error.get('trace'), error.get('type'),
+                    error.get('extra'), py_exception,
+                )
+                if not return_exceptions:
+                    raise exc
+                results.append(exc)
+            else:
+                results.append(rv['result'])
+        return results
+
     def subscribe(self, name, callback):
         ready = Event()
         _id = str(uuid.uuid4())
@@ -521,6 +571,7 @@ def main():
     parser.add_argument('-U', '--username')
     parser.add_argument('-P', '--password')
     parser.add_argument('-t', '--timeout', type=int)
+    parser.add_argument('-m', '--msgpack', action='store_true')
 
     subparsers = parser.add_subparsers(help='sub-command help', dest='name')
     iparser = subparsers.add_parser('call', help='Call method')
@@ -550,7 +601,7 @@ def main():
                 yield i
 
     if args.name == 'call':
-        with Client(uri=args.uri) as c:
+        with Client(uri=args.uri, msgpack=args.msgpack) as c:
             try:
                 if args.username and args.password:
                     if not c.call('auth.login', args.username, args.password):
@@ -587,11 +638,11 @@ def main():
                         print(e.trace['formatted'], file=sys.stderr)
                 sys.exit(1)
     elif args.name == 'ping':
-        with Client(uri=args.uri) as c:
+        with Client(uri=args.uri, msgpack=args.msgpack) as c:
             if not c.ping():
                 sys.exit(1)
     elif args.name == 'sql':
-        with Client(uri=args.uri) as c:
+        with Client(uri=args.uri, msgpack=args.msgpack) as c:
             try:
                 if args.username and args.password:
                     if not c.call('auth.login', args.username, args.password):
@@ -611,7 +662,7 @@ def main():
                     print('|'.join(data))
 
     elif args.name == 'subscribe':
-        with Client(uri=args.uri) as c:
+        with Client(uri=args.uri, msgpack=args.msgpack) as c:
 
             event = Event()
             number = 0
@@ -637,7 +688,7 @@ def main():
         def waitready(args):
             while True:
                 try:
-                    with Client(uri=args.uri) as c:
+                    with Client(uri=args.uri, msgpack=args.msgpack) as c:
                         return c.call('core.ping')
                 except socket.error:
                     time.sleep(0.2)
@@ -0,0 +1,44 @@
+"""
+Compact binary counterpart of `ejson`.
+
+date, datetime and time are encoded as msgpack extension types and decoded
+exactly like their `ejson` representation.
+"""
+from datetime import date, datetime, time
+import struct
+
+import msgpack
+
+from . import ejson
+
+EXT_DATE = 1
+EXT_DATETIME = 2
+EXT_TIME = 3
+
+
+def default(obj):
+    if type(obj) is date:
+        return msgpack.ExtType(EXT_DATE, obj.isoformat().encode())
+    elif type(obj) is datetime:
+        return msgpack.ExtType(EXT_DATETIME, struct.pack('>q', ejson.JSONEncoder().default(obj)['$date']))
+    elif type(obj) is time:
+        return msgpack.ExtType(EXT_TIME, str(obj).encode())
+    raise TypeError(f'Object of type {type(obj).__name__} is not msgpack serializable')
+
+
+def ext_hook(code, data):
+    if code == EXT_DATE:
+        return ejson.object_hook({'$type': 'date', '$value': data.decode()})
+    elif code == EXT_DATETIME:
+        return ejson.object_hook({'$date': struct.unpack('>q', data)[0]})
+    elif code == EXT_TIME:
+        return ejson.object_hook({'$time': data.decode()})
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True, default=default)
+
+
+def loads(obj):
+    return msgpack.unpackb(obj, raw=False, strict_map_key=False, ext_hook=ext_hook)
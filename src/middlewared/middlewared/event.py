@@ -1,26 +1,66 @@
 import asyncio
 import threading
 
+from middlewared.utils import start_daemon_thread
+
 
 class EventSource(object):
+    """
+    Producer of events for subscriptions to `name` (including the optional `:arg`).
+
+    A single instance is shared by all clients subscribed to the same name and argument:
+    it is started on the first subscription and cancelled when the last subscriber is gone.
+
+    `run` can either be a coroutine, which is run in the event loop and cancelled as a task,
+    or a blocking method run in its own thread, which has to return once `_cancel` is set.
+    """
 
-    def __init__(self, middleware, app, ident, name, arg):
+    def __init__(self, middleware, name, arg):
         self.middleware = middleware
-        self.app = app
-        self.ident = ident
         self.name = name
         self.arg = arg
+        self.subscribers = {}
+        self.last_event = None
         self._cancel = threading.Event()
+        self._task = None
 
     def send_event(self, etype, **kwargs):
-        self.app.send_event(self.name, etype, **kwargs)
+        self.last_event = (etype, kwargs)
+        for app in list(self.subscribers.values()):
+            app.send_event(self.name, etype, **kwargs)
+
+    def on_subscribe(self, app):
+        """
+        Called in the event loop when `app` subscribes to an already running event source, must not block.
+        Replays the last event by default so the new subscriber does not have to wait for the next one.
+        """
+        if self.last_event is not None:
+            app.send_event(self.name, self.last_event[0], **self.last_event[1])
+
+    def start(self):
+        if asyncio.iscoroutinefunction(self.run):
+            self._task = asyncio.ensure_future(self.process_async())
+        else:
+            start_daemon_thread(target=self.process)
 
     def process(self):
-        self.run()
-        asyncio.run_coroutine_threadsafe(self.app.unsubscribe(self.ident), self.app.loop)
+        try:
+            self.run()
+        finally:
+            asyncio.run_coroutine_threadsafe(self.middleware.event_source_finished(self), self.middleware.loop)
+
+    async def process_async(self):
+        try:
+            await self.run()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.middleware.event_source_finished(self)
 
     def run(self):
         raise NotImplementedError('run() method not implemented')
 
     def cancel(self):
         self._cancel.set()
+        if self._task is not None:
+            self._task.cancel()
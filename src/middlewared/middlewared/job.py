@@ -1,8 +1,9 @@
 import asyncio
-from collections import OrderedDict
+from collections import defaultdict, deque, OrderedDict
 import copy
 from datetime import datetime
 import enum
+import heapq
 import logging
 import os
 import sys
@@ -12,6 +13,9 @@ import threading
 
 from middlewared.service_exception import CallError, ValidationError, ValidationErrors
 from middlewared.pipe import Pipes
+from middlewared.utils import filter_list
+from middlewared.utils.job_history import COLUMNS as HISTORY_COLUMNS, split_filters
+from middlewared.utils.thread_pool import blocking
 
 logger = logging.getLogger(__name__)
 
@@ -30,39 +34,85 @@ class JobSharedLock(object):
     Each job method can specify a lock which will be shared
     among all calls for that job and only one job can run at a time
     for this lock.
+
+    Jobs waiting for the lock are kept in FIFO order. Only the `holder` (the job
+    scheduled to run or running for this lock) competes for execution, so the
+    scheduler never has to probe jobs that can not run yet.
     """
 
     def __init__(self, queue, name):
         self.queue = queue
         self.name = name
-        self.jobs = []
-        self.semaphore = asyncio.Semaphore()
+        self.holder = None
+        self.waiting = deque()
 
     def add_job(self, job):
-        self.jobs.append(job)
+        """
+        Returns `True` if `job` became the lock holder and is ready to be scheduled.
+        """
+        if self.holder is None:
+            self.holder = job
+            return True
+
+        self.waiting.append(job)
+        return False
 
     def get_jobs(self):
-        return self.jobs
+        return ([self.holder] if self.holder else []) + list(self.waiting)
 
-    def remove_job(self, job):
-        self.jobs.remove(job)
+    def get_queued_jobs(self):
+        """
+        Jobs of this lock that were not started yet.
+        """
+        if self.holder is not None and self.holder.state == State.WAITING:
+            yield self.holder
+        yield from self.waiting
 
     def locked(self):
-        return self.semaphore.locked()
-
-    async def acquire(self):
-        return await self.semaphore.acquire()
+        return self.holder is not None
 
     def release(self):
-        return self.semaphore.release()
+        """
+        Pass the lock to the next waiting job and return it (or `None` if no job is waiting).
+        """
+        self.holder = self.waiting.popleft() if self.waiting else None
+        return self.holder
 
 
 class JobsQueue(object):
+    """
+    Schedules jobs for execution.
+
+    Runnable jobs (jobs without lock and lock holders) are kept in a heap ordered by
+    priority and then by id, so picking the next job to run is O(log n) no matter how many
+    jobs are waiting for their locks.
+
+    `max_jobs` limits the number of jobs running at once and the `max_concurrency` job option
+    limits the number of running jobs of a method. Jobs over the method limit are parked in
+    a FIFO per method until one of its jobs finishes.
 
-    def __init__(self, middleware):
+    Finished jobs are archived to `history` (`JobHistoryStore`) in batches of `history_batch`
+    jobs or when `flush_history` is called periodically, and read back at most `history_page`
+    jobs at a time. Job ids are then reserved from `history` so they are unique across restarts.
+    """
+
+    def __init__(self, middleware, max_jobs=None, history=None, history_batch=100, history_page=1000):
         self.middleware = middleware
         self.deque = JobsDeque()
-        self.queue = []
+        self.max_jobs = max_jobs
+        self.history = history
+        self.history_batch = history_batch
+        self.history_page = history_page
+        self.history_flushing = False
+
+        # Heap of (-priority, id, job) of jobs ready to run
+        self.ready = []
+        # Jobs whose method is running at `max_concurrency`
+        self.method_waiting = defaultdict(deque)
+        self.method_running = defaultdict(int)
+        self.running = 0
+        # Progress updates of finished jobs which were not sent
+        self.progress_suppressed = 0
 
         # Event responsible for the job queue schedule loop.
         # This event is set and a new job is potentially ready to run
@@ -71,6 +121,11 @@ class JobsQueue(object):
         # Shared lock (JobSharedLock) dict
         self.job_locks = {}
 
+        # Last job id reserved from `history`
+        self.ids_reserved = None
+        if self.history is not None:
+            self.deque.count, self.ids_reserved = self.history.reserve_ids()
+
     def __getitem__(self, item):
         return self.deque[item]
 
@@ -81,26 +136,94 @@ class JobsQueue(object):
         return self.deque.all()
 
     def add(self, job):
-        if job.options["lock_queue_size"] is not None:
-            lock = self.get_lock(job)
-            queued_jobs = [another_job for another_job in self.queue if self.get_lock(another_job) is lock]
+        lock = self.get_lock(job)
+
+        if lock is not None and job.options["lock_queue_size"] is not None:
+            queued_jobs = list(lock.get_queued_jobs())
             if len(queued_jobs) >= job.options["lock_queue_size"]:
                 return queued_jobs[-1]
 
+        if self.ids_reserved is not None and self.deque.count >= self.ids_reserved:
+            self.deque.count, self.ids_reserved = self.history.reserve_ids(self.deque.count)
         self.deque.add(job)
-        self.queue.append(job)
+
+        if lock is None:
+            self._push_ready(job)
+        else:
+            job.lock = lock
+            if lock.add_job(job):
+                self._push_ready(job)
 
         if not job.options["transient"]:
             self.middleware.send_event('core.get_jobs', 'ADDED', id=job.id, fields=job.__encode__())
 
-        # A job has been added to the queue, let the queue scheduler run
-        self.queue_event.set()
-
         return job
 
     def remove(self, job_id):
         self.deque.remove(job_id)
 
+    def query(self, filters=None, options=None):
+        """
+        Query jobs in memory and archived jobs. This is a blocking method.
+
+        The archive is only read for paged queries (`limit`, `offset` or `get`) or queries
+        filtering on archived job columns, otherwise only jobs in memory are returned.
+        """
+        options = options or {}
+        jobs = {job.id: job.__encode__() for job in list(self.deque.all().values())}
+
+        if self.history is not None:
+            for job in self.history.pending():
+                jobs.setdefault(job['id'], job)
+
+            for job in self._query_history(filters, options):
+                jobs.setdefault(job['id'], job)
+
+        return filter_list([jobs[id] for id in sorted(jobs)], filters, options)
+
+    def _query_history(self, filters, options):
+        """
+        Reads at most `offset + limit` (or `history_page` if there is no limit) archived jobs
+        matching `filters`.
+
+        Filters on archived job columns are evaluated by the database. Other filters are
+        evaluated on chunks of the latest archived jobs until enough of them match.
+        """
+        history_filters, remaining = split_filters(filters)
+        offset = options.get('offset') or 0
+        limit = options.get('limit') or (1 if options.get('get') else 0)
+        if not (history_filters or offset or limit):
+            return []
+
+        wanted = offset + limit if limit else self.history_page
+        order_by = options.get('order_by') or []
+        if not remaining and all(o.lstrip('-') in HISTORY_COLUMNS for o in order_by):
+            return self.history.query(history_filters, order_by, wanted)
+
+        jobs = []
+        matched = 0
+        while matched < wanted:
+            chunk_filters = history_filters + ([('id', '<', jobs[-1]['id'])] if jobs else [])
+            chunk = self.history.query(chunk_filters, ['-id'], self.history_page)
+            jobs.extend(chunk)
+            matched += len(filter_list(chunk, remaining))
+            if len(chunk) < self.history_page:
+                break
+        return jobs
+
+    async def flush_history(self):
+        if self.history is None or self.history_flushing:
+            return
+
+        self.history_flushing = True
+        try:
+            await self.middleware.run_in_thread(self.history.flush)
+        finally:
+            self.history_flushing = False
+
+        # In case reserved ids were lost (e.g. the boot device was reinstalled)
+        self.deque.count = max(self.deque.count, self.history.max_id)
+
     def get_lock(self, job):
         """
         Get a shared lock for a job
@@ -113,22 +236,57 @@ class JobsQueue(object):
         if lock is None:
             lock = JobSharedLock(self, name)
             self.job_locks[lock.name] = lock
-        lock.add_job(job)
         return lock
 
-    def release_lock(self, job):
+    def release(self, job):
+        """
+        Release concurrency slots and the shared lock held by a finished job.
+        """
+        self.deque.finished(job)
+        self.progress_suppressed += job.progress_suppressed
+        if self.history is not None and not job.options["transient"]:
+            if self.history.add(job.__encode__()) >= self.history_batch:
+                asyncio.ensure_future(self.flush_history())
+
+        self.running -= 1
+        self.method_running[job.method_name] -= 1
+        if self.method_running[job.method_name] == 0:
+            self.method_running.pop(job.method_name)
+
+        method_waiting = self.method_waiting.get(job.method_name)
+        if method_waiting:
+            self._push_ready(method_waiting.popleft())
+            if not method_waiting:
+                self.method_waiting.pop(job.method_name)
+
         lock = job.get_lock()
-        if not lock:
-            return
-        # Remove job from lock list and release it so another job can use it
-        lock.remove_job(job)
-        lock.release()
+        if lock:
+            # Once a lock is released the next job waiting for it can run
+            next_job = lock.release()
+            if next_job is None:
+                self.job_locks.pop(lock.name)
+            else:
+                self._push_ready(next_job)
 
-        if len(lock.get_jobs()) == 0:
-            self.job_locks.pop(lock.name)
+        self.queue_event.set()
+
+    def stats(self):
+        return {
+            'ready': len(self.ready),
+            'running': self.running,
+            'max_jobs': self.max_jobs,
+            'locks': len(self.job_locks),
+            'lock_waiting': sum(len(lock.waiting) for lock in self.job_locks.values()),
+            'method_running': dict(self.method_running),
+            'method_waiting': {k: len(v) for k, v in self.method_waiting.items()},
+            'progress_suppressed': self.progress_suppressed + sum(
+                job.progress_suppressed for job in list(self.deque.all().values()) if job.state == State.RUNNING
+            ),
+            'history': self.history.stats() if self.history is not None else None,
+        }
 
-        # Once a lock is released there could be another job in the queue
-        # waiting for the same lock
+    def _push_ready(self, job):
+        heapq.heappush(self.ready, (-job.options.get("priority", 0), job.id, job))
         self.queue_event.set()
 
     async def __next__(self):
@@ -139,25 +297,21 @@ class JobsQueue(object):
         while True:
             # Awaits a new event to look for a job
             await self.queue_event.wait()
-            found = None
-            for job in self.queue:
-                lock = self.get_lock(job)
-                # Get job in the queue if it has no lock or its not locked
-                if lock is None or not lock.locked():
-                    found = job
-                    if lock:
-                        await job.set_lock(lock)
-                    break
-            if found:
-                # Unlocked job found to run
-                self.queue.remove(found)
-                # If there are no more jobs in the queue, clear the event
-                if len(self.queue) == 0:
-                    self.queue_event.clear()
-                return found
-            else:
-                # No jobs available to run, clear the event
-                self.queue_event.clear()
+
+            while self.ready and (self.max_jobs is None or self.running < self.max_jobs):
+                job = heapq.heappop(self.ready)[2]
+
+                max_concurrency = job.options.get("max_concurrency")
+                if max_concurrency is not None and self.method_running[job.method_name] >= max_concurrency:
+                    self.method_waiting[job.method_name].append(job)
+                    continue
+
+                self.running += 1
+                self.method_running[job.method_name] += 1
+                return job
+
+            # No jobs available to run, clear the event
+            self.queue_event.clear()
 
     async def run(self):
         while True:
@@ -169,12 +323,16 @@ class JobsDeque(object):
     """
     A jobs deque to do not keep more than `maxlen` in memory
     with a `id` assigner.
+
+    Finished jobs are tracked in the order they finished so the oldest one can be
+    evicted in O(1).
     """
 
     def __init__(self, maxlen=1000):
         self.maxlen = maxlen
         self.count = 0
         self.__dict = OrderedDict()
+        self.__finished = OrderedDict()
 
     def __getitem__(self, item):
         return self.__dict[item]
@@ -189,15 +347,18 @@ class JobsDeque(object):
         self.count += 1
         job.set_id(self.count)
         if len(self.__dict) > self.maxlen:
-            for old_job_id, old_job in self.__dict.items():
-                if old_job.state in (State.SUCCESS, State.FAILED, State.ABORTED):
-                    self.remove(old_job_id)
-                    break
+            if self.__finished:
+                self.remove(next(iter(self.__finished)))
             else:
                 logger.warning("There are %d jobs waiting or running", len(self.__dict))
         self.__dict[job.id] = job
 
+    def finished(self, job):
+        if job.id in self.__dict:
+            self.__finished[job.id] = None
+
     def remove(self, job_id):
+        self.__finished.pop(job_id, None)
         self.__dict[job_id].cleanup()
         del self.__dict[job_id]
 
@@ -229,6 +390,10 @@ class Job(object):
             'description': None,
             'extra': None,
         }
+        self.progress_suppressed = 0
+        self._progress_lock = threading.Lock()
+        self._progress_pending = False
+        self._progress_sent_at = 0
         self.time_started = datetime.now()
         self.time_finished = None
         self.loop = asyncio.get_event_loop()
@@ -258,10 +423,6 @@ class Job(object):
     def get_lock(self):
         return self.lock
 
-    async def set_lock(self, lock):
-        self.lock = lock
-        await self.lock.acquire()
-
     def set_result(self, result):
         self.result = result
 
@@ -281,6 +442,11 @@ class Job(object):
             self.time_finished = datetime.now()
 
     def set_progress(self, percent, description=None, extra=None):
+        """
+        Updates are coalesced: at most one `core.get_jobs` CHANGED event carrying only `state` and
+        `progress` is sent every `middleware.job_progress_interval` seconds, updates made in
+        the meantime are counted in `progress_suppressed`. Can be called from any thread.
+        """
         if percent is not None:
             assert isinstance(percent, (int, float))
             self.progress['percent'] = percent
@@ -288,7 +454,28 @@ class Job(object):
             self.progress['description'] = description
         if extra:
             self.progress['extra'] = extra
-        self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields=self.__encode__())
+
+        with self._progress_lock:
+            if self._progress_pending:
+                self.progress_suppressed += 1
+                return
+            self._progress_pending = True
+
+        delay = max(self._progress_sent_at + self.middleware.job_progress_interval - time.monotonic(), 0)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, self._send_progress)
+
+    def _send_progress(self):
+        with self._progress_lock:
+            self._progress_pending = False
+            self._progress_sent_at = time.monotonic()
+
+        # Finished jobs already sent their full state
+        if self.state in (State.WAITING, State.RUNNING):
+            self.middleware.send_event('core.get_jobs', 'CHANGED', id=self.id, fields={
+                'id': self.id,
+                'state': self.state.name,
+                'progress': dict(self.progress),
+            })
 
     async def wait(self, timeout=None):
         if timeout is None:
@@ -308,7 +495,8 @@ class Job(object):
             event.set()
 
         fut.add_done_callback(done)
-        event.wait()
+        with blocking():
+            event.wait()
         return self.result
 
     def abort(self):
@@ -340,7 +528,7 @@ class Job(object):
             await self.__close_logs()
             await self.__close_pipes()
 
-            queue.release_lock(self)
+            queue.release(self)
             self._finished.set()
             if self.options['transient']:
                 queue.remove(self.id)
@@ -463,6 +651,9 @@ class JobProgressBuffer:
     This wrapper for `job.set_progress` strips too frequent progress updated
     (more frequent than `interval` seconds) so they don't spam websocket
     connections.
+
+    `Job.set_progress` coalesces updates itself, this is only useful to throttle
+    updates of a job more than `job_progress_interval`.
     """
 
     def __init__(self, job, interval=1):
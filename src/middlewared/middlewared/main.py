@@ -1,15 +1,21 @@
 from .apidocs import app as apidocs_app
 from .client import ejson as json
+from .client import emsgpack
 from .event import EventSource
 from .job import Job, JobsQueue
 from .pipe import Pipes, Pipe
 from .restful import RESTfulAPI
 from .schema import ResolverError, Error as SchemaError
 from .service import CallError, CallException, ValidationError, ValidationErrors
-from .utils import start_daemon_thread, load_modules, load_classes
+from .utils import load_modules, load_classes
+from .utils.asyncio_ import ConcurrencyLimit
+from .utils.job_history import JobHistoryStore
+from .utils.process_pool import ProcessPool
+from .utils.send_queue import SendQueue
+from .utils.thread_pool import IoThreadPoolExecutor, blocking
 from .webui_auth import WebUIAuth
 from .worker import main_worker, worker_init
-from aiohttp import web
+from aiohttp import web, WSMsgType
 from aiohttp.web_exceptions import HTTPPermanentRedirect
 from aiohttp.web_middlewares import normalize_path_middleware
 from aiohttp_wsgi import WSGIHandler
@@ -51,8 +57,10 @@ class Application(object):
         self.handshake = False
         self.logger = logger.Logger('application').getLogger()
         self.sessionid = str(uuid.uuid4())
+        self._loop_thread_id = threading.get_ident()
 
         self._py_exceptions = False
+        self._msgpack = False
 
         """
         Callback index registered by services. They are blocking.
@@ -65,14 +73,67 @@ class Application(object):
         self.__event_sources = {}
         self.__subscribed = {}
 
+        # Outgoing messages are written one at a time by `__writer`
+        self.__send_queue = SendQueue(middleware.event_queue_size)
+        self.__send_ready = asyncio.Event()
+        self.__writer_task = None
+        self.__closed = False
+
     def register_callback(self, name, method):
         assert name in ('on_message', 'on_close')
         self.__callbacks[name].append(method)
 
     def _send(self, data):
-        asyncio.run_coroutine_threadsafe(self.response.send_json(
-            data, dumps=json.dumps
-        ), loop=self.loop)
+        if self.__closed:
+            return
+
+        # Encode in the calling thread so event loop does not spend time on it
+        self.__send_queue.put(self.__encode(data))
+        self.__wakeup_writer()
+
+    def _send_event(self, event):
+        if self.__closed:
+            return
+
+        # Events are encoded by the writer as they can still be merged while waiting to be sent
+        if self.__send_queue.put_event(event):
+            self.__wakeup_writer()
+
+    def __encode(self, data):
+        if self._msgpack:
+            return emsgpack.dumps(data)
+        else:
+            return json.dumps(data)
+
+    def __wakeup_writer(self):
+        if threading.get_ident() == self._loop_thread_id:
+            self.__send_ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.__send_ready.set)
+
+    async def __writer(self):
+        while True:
+            await self.__send_ready.wait()
+            self.__send_ready.clear()
+
+            while True:
+                data = self.__send_queue.get()
+                if data is None:
+                    break
+
+                if isinstance(data, dict):
+                    data = self.__encode(data)
+
+                try:
+                    if isinstance(data, bytes):
+                        await self.response.send_bytes(data)
+                    else:
+                        await self.response.send_str(data)
+                except Exception:
+                    self.logger.debug('Failed to send message to %s', self.sessionid, exc_info=True)
+
+    def send_queue_stats(self):
+        return self.__send_queue.stats()
 
     def _tb_error(self, exc_info):
         klass, exc, trace = exc_info
@@ -139,24 +200,30 @@ class Application(object):
             'formatted': ''.join(traceback.format_exception(*exc_info)),
         }
 
-    def send_error(self, message, errno, reason=None, exc_info=None, etype=None, extra=None):
+    def _error(self, errno, reason=None, exc_info=None, etype=None, extra=None):
         error_extra = {}
         if self._py_exceptions and exc_info:
             error_extra['py_exception'] = binascii.b2a_base64(pickle.dumps(exc_info[1])).decode()
+        return dict({
+            'error': errno,
+            'type': etype,
+            'reason': reason,
+            'trace': self._tb_error(exc_info) if exc_info else None,
+            'extra': extra,
+        }, **error_extra)
+
+    def send_error(self, message, errno, reason=None, exc_info=None, etype=None, extra=None):
         self._send({
             'msg': 'result',
             'id': message['id'],
-            'error': dict({
-                'error': errno,
-                'type': etype,
-                'reason': reason,
-                'trace': self._tb_error(exc_info) if exc_info else None,
-                'extra': extra,
-            }, **error_extra),
+            'error': self._error(errno, reason, exc_info, etype, extra),
         })
 
-    async def call_method(self, message):
-
+    async def run_method(self, message):
+        """
+        Run method described by `message` (`method` and `params` keys).
+        Returns a dict with either `result` or `error` key.
+        """
         try:
             result = await self.middleware.call_method(self, message)
             if isinstance(result, Job):
@@ -165,29 +232,29 @@ class Application(object):
                 result = list(result)
             elif isinstance(result, types.AsyncGeneratorType):
                 result = [i async for i in result]
-            self._send({
-                'id': message['id'],
-                'msg': 'result',
-                'result': result,
-            })
+            return {'result': result}
         except ValidationError as e:
-            self.send_error(message, e.errno, str(e), sys.exc_info(), etype='VALIDATION', extra=[
+            return {'error': self._error(e.errno, str(e), sys.exc_info(), etype='VALIDATION', extra=[
                 (e.attribute, e.errmsg, e.errno),
-            ])
+            ])}
         except ValidationErrors as e:
-            self.send_error(message, errno.EAGAIN, str(e), sys.exc_info(), etype='VALIDATION', extra=list(e))
+            return {'error': self._error(errno.EAGAIN, str(e), sys.exc_info(), etype='VALIDATION', extra=list(e))}
         except (CallException, SchemaError) as e:
             # CallException and subclasses are the way to gracefully
             # send errors to the client
-            self.send_error(message, e.errno, str(e), sys.exc_info(), extra=e.extra)
+            return {'error': self._error(e.errno, str(e), sys.exc_info(), extra=e.extra)}
         except Exception as e:
-            self.send_error(message, errno.EINVAL, str(e), sys.exc_info())
+            error = self._error(errno.EINVAL, str(e), sys.exc_info())
             if not self._py_exceptions:
                 self.logger.warn('Exception while calling {}(*{})'.format(
                     message['method'],
                     self.middleware.dump_args(message.get('params', []), method_name=message['method'])
                 ), exc_info=True)
                 asyncio.ensure_future(self.__crash_reporting(sys.exc_info()))
+            return {'error': error}
+
+    async def call_method(self, message):
+        self._send(dict(await self.run_method(message), id=message['id'], msg='result'))
 
     async def __crash_reporting(self, exc_info):
         if self.middleware.crash_reporting.is_disabled():
@@ -213,25 +280,20 @@ class Application(object):
             arg = None
         event_source = self.middleware.get_event_source(shortname)
         if event_source:
-            for v in self.__event_sources.values():
-                # Do not allow an event source to be subscribed again
-                if v['name'] == name:
-                    self._send({
-                        'msg': 'nosub',
-                        'id': ident,
-                        'error': {
-                            'error': 'Already subscribed',
-                        }
-                    })
-                    return
-            es = event_source(self.middleware, self, ident, name, arg)
-            self.__event_sources[ident] = {
-                'event_source': es,
-                'name': name,
-            }
-            # Start it after setting __event_sources or it can have a race condition
-            start_daemon_thread(target=es.process)
+            # Do not allow an event source to be subscribed again
+            if name in self.__event_sources.values():
+                self._send({
+                    'msg': 'nosub',
+                    'id': ident,
+                    'error': {
+                        'error': 'Already subscribed',
+                    }
+                })
+                return
+            self.__event_sources[ident] = name
         else:
+            if name not in self.__subscribed.values():
+                self.middleware.register_event_subscriber(name, self)
             self.__subscribed[ident] = name
 
         self._send({
@@ -239,19 +301,23 @@ class Application(object):
             'subs': [ident],
         })
 
+        if event_source:
+            self.middleware.subscribe_event_source(self, ident, name, arg)
+
     async def unsubscribe(self, ident):
         if ident in self.__subscribed:
-            self.__subscribed.pop(ident)
+            name = self.__subscribed.pop(ident)
+            if name not in self.__subscribed.values():
+                self.middleware.unregister_event_subscriber(name, self)
         elif ident in self.__event_sources:
-            event_source = self.__event_sources[ident]['event_source']
-            await self.middleware.run_in_thread(event_source.cancel)
+            name = self.__event_sources.pop(ident)
+            self.middleware.unsubscribe_event_source(self, ident, name)
 
     def send_event(self, name, event_type, **kwargs):
-        if (
-            not any(i == name or i == '*' for i in self.__subscribed.values()) and
-            not any(i['name'] == name for i in self.__event_sources.values())
-        ):
-            return
+        """
+        Send event `name` to the client. `Middleware.send_event` only calls this for
+        clients subscribed to `name`.
+        """
         event = {
             'msg': event_type.lower(),
             'collection': name,
@@ -267,9 +333,10 @@ class Application(object):
                 event['cleared'] = kwargs.pop('cleared')
         if kwargs:
             event['extra'] = kwargs
-        self._send(event)
+        self._send_event(event)
 
     def on_open(self):
+        self.__writer_task = asyncio.ensure_future(self.__writer())
         self.middleware.register_wsclient(self)
 
     async def on_close(self, *args, **kwargs):
@@ -280,12 +347,21 @@ class Application(object):
             except Exception:
                 self.logger.error('Failed to run on_close callback.', exc_info=True)
 
-        for ident, val in self.__event_sources.items():
-            event_source = val['event_source']
-            asyncio.ensure_future(self.middleware.run_in_thread(event_source.cancel))
+        for ident, name in self.__event_sources.items():
+            self.middleware.unsubscribe_event_source(self, ident, name)
+        self.__event_sources.clear()
+
+        for name in set(self.__subscribed.values()):
+            self.middleware.unregister_event_subscriber(name, self)
+        self.__subscribed.clear()
 
         self.middleware.unregister_wsclient(self)
 
+        self.__closed = True
+        self.__send_queue.clear()
+        if self.__writer_task is not None:
+            self.__writer_task.cancel()
+
     async def on_message(self, message):
         # Run callbacks registered in plugins for on_message
         for method in self.__callbacks['on_message']:
@@ -304,6 +380,9 @@ class Application(object):
                 features = message.get('features') or []
                 if 'PY_EXCEPTIONS' in features:
                     self._py_exceptions = True
+                # Responses (starting with `connected`) are sent as binary msgpack frames
+                if 'MSGPACK' in features:
+                    self._msgpack = True
                 # aiohttp can cancel tasks if a request take too long to finish
                 # It is desired to prevent that in this stage in case we are debugging
                 # middlewared via gdb (which makes the program execution a lot slower)
@@ -726,27 +805,49 @@ class ShellApplication(object):
 
 class Middleware(object):
 
-    def __init__(self, loop_debug=False, loop_monitor=True, overlay_dirs=None, debug_level=None):
+    def __init__(
+        self, loop_debug=False, loop_monitor=True, overlay_dirs=None, debug_level=None, io_threads=128,
+        process_workers_min=2, process_workers_max=8, ws_compress=True, datastore_cache=True,
+        replication_streams=4, max_jobs=None, job_history=True, job_progress_interval=1, event_queue_size=1000,
+        zfs_inventory_interval=600,
+    ):
         self.logger = logger.Logger('middlewared', debug_level).getLogger()
         self.crash_reporting = logger.CrashReporting()
         self.crash_reporting_semaphore = asyncio.Semaphore(value=2)
         self.loop_debug = loop_debug
         self.loop_monitor = loop_monitor
         self.overlay_dirs = overlay_dirs or []
+        self.ws_compress = ws_compress
+        self.datastore_cache = datastore_cache
+        self.replication_streams = replication_streams
+        self.job_progress_interval = job_progress_interval
+        self.event_queue_size = event_queue_size
+        self.zfs_inventory_interval = zfs_inventory_interval
         self.__loop = None
         self.__thread_id = threading.get_ident()
         # Spawn new processes for ProcessPool instead of forking
         multiprocessing.set_start_method('spawn')
-        self.__procpool = concurrent.futures.ProcessPoolExecutor(
-            max_workers=2,
+        self.__procpool = ProcessPool(
+            'ProcessWorker',
+            min_workers=process_workers_min,
+            max_workers=process_workers_max,
             initializer=worker_init,
+            # Recycle workers so leaks in long living processes (e.g. iocage) do not pile up
+            max_calls=1000,
+            max_rss=512 * 1024 * 1024,
         )
         self.__threadpool = concurrent.futures.ThreadPoolExecutor(max_workers=10)
-        self.jobs = JobsQueue(self)
+        self.__io_threadpool = IoThreadPoolExecutor('IoThread', max_workers=io_threads)
+        self.__thread_limits = {}
+        self.jobs = JobsQueue(self, max_jobs=max_jobs, history=JobHistoryStore() if job_history else None)
         self.__schemas = {}
         self.__services = {}
         self.__wsclients = {}
+        # Event name -> {sessionid: wsclient} of clients subscribed to it
+        self.__event_subscribers = defaultdict(dict)
         self.__event_sources = {}
+        # Running event sources by name (including argument)
+        self.__event_source_instances = {}
         self.__event_subs = defaultdict(list)
         self.__hooks = defaultdict(list)
         self.__server_threads = []
@@ -856,6 +957,30 @@ class Middleware(object):
     def unregister_wsclient(self, client):
         self.__wsclients.pop(client.sessionid)
 
+    def register_event_subscriber(self, name, client):
+        self.__event_subscribers[name][client.sessionid] = client
+
+    def unregister_event_subscriber(self, name, client):
+        subscribers = self.__event_subscribers.get(name)
+        if subscribers is not None:
+            subscribers.pop(client.sessionid, None)
+            if not subscribers:
+                self.__event_subscribers.pop(name)
+
+    def get_event_stats(self):
+        connections = {sessionid: wsclient.send_queue_stats() for sessionid, wsclient in list(self.__wsclients.items())}
+        return {
+            'subscribers': {name: len(subscribers) for name, subscribers in list(self.__event_subscribers.items())},
+            'event_sources': {
+                name: len(event_source.subscribers)
+                for name, event_source in list(self.__event_source_instances.items())
+            },
+            'queued': sum(i['queued'] for i in connections.values()),
+            'merged': sum(i['merged'] for i in connections.values()),
+            'dropped': sum(i['dropped'] for i in connections.values()),
+            'connections': connections,
+        }
+
     def register_hook(self, name, method, sync=True):
         """
         Register a hook under `name`.
@@ -896,6 +1021,43 @@ class Middleware(object):
     def get_event_source(self, name):
         return self.__event_sources.get(name)
 
+    def subscribe_event_source(self, app, ident, name, arg):
+        """
+        Subscribe `app` to event source `name`. Clients subscribed to the same name
+        and argument share a single event source instance.
+        """
+        event_source = self.__event_source_instances.get(name)
+        if event_source is None:
+            shortname = name.split(':', 1)[0]
+            event_source = self.__event_sources[shortname](self, name, arg)
+            self.__event_source_instances[name] = event_source
+            event_source.subscribers[(app.sessionid, ident)] = app
+            event_source.start()
+        else:
+            event_source.on_subscribe(app)
+            event_source.subscribers[(app.sessionid, ident)] = app
+
+    def unsubscribe_event_source(self, app, ident, name):
+        """
+        Cancel the event source once its last subscriber is gone.
+        """
+        event_source = self.__event_source_instances.get(name)
+        if event_source is None:
+            return
+
+        event_source.subscribers.pop((app.sessionid, ident), None)
+        if not event_source.subscribers:
+            self.__event_source_instances.pop(name)
+            event_source.cancel()
+
+    async def event_source_finished(self, event_source):
+        if self.__event_source_instances.get(event_source.name) is event_source:
+            self.__event_source_instances.pop(event_source.name)
+
+        for (sessionid, ident), app in list(event_source.subscribers.items()):
+            await app.unsubscribe(ident)
+        event_source.subscribers.clear()
+
     def add_service(self, service):
         self.__services[service._config.namespace] = service
 
@@ -928,8 +1090,9 @@ class Middleware(object):
     async def _run_in_conn_threadpool(self, method, *args, **kwargs):
         """
         Threads to handle websocket connection are gated on `__threadpool`.
-        Any other calls should use `run_in_thread` as that launches its own thread
-        and does not cause deadlock waiting another thread to finish in the pool
+        Any other calls should use `run_in_thread` as that pool spawns a new thread
+        whenever its workers are blocked on nested calls and does not cause deadlock
+        waiting another thread to finish in the pool
         (which could happen on the stack call, e.g.
            service.foo calls something in using the thread pool and something also
            uses the thread pool. If service.foo is called many times before each thread
@@ -941,16 +1104,44 @@ class Middleware(object):
         return await self.run_in_executor(self.__procpool, method, *args, **kwargs)
 
     async def run_in_thread(self, method, *args, **kwargs):
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        try:
-            return await self.loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
-        finally:
-            executor.shutdown(wait=False)
+        """
+        Runs blocking `method` in the I/O thread pool.
+        Threads are reused between calls and their number is capped by `io_threads`.
+        """
+        return await self.loop.run_in_executor(self.__io_threadpool, functools.partial(method, *args, **kwargs))
+
+    def __get_thread_limit(self, name, serviceobj, methodobj):
+        """
+        Concurrency limit for threaded calls of a method, either set for the method
+        using @thread_limit or for the whole service using `thread_limit` Config attribute.
+        """
+        limit = getattr(methodobj, '_thread_limit', None)
+        if limit is not None:
+            key = name
+        elif serviceobj._config.thread_limit is not None:
+            limit = serviceobj._config.thread_limit
+            key = serviceobj._config.namespace
+        else:
+            return None
+
+        thread_limit = self.__thread_limits.get(key)
+        if thread_limit is None:
+            thread_limit = self.__thread_limits[key] = ConcurrencyLimit(limit)
+        return thread_limit
+
+    def get_process_pool_stats(self):
+        return self.__procpool.stats()
+
+    def get_thread_pool_stats(self):
+        return {
+            'io': self.__io_threadpool.stats(),
+            'limits': {k: v.stats() for k, v in self.__thread_limits.items()},
+        }
 
     def pipe(self):
         return Pipe(self)
 
-    async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=True):
+    async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=True, nested=False):
 
         args = []
         if hasattr(methodobj, '_pass_app'):
@@ -997,7 +1188,14 @@ class Middleware(object):
                 run_method = self.run_in_thread
             else:
                 run_method = self._run_in_conn_threadpool
-            return await run_method(methodobj, *args)
+
+            # Nested calls (call_sync) are not subject to limits because the caller
+            # may be holding the very same limit we would wait for.
+            thread_limit = None if nested else self.__get_thread_limit(name, serviceobj, methodobj)
+            if thread_limit is None:
+                return await run_method(methodobj, *args)
+            async with thread_limit:
+                return await run_method(methodobj, *args)
 
     async def _call_worker(self, serviceobj, name, *args, job=None):
         return await self.run_in_proc(
@@ -1039,8 +1237,7 @@ class Middleware(object):
         serviceobj, methodobj = self._method_lookup(message['method'])
 
         if not app.authenticated and not hasattr(methodobj, '_no_auth_required'):
-            app.send_error(message, errno.EACCES, 'Not authenticated')
-            return
+            raise CallError('Not authenticated', errno.EACCES)
 
         return await self._call(message['method'], serviceobj, methodobj, params, app=app, io_thread=False)
 
@@ -1059,8 +1256,11 @@ class Middleware(object):
         # This method is already being called from a thread so we cant use the same
         # thread pool or we may get in a deadlock situation if all threads in the default
         # pool are waiting.
-        # Instead we launch a new thread just for that call (io_thread).
-        fut = asyncio.run_coroutine_threadsafe(self._call(name, serviceobj, methodobj, params, io_thread=True), self.__loop)
+        # Instead we use the I/O thread pool (io_thread) and flag this thread as blocked
+        # so the pool is allowed to spawn a new thread for the nested call.
+        fut = asyncio.run_coroutine_threadsafe(
+            self._call(name, serviceobj, methodobj, params, io_thread=True, nested=True), self.__loop
+        )
         event = threading.Event()
 
         def done(_):
@@ -1068,10 +1268,11 @@ class Middleware(object):
 
         fut.add_done_callback(done)
 
-        # In case middleware dies while we are waiting for a `call_sync` result
-        while not event.wait(1):
-            if not self.__loop.is_running():
-                raise RuntimeError('Middleware is terminating')
+        with blocking():
+            # In case middleware dies while we are waiting for a `call_sync` result
+            while not event.wait(1):
+                if not self.__loop.is_running():
+                    raise RuntimeError('Middleware is terminating')
         return fut.result()
 
     def event_subscribe(self, name, handler):
@@ -1085,7 +1286,10 @@ class Middleware(object):
 
         self.logger.trace(f'Sending event "{event_type}":{kwargs}')
 
-        for sessionid, wsclient in list(self.__wsclients.items()):
+        # Only clients subscribed to the event (or to all events)
+        subscribers = dict(self.__event_subscribers.get('*', {}))
+        subscribers.update(self.__event_subscribers.get(name, {}))
+        for sessionid, wsclient in subscribers.items():
             try:
                 wsclient.send_event(name, event_type, **kwargs)
             except Exception:
@@ -1100,14 +1304,18 @@ class Middleware(object):
         pdb.set_trace()
 
     async def ws_handler(self, request):
-        ws = web.WebSocketResponse()
+        # permessage-deflate is used if requested by the client in the handshake
+        ws = web.WebSocketResponse(compress=self.ws_compress)
         await ws.prepare(request)
 
         connection = Application(self, self.__loop, request, ws)
         connection.on_open()
 
         async for msg in ws:
-            x = json.loads(msg.data)
+            if msg.type == WSMsgType.BINARY:
+                x = emsgpack.loads(msg.data)
+            else:
+                x = json.loads(msg.data)
             try:
                 await connection.on_message(x)
             except Exception as e:
@@ -1184,7 +1392,7 @@ class Middleware(object):
         self.__setup_periodic_tasks()
 
         # Start up middleware worker process pool
-        self.__procpool._start_queue_management_thread()
+        self.__procpool.start()
 
         runner = web.AppRunner(app, handle_signals=False, access_log=None)
         self.__loop.run_until_complete(runner.setup())
@@ -1236,6 +1444,17 @@ def main():
     parser.add_argument('--disable-loop-monitor', '-L', action='store_true')
     parser.add_argument('--loop-debug', action='store_true')
     parser.add_argument('--overlay-dirs', '-o', action='append')
+    parser.add_argument('--io-threads', type=int, default=128)
+    parser.add_argument('--process-workers-min', type=int, default=2)
+    parser.add_argument('--process-workers-max', type=int, default=8)
+    parser.add_argument('--disable-ws-compression', action='store_true')
+    parser.add_argument('--disable-datastore-cache', action='store_true')
+    parser.add_argument('--replication-streams', type=int, default=4)
+    parser.add_argument('--max-jobs', type=int)
+    parser.add_argument('--disable-job-history', action='store_true')
+    parser.add_argument('--job-progress-interval', type=float, default=1)
+    parser.add_argument('--event-queue-size', type=int, default=1000)
+    parser.add_argument('--zfs-inventory-interval', type=float, default=600)
     parser.add_argument('--debug-level', choices=[
         'TRACE',
         'DEBUG',
@@ -1287,6 +1506,17 @@ def main():
         loop_monitor=not args.disable_loop_monitor,
         overlay_dirs=args.overlay_dirs,
         debug_level=args.debug_level,
+        io_threads=args.io_threads,
+        process_workers_min=args.process_workers_min,
+        process_workers_max=args.process_workers_max,
+        ws_compress=not args.disable_ws_compression,
+        datastore_cache=not args.disable_datastore_cache,
+        replication_streams=args.replication_streams,
+        max_jobs=args.max_jobs,
+        job_history=not args.disable_job_history,
+        job_progress_interval=args.job_progress_interval,
+        event_queue_size=args.event_queue_size,
+        zfs_inventory_interval=args.zfs_inventory_interval,
     ).run()
 
 
@@ -4,6 +4,8 @@ from middlewared.service import (
 )
 from middlewared.utils import run, Popen
 
+from collections import defaultdict
+
 import asyncio
 import binascii
 import crypt
@@ -67,25 +69,34 @@ class UserService(CRUDService):
 
     class Config:
         datastore = 'account.bsdusers'
-        datastore_extend = 'user.user_extend'
+        datastore_extend_many = 'user.user_extend_many'
         datastore_prefix = 'bsdusr_'
+        datastore_raw_fields = ['username', 'uid', 'builtin', 'full_name', 'home', 'locked']
 
     @private
-    async def user_extend(self, user):
+    async def user_extend_many(self, users):
 
-        # Get group membership
-        user['groups'] = [gm['group']['id'] for gm in await self.middleware.call('datastore.query', 'account.bsdgroupmembership', [('user', '=', user['id'])], {'prefix': 'bsdgrpmember_'})]
+        # Get group membership of all queried users at once
+        groups = defaultdict(list)
+        for gm in await self.middleware.call(
+            'datastore.query', 'account.bsdgroupmembership', [('user', 'in', [u['id'] for u in users])],
+            {'prefix': 'bsdgrpmember_'}
+        ):
+            groups[gm['user']['id']].append(gm['group']['id'])
 
-        # Get authorized keys
-        keysfile = f'{user["home"]}/.ssh/authorized_keys'
-        user['sshpubkey'] = None
-        if os.path.exists(keysfile):
-            try:
-                with open(keysfile, 'r') as f:
-                    user['sshpubkey'] = f.read()
-            except Exception:
-                pass
-        return user
+        for user in users:
+            user['groups'] = groups[user['id']]
+
+            # Get authorized keys
+            keysfile = f'{user["home"]}/.ssh/authorized_keys'
+            user['sshpubkey'] = None
+            if os.path.exists(keysfile):
+                try:
+                    with open(keysfile, 'r') as f:
+                        user['sshpubkey'] = f.read()
+                except Exception:
+                    pass
+        return users
 
     @accepts(Dict(
         'user_create',
@@ -592,6 +603,7 @@ class GroupService(CRUDService):
         datastore = 'account.bsdgroups'
         datastore_prefix = 'bsdgrp_'
         datastore_extend = 'group.group_extend'
+        datastore_raw_fields = ['group', 'gid', 'builtin']
 
     @private
     async def group_extend(self, group):
@@ -51,6 +51,7 @@ class SharingAFPService(CRUDService):
         datastore = 'sharing.afp_share'
         datastore_prefix = 'afp_'
         datastore_extend = 'sharing.afp.extend'
+        datastore_raw_fields = ['name', 'path']
 
     @accepts(Dict(
         'sharingafp_create',
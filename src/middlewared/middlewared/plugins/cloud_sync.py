@@ -370,14 +370,16 @@ class CloudSyncService(CRUDService):
     class Config:
         datastore = "tasks.cloudsync"
         datastore_extend = "cloudsync._extend"
+        datastore_raw_fields = ["description", "enabled"]
 
     @filterable
     async def query(self, filters=None, options=None):
         tasks_or_task = await super().query(filters, options)
 
         jobs = {}
-        for j in await self.middleware.call("core.get_jobs", [("method", "=", "cloudsync.sync")],
-                                            {"order_by": ["id"]}):
+        # Only look at the most recent jobs, not at the whole job history
+        for j in reversed(await self.middleware.call("core.get_jobs", [("method", "=", "cloudsync.sync")],
+                                                     {"order_by": ["-id"], "limit": 1000})):
             try:
                 task_id = int(j["arguments"][0])
             except (IndexError, ValueError):
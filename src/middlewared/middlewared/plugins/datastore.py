@@ -1,9 +1,10 @@
 from middlewared.service import CallError, Service
-from middlewared.schema import accepts, Any, Bool, Dict, List, Ref, Str
+from middlewared.schema import accepts, Any, Bool, Dict, Int, List, Ref, Str
 from sqlite3 import OperationalError
 
 import os
 import sys
+import threading
 from itertools import chain
 
 sys.path.append('/usr/local/www')
@@ -25,7 +26,8 @@ from django.db.models.fields.related import ForeignKey, ManyToManyField
 from freenasUI.freeadmin.sqlite3_ha import base as sqlite3_ha_base
 sqlite3_ha_base.execute_sync = True
 
-from middlewared.utils import django_modelobj_serialize
+from middlewared.utils import django_queryset_serialize, select_fields
+from middlewared.utils.query_cache import QueryCache
 
 
 class DatastoreService(Service):
@@ -33,6 +35,12 @@ class DatastoreService(Service):
     class Config:
         private = True
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__cache = QueryCache()
+        self.__cache_dependencies = {}
+        self.__cache_local = threading.local()
+
     def _filters_to_queryset(self, filters, field_prefix=None):
         opmap = {
             '=': 'exact',
@@ -84,9 +92,123 @@ class DatastoreService(Service):
         app, model = name.split('.', 1)
         return apps.get_model(app, model)
 
-    def __queryset_serialize(self, qs, extend=None, field_prefix=None):
-        for i in qs:
-            yield django_modelobj_serialize(self.middleware, i, extend=extend, field_prefix=field_prefix)
+    def __model_dependencies(self, model):
+        """
+        Tables rows of `model` query results are read from, following
+        ForeignKey and ManyToMany fields the way they are serialized.
+        """
+        tables = self.__cache_dependencies.get(model)
+        if tables is None:
+            tables = set()
+            models = [model]
+            while models:
+                m = models.pop()
+                if m._meta.db_table in tables:
+                    continue
+                tables.add(m._meta.db_table)
+                for field in chain(m._meta.fields, m._meta.many_to_many):
+                    if isinstance(field, (ForeignKey, ManyToManyField)):
+                        models.append(field.rel.to)
+            tables = self.__cache_dependencies[model] = frozenset(tables)
+        return tables
+
+    def __filters_cacheable(self, model, filters, prefix):
+        # Lookups spanning reverse relations would make the result depend on
+        # tables we do not track, only allow forward ForeignKey/ManyToMany.
+        for f in filters:
+            if not isinstance(f, (list, tuple)):
+                return False
+            if len(f) == 2:
+                if not isinstance(f[1], (list, tuple)) or not self.__filters_cacheable(model, f[1], prefix):
+                    return False
+                continue
+            name = f[0]
+            if prefix and name != 'id':
+                name = prefix + name
+            m = model
+            for part in name.split('__')[:-1]:
+                try:
+                    field = m._meta.get_field(part)
+                except Exception:
+                    return False
+                if not isinstance(field, (ForeignKey, ManyToManyField)):
+                    return False
+                m = field.rel.to
+        return True
+
+    def __data_version(self):
+        cursor = connection.cursor()
+        try:
+            cursor.executelocal('PRAGMA data_version')
+            # `data_version` only changes on commits of other connections, `total_changes`
+            # counts rows changed through this one (e.g. ORM writes done by notifier)
+            return (id(connection.connection), cursor.fetchone()[0], connection.connection.total_changes)
+        finally:
+            cursor.close()
+
+    def __cache_check_data_version(self):
+        """
+        Drop the cache if the database has been changed by another connection
+        (e.g. the web UI writing through django directly) or outside of `datastore.*`.
+        """
+        data_version = self.__data_version()
+
+        # Django connections are per thread and so is `data_version`
+        if getattr(self.__cache_local, 'data_version', None) != data_version:
+            self.__cache_local.data_version = data_version
+            self.__cache.clear()
+
+    def __cache_invalidate(self, model):
+        self.__cache.invalidate([model._meta.db_table])
+
+        if not self.middleware.datastore_cache:
+            return
+
+        # Changes we have just made are invalidated above, anything else clears the cache
+        # on the next check. `__cache_check_data_version` was called before the write.
+        local_version = getattr(self.__cache_local, 'data_version', None)
+        data_version = self.__data_version()
+        if local_version is not None and local_version[:2] == data_version[:2]:
+            self.__cache_local.data_version = data_version
+
+    def __query(self, model, filters, options):
+        qs = model.objects.all()
+
+        extra = options.get('extra')
+        if extra:
+            qs = qs.extra(**extra)
+
+        prefix = options.get('prefix')
+
+        if filters:
+            qs = qs.filter(*self._filters_to_queryset(filters, prefix))
+
+        order_by = options.get('order_by')
+        if order_by:
+            if prefix:
+                # Do not change original order_by
+                order_by = order_by[:]
+                for i, order in enumerate(order_by):
+                    if order.startswith('-'):
+                        order_by[i] = '-' + prefix + order[1:]
+                    else:
+                        order_by[i] = prefix + order
+            qs = qs.order_by(*order_by)
+
+        if options.get('count') is True:
+            return qs.count()
+
+        offset = options.get('offset') or 0
+        limit = options.get('limit')
+        if offset or limit:
+            qs = qs[offset:offset + limit if limit else None]
+
+        # Extend methods might need any field so projection is done afterwards
+        fields = None
+        if options.get('select') and not options.get('extend') and not options.get('extend_many'):
+            fields = set(options['select'])
+
+        return django_queryset_serialize(self.middleware, qs, field_prefix=prefix, fields=fields)
 
     @accepts(
         Str('name'),
@@ -94,10 +216,14 @@ class DatastoreService(Service):
         Dict(
             'query-options',
             Str('extend', default=None, null=True),
+            Str('extend_many', default=None, null=True),
             Dict('extra', additional_attrs=True),
             List('order_by', default=[]),
             Bool('count', default=False),
             Bool('get', default=False),
+            Int('offset', default=0),
+            Int('limit', default=0),
+            List('select', default=[], items=[Str('field')]),
             Str('prefix'),
             default=None,
             null=True,
@@ -122,6 +248,12 @@ class DatastoreService(Service):
 
         `[ ['username', '=', 'root' ] ]`
 
+        `extend` method is called for every item while `extend_many` method is called
+        once with the list of all items and must return the list of extended items.
+
+        `offset` and `limit` (0 for no limit) page through the items, `count` ignores them.
+        `select` restricts every item to the given fields.
+
         .. examples(websocket)::
 
           Querying for username "root" and returning a single item:
@@ -142,43 +274,58 @@ class DatastoreService(Service):
             # which might happen with "prefix"
             options = options.copy()
 
-        qs = model.objects.all()
+        if options.get('get') is True:
+            # Only the first item is needed
+            options['limit'] = 1
+
+        # Only rows coming from the database are cached, `extend` and `extend_many`
+        # may depend on anything else so they are always called.
+        if (
+            self.middleware.datastore_cache and
+            not options.get('extra') and
+            self.__filters_cacheable(model, filters or [], options.get('prefix'))
+        ):
+            self.__cache_check_data_version()
+            key = repr((name, filters, sorted(
+                (k, v) for k, v in options.items() if k not in ('extend', 'extend_many', 'get')
+            )))
+            hit, result = self.__cache.get(key)
+            if not hit:
+                token = self.__cache.token()
+                result = self.__query(model, filters, options)
+                self.__cache.put(key, self.__model_dependencies(model), result, token)
+        else:
+            result = self.__query(model, filters, options)
 
-        extra = options.get('extra')
-        if extra:
-            qs = qs.extra(**extra)
+        if options.get('count') is True:
+            return result
 
-        prefix = options.get('prefix')
+        if options.get('get') is True:
+            result = [result[0]]
 
-        if filters:
-            qs = qs.filter(*self._filters_to_queryset(filters, prefix))
+        extend_many = options.get('extend_many')
+        if extend_many and result:
+            result = self.middleware.call_sync(extend_many, result)
 
-        order_by = options.get('order_by')
-        if order_by:
-            if prefix:
-                # Do not change original order_by
-                order_by = order_by[:]
-                for i, order in enumerate(order_by):
-                    if order.startswith('-'):
-                        order_by[i] = '-' + prefix + order[1:]
-                    else:
-                        order_by[i] = prefix + order
-            qs = qs.order_by(*order_by)
+        extend = options.get('extend')
+        if extend:
+            result = [self.middleware.call_sync(extend, i) for i in result]
 
-        if options.get('count') is True:
-            return qs.count()
-
-        result = []
-        for i in self.__queryset_serialize(
-            qs, extend=options.get('extend'), field_prefix=options.get('prefix')
-        ):
-            result.append(i)
+        if options.get('select') and (extend or extend_many):
+            result = [select_fields(i, options['select']) for i in result]
 
         if options.get('get') is True:
             return result[0]
 
         return result
 
+    @accepts()
+    def cache_stats(self):
+        """
+        Statistics of `datastore.query` results cache.
+        """
+        return dict(self.__cache.stats(), enabled=self.middleware.datastore_cache)
+
     @accepts(Str('name'), Ref('query-options'))
     def config(self, name, options=None):
         """
@@ -196,6 +343,9 @@ class DatastoreService(Service):
         """
         Insert a new entry to `name`.
         """
+        if self.middleware.datastore_cache:
+            self.__cache_check_data_version()
+
         data = data.copy()
         many_to_many_fields_data = {}
         options = options or {}
@@ -224,6 +374,7 @@ class DatastoreService(Service):
             field = getattr(obj, k)
             field.add(*v)
 
+        self.__cache_invalidate(model)
         return obj.pk
 
     @accepts(Str('name'), Any('id'), Dict('data', additional_attrs=True), Dict('options', Str('prefix')))
@@ -231,6 +382,9 @@ class DatastoreService(Service):
         """
         Update an entry `id` in `name`.
         """
+        if self.middleware.datastore_cache:
+            self.__cache_check_data_version()
+
         data = data.copy()
         many_to_many_fields_data = {}
         options = options or {}
@@ -258,6 +412,7 @@ class DatastoreService(Service):
             field.clear()
             field.add(*v)
 
+        self.__cache_invalidate(model)
         return obj.pk
 
     @accepts(Str('name'), Any('id_or_filters'))
@@ -265,12 +420,17 @@ class DatastoreService(Service):
         """
         Delete an entry `id` in `name`.
         """
+        if self.middleware.datastore_cache:
+            self.__cache_check_data_version()
+
         model = self.__get_model(name)
         if isinstance(id_or_filters, list):
             qs = model.objects.all()
             qs.filter(*self._filters_to_queryset(id_or_filters, None)).delete()
         else:
             model.objects.get(pk=id_or_filters).delete()
+        # Rows deleted by cascade belong to tables depending on this one
+        self.__cache_invalidate(model)
         return True
 
     def sql(self, query, params=None):
@@ -291,6 +451,8 @@ class DatastoreService(Service):
             raise CallError(err)
         finally:
             cursor.close()
+            if not query.lstrip().upper().startswith('SELECT'):
+                self.__cache.clear()
         return rv
 
     @accepts(List('queries'))
@@ -299,7 +461,10 @@ class DatastoreService(Service):
         Receives a list of SQL queries (usually a database dump)
         and executes it within a transaction.
         """
-        return connection.dump_recv(queries)
+        try:
+            return connection.dump_recv(queries)
+        finally:
+            self.__cache.clear()
 
     @accepts()
     def dump(self):
@@ -1,3 +1,4 @@
+import asyncio
 import binascii
 import bsd
 import errno
@@ -230,23 +231,26 @@ class FilesystemService(Service):
 
 class FileFollowTailEventSource(EventSource):
 
-    def run(self):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arg = self.arg or ''
         if ':' in self.arg:
-            path, lines = self.arg.rsplit(':', 1)
-            lines = int(lines)
+            self.path, lines = self.arg.rsplit(':', 1)
+            try:
+                self.lines = int(lines)
+            except ValueError:
+                self.lines = None
         else:
-            path = self.arg
-            lines = 3
-        if not os.path.exists(path):
-            # FIXME: Error?
-            return
+            self.path = self.arg
+            self.lines = 3
 
+    def tail(self):
         bufsize = 8192
-        fsize = os.stat(path).st_size
+        fsize = os.stat(self.path).st_size
         if fsize < bufsize:
             bufsize = fsize
         i = 0
-        with open(path) as f:
+        with open(self.path) as f:
             data = []
             while True:
                 i += 1
@@ -254,11 +258,32 @@ class FileFollowTailEventSource(EventSource):
                     break
                 f.seek(fsize - bufsize * i)
                 data.extend(f.readlines())
-                if len(data) >= lines or f.tell() == 0:
+                if len(data) >= self.lines or f.tell() == 0:
                     break
 
-            self.send_event('ADDED', fields={'data': ''.join(data[-lines:])})
-            f.seek(fsize)
+        return ''.join(data[-self.lines:])
+
+    def on_subscribe(self, app):
+        if self.lines is None:
+            return
+
+        # Every subscriber starts with the last lines of the file
+        def send_tail():
+            try:
+                app.send_event(self.name, 'ADDED', fields={'data': self.tail()})
+            except OSError:
+                pass
+
+        asyncio.ensure_future(self.middleware.run_in_thread(send_tail))
+
+    def run(self):
+        if self.lines is None or not os.path.exists(self.path):
+            # FIXME: Error?
+            return
+
+        with open(self.path) as f:
+            f.seek(0, os.SEEK_END)
+            self.send_event('ADDED', fields={'data': self.tail()})
 
             kqueue = select.kqueue()
 
@@ -701,9 +701,6 @@ class iSCSITargetExtentService(CRUDService):
         async for pdisk in await self.middleware.call('pool.get_disks'):
             used_disks.append(pdisk)
 
-        zfs_snaps = await self.middleware.call('zfs.snapshot.query', [],
-                                               {'order_by': ['name']})
-
         zvols = await self.middleware.call(
             'pool.dataset.query',
             [('type', '=', 'VOLUME')]
@@ -711,6 +708,10 @@ class iSCSITargetExtentService(CRUDService):
 
         zvol_list = [ds['name'] for ds in zvols]
 
+        zfs_snaps = await self.middleware.call('zfs.snapshot.query', [('dataset', 'in', zvol_list)], {
+            'order_by': ['name'], 'extra': {'properties': ['name', 'referenced']},
+        })
+
         for zvol in zvols:
             zvol_name = zvol['name']
             zvol_size = zvol['volsize']['value']
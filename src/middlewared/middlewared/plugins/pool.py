@@ -8,6 +8,7 @@ import re
 import subprocess
 import sysctl
 import tempfile
+import threading
 import uuid
 
 import bsd
@@ -63,6 +64,83 @@ def _null(x):
     return x
 
 
+# (zfs property, pool.dataset attribute if named differently, value transformation)
+DATASET_PROPERTIES_TRANSFORM = (
+    ('org.freenas:description', 'comments', None),
+    ('org.freenas:quota_warning', 'quota_warning', None),
+    ('org.freenas:quota_critical', 'quota_critical', None),
+    ('org.freenas:refquota_warning', 'refquota_warning', None),
+    ('org.freenas:refquota_critical', 'refquota_critical', None),
+    ('dedup', 'deduplication', str.upper),
+    ('atime', None, str.upper),
+    ('casesensitivity', None, str.upper),
+    ('exec', None, str.upper),
+    ('sync', None, str.upper),
+    ('compression', None, str.upper),
+    ('compressratio', None, None),
+    ('origin', None, None),
+    ('quota', None, _null),
+    ('refquota', None, _null),
+    ('reservation', None, _null),
+    ('refreservation', None, _null),
+    ('copies', None, None),
+    ('snapdir', None, str.upper),
+    ('readonly', None, str.upper),
+    ('recordsize', None, None),
+    ('sparse', None, None),
+    ('volsize', None, None),
+    ('volblocksize', None, None),
+)
+
+
+class DatasetShareTypes(object):
+    """
+    Share type of filesystem datasets, the same way `notifier.get_dataset_share_type`
+    tells it from `.windows`/`.apple` files in their mountpoint.
+
+    Results are cached by mountpoint inode and mtime, creating or removing these
+    files updates the mtime so only changed mountpoints are looked at again.
+    """
+
+    def __init__(self, root='/mnt'):
+        self.root = root
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def get(self, names):
+        """
+        Returns share types (`UNIX`, `WINDOWS` or `MAC`) by dataset name.
+        """
+        rv = {}
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                with self.lock:
+                    self.cache.pop(name, None)
+                rv[name] = 'UNIX'
+                continue
+
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+            with self.lock:
+                cached = self.cache.get(name)
+            if cached is not None and cached[0] == key:
+                rv[name] = cached[1]
+                continue
+
+            if os.path.exists(f'{path}/.windows'):
+                share_type = 'WINDOWS'
+            elif os.path.exists(f'{path}/.apple'):
+                share_type = 'MAC'
+            else:
+                share_type = 'UNIX'
+            with self.lock:
+                self.cache[name] = (key, share_type)
+            rv[name] = share_type
+        return rv
+
+
 async def is_mounted(middleware, path):
     mounted = await middleware.run_in_thread(bsd.getmntinfo)
     return any(fs.dest == path for fs in mounted)
@@ -1643,7 +1721,10 @@ class PoolService(CRUDService):
 
     @private
     async def get_current_import_disk_job(self):
-        import_jobs = await self.middleware.call('core.get_jobs', [('method', '=', 'pool.import_disk')])
+        # Only jobs of this middlewared run, archived ones are not relevant anymore
+        import_jobs = [
+            job.__encode__() for job in self.middleware.jobs.all().values() if job.method_name == 'pool.import_disk'
+        ]
         not_dismissed_import_jobs = [job for job in import_jobs if job["id"] not in self.dismissed_import_disk_jobs]
         if not_dismissed_import_jobs:
             return not_dismissed_import_jobs[0]
@@ -1660,6 +1741,8 @@ class PoolDatasetService(CRUDService):
     class Config:
         namespace = 'pool.dataset'
 
+    share_types = DatasetShareTypes()
+
     @filterable
     def query(self, filters=None, options=None):
         # Otimization for cases in which they can be filtered at zfs.dataset.query
@@ -1676,45 +1759,31 @@ class PoolDatasetService(CRUDService):
         We need to transform the data zfs gives us to make it consistent/user-friendly,
         making it match whatever pool.dataset.{create,update} uses as input.
         """
+        filesystems = set()
+
+        def collect(dataset):
+            if dataset['type'] == 'FILESYSTEM':
+                filesystems.add(dataset['name'])
+            for child in dataset['children']:
+                collect(child)
+
+        for dataset in datasets:
+            collect(dataset)
+        # Datasets are listed as children of their parent as well, resolve each one once
+        share_types = self.share_types.get(filesystems)
+
         def transform(dataset):
-            for orig_name, new_name, method in (
-                ('org.freenas:description', 'comments', None),
-                ('org.freenas:quota_warning', 'quota_warning', None),
-                ('org.freenas:quota_critical', 'quota_critical', None),
-                ('org.freenas:refquota_warning', 'refquota_warning', None),
-                ('org.freenas:refquota_critical', 'refquota_critical', None),
-                ('dedup', 'deduplication', str.upper),
-                ('atime', None, str.upper),
-                ('casesensitivity', None, str.upper),
-                ('exec', None, str.upper),
-                ('sync', None, str.upper),
-                ('compression', None, str.upper),
-                ('compressratio', None, None),
-                ('origin', None, None),
-                ('quota', None, _null),
-                ('refquota', None, _null),
-                ('reservation', None, _null),
-                ('refreservation', None, _null),
-                ('copies', None, None),
-                ('snapdir', None, str.upper),
-                ('readonly', None, str.upper),
-                ('recordsize', None, None),
-                ('sparse', None, None),
-                ('volsize', None, None),
-                ('volblocksize', None, None),
-            ):
-                if orig_name not in dataset['properties']:
+            properties = dataset.pop('properties')
+            for orig_name, new_name, method in DATASET_PROPERTIES_TRANSFORM:
+                if orig_name not in properties:
                     continue
                 i = new_name or orig_name
-                dataset[i] = dataset['properties'][orig_name]
+                dataset[i] = properties[orig_name]
                 if method:
                     dataset[i]['value'] = method(dataset[i]['value'])
-            del dataset['properties']
 
             if dataset['type'] == 'FILESYSTEM':
-                dataset['share_type'] = self.middleware.call_sync(
-                    'notifier.get_dataset_share_type', dataset['name'],
-                ).upper()
+                dataset['share_type'] = share_types[dataset['name']]
             else:
                 dataset['share_type'] = None
 
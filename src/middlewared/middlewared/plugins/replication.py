@@ -1,22 +1,429 @@
 from middlewared.async_validators import resolve_hostname
 from middlewared.client import Client
+from middlewared.job import State
 from middlewared.schema import accepts, Bool, Dict, Int, Patch, Str
-from middlewared.service import private, CallError, CRUDService, ValidationErrors
+from middlewared.service import job, private, CallError, CRUDService, ValidationErrors
 from middlewared.utils import Popen
 from middlewared.validators import Range, Time
 
+import asyncio
 import base64
+from collections import defaultdict, OrderedDict
+import concurrent.futures
+import contextlib
 import errno
 import os
 import pickle
 import re
+import shlex
 import subprocess
+import tempfile
+import threading
 
-from datetime import time
+from datetime import datetime, time
+from time import monotonic, sleep
 
 
 REPLICATION_KEY = '/data/ssh/replication.pub'
+REPLICATION_PRIVATE_KEY = '/data/ssh/replication'
 REPL_RESULTFILE = '/tmp/.repl-result'
+# Control sockets of ssh master connections shared by replication tasks, `%C` is a hash of host, port and user
+REPLICATION_CONTROL_PATH = '/var/run/replication/%C'
+REPLICATION_CONTROL_PERSIST = 300
+REPLICATION_BUFSIZE = 1024 * 1024
+REPLICATION_PROGRESS_INTERVAL = 1
+# Weight of the last interval in the reported transfer rate
+REPLICATION_RATE_SMOOTHING = 0.3
+REPLICATION_BENCHMARK_SIZE = 64 * 1024 * 1024
+REPLICATION_ESTIMATE_WORKERS = 8
+
+SSH = '/usr/local/bin/ssh'
+ZFS = '/sbin/zfs'
+SSH_CIPHERS = {
+    'FAST': ['-c', 'arcfour256,arcfour128,blowfish-cbc,aes128-ctr,aes192-ctr,aes256-ctr'],
+    'DISABLED': ['-o', 'NoneEnabled=yes', '-o', 'NoneSwitch=yes'],
+    'STANDARD': [],
+}
+SSH_NONE_CIPHER_WARNING = 'WARNING: ENABLED NONE CIPHER'
+# Compress command run locally and decompress command run by the remote shell
+COMPRESSION = {
+    'PIGZ': (['/usr/local/bin/pigz'], 'pigz -d'),
+    'PLZIP': (['/usr/local/bin/plzip'], 'plzip -d'),
+    'LZ4': (['/usr/local/bin/lz4c'], 'lz4c -d'),
+}
+# Levels measured by `replication.compression_benchmark`
+COMPRESSION_LEVELS = {
+    'LZ4': [1, 9],
+    'PIGZ': [1, 6, 9],
+    'PLZIP': [0, 3, 6, 9],
+}
+SYSTEM_DATASET = re.compile(r'^[^/]+/\.system')
+
+results_lock = threading.Lock()
+masters_lock = threading.Lock()
+
+
+def time_between(now, begin, end):
+    if begin <= end:
+        return begin <= now <= end
+    return now >= begin or now <= end
+
+
+def remote_dataset(remotefs, dataset):
+    """
+    Name `dataset` is received as by `zfs receive -d remotefs`.
+    """
+    rest = dataset.partition('/')[2]
+    return f'{remotefs}/{rest}' if rest else remotefs
+
+
+def parse_snapshots(output, prefix=None, replace=None):
+    """
+    Parses `zfs list -H -p -t snapshot -o name,guid,createtxg` output into a dict of
+    dataset name to list of (snapshot name, guid, createtxg) ordered by createtxg.
+
+    Dataset names starting with `prefix` are renamed to start with `replace` instead.
+    """
+    rv = defaultdict(list)
+    for line in output.splitlines():
+        if not line.strip() or SYSTEM_DATASET.match(line):
+            continue
+        name, guid, createtxg = line.split('\t')
+        dataset, snapshot = name.split('@', 1)
+        if prefix is not None:
+            dataset = replace + dataset[len(prefix):]
+        rv[dataset].append((snapshot, guid, int(createtxg)))
+    return OrderedDict((dataset, sorted(snapshots, key=lambda s: s[2])) for dataset, snapshots in rv.items())
+
+
+def plan_replication(source, target, followdelete):
+    """
+    Returns replication steps bringing `target` snapshots to `source` ones (both as returned
+    by `parse_snapshots`, named after source datasets), deepest datasets first so that they are
+    remounted before their parents.
+
+    Every step is a dict with:
+      - `dataset`
+      - `destroy_snapshots`: target snapshots to destroy before sending, when target diverged
+      - `sends`: list of (from snapshot or None for a full stream, to snapshot), incremental
+        sends include intermediate snapshots
+      - `delete_snapshots`: stale target snapshots to destroy once sent, if `followdelete`
+      - `destroy`: dataset has to be destroyed on target
+
+    Snapshots are matched by guid so that renamed or recreated snapshots are not mistaken
+    for the same ones.
+    """
+    steps = []
+    for dataset, snapshots in source.items():
+        if not snapshots:
+            continue
+        step = {'dataset': dataset, 'destroy_snapshots': [], 'sends': [], 'delete_snapshots': [], 'destroy': False}
+        target_snapshots = target.get(dataset, [])
+        positions = {guid: i for i, (name, guid, createtxg) in enumerate(snapshots)}
+        common = None
+        for name, guid, createtxg in reversed(target_snapshots):
+            if guid in positions:
+                common = positions[guid]
+                break
+
+        if common is None:
+            # No common snapshot, nuke and repave
+            step['destroy_snapshots'] = [s[0] for s in target_snapshots]
+            step['sends'].append((None, snapshots[0][0]))
+            if len(snapshots) > 1:
+                step['sends'].append((snapshots[0][0], snapshots[-1][0]))
+        else:
+            if common < len(snapshots) - 1:
+                step['sends'].append((snapshots[common][0], snapshots[-1][0]))
+            if followdelete:
+                step['delete_snapshots'] = [s[0] for s in target_snapshots if s[1] not in positions]
+
+        if step['destroy_snapshots'] or step['sends'] or step['delete_snapshots']:
+            steps.append(step)
+
+    for dataset in target:
+        if dataset not in source:
+            steps.append({
+                'dataset': dataset, 'destroy_snapshots': [], 'sends': [], 'delete_snapshots': [], 'destroy': True,
+            })
+
+    return sorted(steps, key=lambda step: len(step['dataset'].split('/')), reverse=True)
+
+
+def compress_argv(compression, level):
+    if compression not in COMPRESSION:
+        return None
+    argv = list(COMPRESSION[compression][0])
+    if level is not None:
+        argv.append(f'-{level}')
+    return argv
+
+
+def recommend_compression(results, bandwidth):
+    """
+    Returns the `replication.compression_benchmark` result sending a stream the fastest
+    through a link of `bandwidth` KiB/s, limited either by the compressor throughput
+    or by the link carrying compressed data.
+    """
+    def effective(result):
+        rate = bandwidth * 1024 * result['ratio']
+        return rate if result['throughput'] is None else min(rate, result['throughput'])
+    return max(results, key=effective)
+
+
+def parse_send_size(output):
+    for line in reversed(output.splitlines()):
+        if line.startswith('size\t'):
+            return int(line.split('\t')[1])
+    return 0
+
+
+def estimate_sizes(commands):
+    """
+    Runs `zfs send -nP` `commands` in parallel, returns the estimated size of their streams.
+    """
+    def estimate(argv):
+        cp = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return parse_send_size(cp.stdout.decode('utf8', 'ignore'))
+
+    if not commands:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=REPLICATION_ESTIMATE_WORKERS) as executor:
+        return list(executor.map(estimate, commands))
+
+
+def send_argv(dataset, fromsnap, tosnap, properties, dry_run=False):
+    argv = [ZFS, 'send']
+    if dry_run:
+        argv.append('-nP')
+    # -p sends properties of the whole dataset which removes stale snapshots as well
+    if properties:
+        argv.append('-p')
+    if fromsnap is not None:
+        argv.extend(['-I', f'{dataset}@{fromsnap}'])
+    argv.append(f'{dataset}@{tosnap}')
+    return argv
+
+
+def pipe_stream(send, receive, compression, limit, callback):
+    """
+    Pipes `send` command output into `receive` command, compressed with `compression` command
+    if given and throttled to `limit` KiB/s if not zero, reporting every chunk size to `callback`.
+
+    Returns a tuple (success, output).
+    """
+    with tempfile.TemporaryFile() as send_output, tempfile.TemporaryFile() as receive_output:
+        recv = subprocess.Popen(
+            receive, stdin=subprocess.PIPE, stdout=receive_output, stderr=subprocess.STDOUT, close_fds=True,
+        )
+        compress = None
+        sink = recv.stdin
+        if compression:
+            compress = subprocess.Popen(compression, stdin=subprocess.PIPE, stdout=recv.stdin, close_fds=True)
+            recv.stdin.close()
+            sink = compress.stdin
+        proc = subprocess.Popen(send, stdout=subprocess.PIPE, stderr=send_output, close_fds=True)
+
+        sent = 0
+        start = monotonic()
+        try:
+            while True:
+                chunk = proc.stdout.read1(REPLICATION_BUFSIZE)
+                if not chunk:
+                    break
+                sink.write(chunk)
+                sent += len(chunk)
+                callback(len(chunk))
+                if limit:
+                    delay = sent / (limit * 1024) - (monotonic() - start)
+                    if delay > 0:
+                        sleep(delay)
+        except BrokenPipeError:
+            proc.kill()
+        finally:
+            proc.stdout.close()
+            try:
+                sink.close()
+            except BrokenPipeError:
+                pass
+
+        proc.wait()
+        if compress:
+            compress.wait()
+        recv.wait()
+
+        send_output.seek(0)
+        receive_output.seek(0)
+        output = '\n'.join(filter(None, [
+            send_output.read().decode('utf8', 'ignore').strip(),
+            receive_output.read().decode('utf8', 'ignore').replace(SSH_NONE_CIPHER_WARNING, '').strip(),
+        ]))
+
+    # When replicating to a target "container" dataset that doesn't exist on the sending
+    # side the target dataset will have to be readonly, however that will preclude
+    # creating mountpoints for the datasets that are sent.
+    return (proc.returncode == 0 and recv.returncode == 0) or 'failed to create mountpoint' in output, output
+
+
+class SSHConnection(object):
+    """
+    Runs commands on a replication remote, multiplexed over a persistent master connection.
+    """
+
+    def __init__(self, task):
+        self.args = [
+            SSH,
+            '-i', REPLICATION_PRIVATE_KEY,
+            '-o', 'BatchMode=yes',
+            '-o', 'StrictHostKeyChecking=yes',
+            # There's nothing magical about ConnectTimeout, it's an average
+            # of wiliam and josh's thoughts on a Wednesday morning.
+            # It will prevent hunging in the status of "Sending".
+            '-o', 'ConnectTimeout=7',
+            '-o', f'ControlPath={REPLICATION_CONTROL_PATH}',
+        ] + SSH_CIPHERS.get(task['remote_cipher'], [])
+        if task['remote_dedicateduser']:
+            self.args.extend(['-l', task['remote_dedicateduser']])
+        self.args.extend(['-p', str(task['remote_port'])])
+        self.hostname = task['remote_hostname']
+
+    def argv(self, command=None, options=None):
+        """
+        Returns ssh argv running shell `command` on the remote, ssh `options` go before the hostname.
+        """
+        return self.args + list(options or []) + [self.hostname] + ([command] if command else [])
+
+    def connect(self):
+        """
+        Starts a master connection, unless one is already running, which is kept
+        REPLICATION_CONTROL_PERSIST seconds after its last client exits.
+        """
+        with masters_lock:
+            check = subprocess.run(
+                self.argv(options=['-O', 'check']), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            if check.returncode == 0:
+                return
+
+            os.makedirs(os.path.dirname(REPLICATION_CONTROL_PATH), mode=0o700, exist_ok=True)
+            master = subprocess.run(
+                self.argv(options=['-M', '-f', '-N', '-o', f'ControlPersist={REPLICATION_CONTROL_PERSIST}']),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            )
+            if master.returncode != 0:
+                error = master.stderr.decode('utf8', 'ignore').replace(SSH_NONE_CIPHER_WARNING, '').strip()
+                raise CallError(f'Failed to connect to {self.hostname}: {error}')
+
+    def run(self, command):
+        """
+        Runs shell `command` on the remote, returns a tuple (returncode, stdout, stderr).
+        """
+        cp = subprocess.run(self.argv(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return (
+            cp.returncode,
+            cp.stdout.decode('utf8', 'ignore'),
+            cp.stderr.decode('utf8', 'ignore').replace(SSH_NONE_CIPHER_WARNING, '').strip(),
+        )
+
+
+class StreamLimiter(object):
+    """
+    Limits the number of replication streams running at once, granting them in FIFO order.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = []
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def stream(self, queued=None):
+        """
+        Holds a stream slot. `queued` is called with the position in the queue while
+        waiting for it and with None once granted.
+        """
+        token = object()
+        position = None
+        with self.cond:
+            self.waiting.append(token)
+            try:
+                while self.waiting[0] is not token or self.running >= self.limit:
+                    if queued and self.waiting.index(token) + 1 != position:
+                        position = self.waiting.index(token) + 1
+                        queued(position)
+                    self.cond.wait()
+            except BaseException:
+                self.waiting.remove(token)
+                self.cond.notify_all()
+                raise
+            self.waiting.pop(0)
+            self.running += 1
+            # Next waiter might be granted a slot as well
+            self.cond.notify_all()
+
+        try:
+            if queued and position is not None:
+                queued(None)
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {'limit': self.limit, 'running': self.running, 'queued': len(self.waiting)}
+
+
+class ReplicationProgress(object):
+    """
+    Reports replication job progress along with transfer rate (bytes/s), ETA (seconds)
+    and position in the stream queue.
+    """
+
+    def __init__(self, job, total):
+        self.job = job
+        self.total = total
+        self.sent = 0
+        self.rate = None
+        self.queue = None
+        self.description = None
+        self.checkpoint = (monotonic(), 0)
+        self.reported = 0
+
+    def describe(self, description):
+        self.description = description
+        self.report()
+
+    def queued(self, position):
+        self.queue = position
+        # Time spent waiting for a stream does not count for the rate
+        self.checkpoint = (monotonic(), self.sent)
+        self.report()
+
+    def __call__(self, size):
+        self.sent += size
+        now = monotonic()
+        if now - self.reported >= REPLICATION_PROGRESS_INTERVAL:
+            since, sent = self.checkpoint
+            if now > since:
+                rate = (self.sent - sent) / (now - since)
+                self.rate = rate if self.rate is None else self.rate + REPLICATION_RATE_SMOOTHING * (rate - self.rate)
+            self.checkpoint = (now, self.sent)
+            self.report()
+
+    def report(self):
+        self.reported = monotonic()
+        # Estimates are not exact, do not report 100% before the end
+        percent = min(int(self.sent * 100 / self.total), 99) if self.total else 0
+        self.job.set_progress(percent, self.description, {
+            'sent': self.sent,
+            'total': self.total,
+            'rate': int(self.rate) if self.rate is not None else None,
+            'eta': int(max(self.total - self.sent, 0) / self.rate) if self.rate else None,
+            'queue': self.queue,
+        })
 
 
 class ReplicationService(CRUDService):
@@ -26,6 +433,10 @@ class ReplicationService(CRUDService):
         datastore_prefix = 'repl_'
         datastore_extend = 'replication.replication_extend'
 
+    def __init__(self, *args, **kwargs):
+        super(ReplicationService, self).__init__(*args, **kwargs)
+        self.streams = StreamLimiter(self.middleware.replication_streams)
+
     @private
     async def replication_extend(self, data):
 
@@ -49,17 +460,16 @@ class ReplicationService(CRUDService):
             except Exception:
                 data['lastresult'] = {'msg': None}
 
-        progressfile = f'/tmp/.repl_progress_{data["id"]}'
-        if os.path.exists(progressfile):
-            with open(progressfile, 'r') as f:
-                pid = int(f.read())
-            title = await self.middleware.call('notifier.get_proc_title', pid)
-            if title:
-                reg = re.search(r'sending (\S+) \((\d+)%', title)
-                if reg:
-                    data['status'] = f'Sending {reg.groups()[0]}s {reg.groups()[1]}s'
-                else:
-                    data['status'] = 'Sending'
+        running = self.__running_jobs().get(data['id'])
+        if running is not None:
+            progress = running.progress
+            extra = progress['extra'] or {}
+            if extra.get('queue'):
+                data['status'] = f'Waiting for a replication stream ({extra["queue"]} in queue)'
+            elif progress['description']:
+                data['status'] = f'{progress["description"]} ({progress["percent"] or 0}%)'
+            else:
+                data['status'] = 'Sending'
 
         if 'status' not in data:
             data['status'] = data['lastresult'].get('msg')
@@ -150,6 +560,7 @@ class ReplicationService(CRUDService):
             Int('remote_port', default=22, required=True),
             Str('begin', validators=[Time()]),
             Str('compression', enum=['OFF', 'LZ4', 'PIGZ', 'PLZIP']),
+            Int('compression_level', null=True, validators=[Range(min=0, max=9)]),
             Str('end', validators=[Time()]),
             Str('filesystem', required=True),
             Str('remote_cipher', enum=['STANDARD', 'FAST', 'DISABLED']),
@@ -306,11 +717,288 @@ class ReplicationService(CRUDService):
             except Exception as e:
                 self.logger.debug('Failed to remove replication from state file %s', e)
 
-        progressfile = '/tmp/.repl_progress_%d' % id
+    def __running_jobs(self):
+        return {
+            job.args[0]: job
+            for job in self.middleware.jobs.all().values()
+            if job.method_name == 'replication.run' and job.state == State.RUNNING
+        }
+
+    @private
+    def running(self):
+        """
+        Whether any replication task is running.
+        """
+        return bool(self.__running_jobs())
+
+    @private
+    def write_result(self, id, result):
+        with results_lock:
+            try:
+                with open(REPL_RESULTFILE, 'rb') as f:
+                    results = pickle.loads(f.read())
+            except Exception:
+                results = {}
+            results.setdefault(id, {}).update(result)
+            with open(REPL_RESULTFILE, 'wb') as f:
+                f.write(pickle.dumps(results))
+
+    @private
+    @job(lock='replication_run_all', lock_queue_size=1)
+    async def run_all(self, job):
+        """
+        Run enabled replication tasks whose time window includes current time concurrently,
+        their streams being limited by `replication_streams` middleware option.
+        """
+        now = datetime.now().replace(second=0, microsecond=0)
+        if datetime.now().second >= 30 and now.minute < 59:
+            now = now.replace(minute=now.minute + 1)
+        now = now.time()
+
+        tasks = [
+            task for task in await self.middleware.call('replication.query', [('enabled', '=', True)])
+            if time_between(now, *[time(*[int(v) for v in task[k].split(':')]) for k in ('begin', 'end')])
+        ]
+        finished = []
+
+        async def run(task):
+            run_job = await self.middleware.call('replication.run', task['id'])
+            await run_job.wait()
+            finished.append(task['id'])
+            job.set_progress(
+                int(len(finished) * 100 / len(tasks)), f'{len(finished)} of {len(tasks)} replication tasks finished',
+                {'tasks': len(tasks), 'finished': len(finished), 'streams': self.streams.stats()},
+            )
+
+        await asyncio.gather(*[run(task) for task in tasks])
+
+    @private
+    @job(lock=lambda args: f'replication_{args[0]}')
+    def run(self, job, id):
+        """
+        Replicate snapshots of task `id` to its remote.
+        """
+        task = self.middleware.call_sync('replication.query', [('id', '=', id)], {'get': True})
         try:
-            os.unlink(progressfile)
-        except Exception:
-            pass
+            result = self.__replicate(job, task)
+        except CallError as e:
+            self.write_result(id, {'msg': e.errmsg})
+            raise
+        self.write_result(id, result)
+        if result['msg'] != 'Succeeded' and result['msg'] != 'Up to date':
+            raise CallError(result['msg'])
+
+    def __notify(self, task, subject, text, interval):
+        self.middleware.call_sync('mail.send', {
+            'subject': f'{subject} ({task["remote_hostname"]})',
+            'text': f'Hello,\n    {text}',
+            'interval': interval,
+            'channel': 'autorepl',
+        })
+
+    def __plan(self, task, ssh):
+        """
+        Returns a tuple (remote datasets, receive resume tokens, steps) of `task` replication.
+        """
+        localfs = task['filesystem']
+        remotefs_final = remote_dataset(task['zfs'], localfs)
+        depth = [] if task['userepl'] else ['-d', '1']
+
+        cp = subprocess.run(
+            [ZFS, 'list', '-H', '-p', '-t', 'snapshot', '-o', 'name,guid,createtxg', '-r'] + depth + [localfs],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        if cp.returncode != 0:
+            raise CallError(f'Could not list snapshots of {localfs}: {cp.stderr.decode("utf8", "ignore").strip()}')
+        source = parse_snapshots(cp.stdout.decode('utf8', 'ignore'))
+
+        returncode, output, error = ssh.run(
+            f'{ZFS} list -H -o name,readonly -t filesystem,volume -r {shlex.quote(remotefs_final.split("/")[0])}'
+        )
+        if returncode != 0:
+            raise CallError(f'Could not list datasets of {remotefs_final.split("/")[0]} on remote: {error}')
+        remote_datasets = dict(line.split('\t') for line in output.splitlines() if line)
+
+        resume = []
+        if remotefs_final in remote_datasets:
+            returncode, output, error = ssh.run(
+                f'{ZFS} get -H -p -o name,value -t filesystem,volume -r receive_resume_token '
+                f'{shlex.quote(remotefs_final)}'
+            )
+            for line in output.splitlines():
+                name, token = line.split('\t')
+                if token != '-':
+                    resume.append({'dataset': name, 'token': token})
+
+        returncode, output, error = ssh.run(
+            f'{ZFS} list -H -p -t snapshot -o name,guid,createtxg -r {" ".join(depth)} {shlex.quote(remotefs_final)}'
+        )
+        if returncode != 0 and remotefs_final in remote_datasets:
+            raise CallError(f'Failed: {error}')
+        target = parse_snapshots(output, remotefs_final, localfs)
+
+        return remote_datasets, resume, plan_replication(source, target, task['followdelete'])
+
+    def __estimate(self, task, resume, steps):
+        """
+        Adds estimated stream `size` to `resume` tokens and to `steps` sends, which become
+        dicts with `from`, `to` and `size` keys.
+        """
+        commands = [[ZFS, 'send', '-nP', '-t', item['token']] for item in resume]
+        for step in steps:
+            for fromsnap, tosnap in step['sends']:
+                commands.append(send_argv(step['dataset'], fromsnap, tosnap, task['followdelete'], dry_run=True))
+        sizes = iter(estimate_sizes(commands))
+
+        resume = [dict(item, size=next(sizes)) for item in resume]
+        steps = [
+            dict(step, sends=[
+                {'from': fromsnap, 'to': tosnap, 'size': next(sizes)} for fromsnap, tosnap in step['sends']
+            ])
+            for step in steps
+        ]
+        return resume, steps
+
+    def __replicate(self, job, task):
+        localfs = task['filesystem']
+        remotefs = task['zfs']
+        remotefs_final = remote_dataset(remotefs, localfs)
+
+        ssh = SSHConnection(task)
+        try:
+            ssh.connect()
+        except CallError as e:
+            self.__notify(task, 'Replication failed!', f'Replication of local ZFS {localfs} to remote ZFS '
+                          f'{remotefs_final} failed.  The remote system is not responding.', 86400)
+            self.logger.warning('%s', e.errmsg)
+            raise CallError('Remote system not responding.')
+
+        job.set_progress(0, 'Listing snapshots')
+        remote_datasets, resume, steps = self.__plan(task, ssh)
+        if not steps and not resume:
+            return {'msg': 'Up to date'}
+
+        # Parents of the destination have to exist for `zfs receive -d`
+        parts = remotefs_final.split('/')
+        for i in range(2, len(parts)):
+            parent = '/'.join(parts[:i])
+            if parent not in remote_datasets:
+                returncode, output, error = ssh.run(f'{ZFS} create -o readonly=on {shlex.quote(parent)}')
+                if returncode != 0:
+                    self.logger.debug('Unable to create remote dataset %s: %s', parent, error)
+
+        if not self.middleware.call_sync('system.is_freenas'):
+            # Bi-directional replication: the remote side indicates that they are
+            # willing to receive snapshots by setting readonly to 'on', which prevents
+            # local writes.
+            if any(
+                readonly != 'on' for name, readonly in remote_datasets.items()
+                if name == remotefs_final or name.startswith(f'{remotefs_final}/')
+            ):
+                self.__notify(task, 'Replication denied!', f'The remote system have denied our replication from '
+                              f'local ZFS {localfs} to remote ZFS {remotefs_final}.  Please change the '
+                              f"'readonly' property of {remotefs_final} as well as its children to 'on' to allow "
+                              'receiving replication.', 86400)
+                raise CallError('Remote destination must be set readonly')
+
+        # Remote filesystem is the root dataset
+        # Make sure it has no .system dataset over there because zfs receive will try to
+        # remove it and fail (because its mounted and being used)
+        if '/' not in remotefs_final:
+            returncode, output, error = ssh.run(f'mount | grep ^{shlex.quote(remotefs_final)}/.system')
+            if output.strip():
+                raise CallError('Please move system dataset of remote side to another pool')
+
+        receive = ssh.argv(' '.join(filter(None, [
+            f'{COMPRESSION[task["compression"]][1]} |' if task['compression'] in COMPRESSION else None,
+            f'{ZFS} receive -s -F -d {shlex.quote(remotefs)}',
+        ])))
+        compression = compress_argv(task['compression'], task['compression_level'])
+
+        self.write_result(task['id'], {'msg': 'Running'})
+
+        job.set_progress(0, 'Estimating streams size')
+        resume, steps = self.__estimate(task, resume, steps)
+        progress = ReplicationProgress(
+            job, sum(item['size'] for item in resume) + sum(send['size'] for step in steps for send in step['sends']),
+        )
+
+        for item in resume:
+            progress.describe(f'Resuming {item["dataset"]}')
+            with self.streams.stream(progress.queued):
+                success, output = pipe_stream(
+                    [ZFS, 'send', '-t', item['token']], receive, compression, task['limit'], progress,
+                )
+            if not success:
+                # Source snapshots might be gone, discard the partial state and send again
+                self.logger.warning('Failed to resume receive on %s: %s', item['dataset'], output)
+                ssh.run(f'{ZFS} receive -A {shlex.quote(item["dataset"])}')
+        if resume:
+            # Snapshots received, the plan is out of date
+            remote_datasets, resume, steps = self.__plan(task, ssh)
+            resume, steps = self.__estimate(task, [], steps)
+            progress.total = progress.sent + sum(send['size'] for step in steps for send in step['sends'])
+
+        result = {'msg': 'Succeeded'}
+        destroyed = None
+        for step in steps:
+            dataset = step['dataset']
+            target_dataset = remotefs_final + dataset[len(localfs):]
+
+            if step['destroy']:
+                if destroyed and target_dataset.startswith(f'{destroyed}/'):
+                    continue
+                returncode, output, error = ssh.run(f'{ZFS} destroy -r {shlex.quote(target_dataset)}')
+                if returncode != 0:
+                    self.logger.warning('Unable to destroy dataset %s on remote system: %s', target_dataset, error)
+                else:
+                    destroyed = target_dataset
+                continue
+
+            failed = []
+            for snapshot in step['destroy_snapshots']:
+                returncode, output, error = ssh.run(f'{ZFS} destroy {shlex.quote(f"{target_dataset}@{snapshot}")}')
+                if returncode != 0:
+                    self.logger.warning('Unable to destroy snapshot %s@%s on remote system: %s',
+                                        target_dataset, snapshot, error)
+                    failed.append(f'{target_dataset}@{snapshot}')
+            if failed:
+                self.__notify(task, 'Replication failed!', f'The replication failed for the local ZFS {localfs} '
+                              'because the remote system has diverged snapshots with us and we were unable to '
+                              f'remove them, including: {", ".join(failed)}', 7200)
+                result['msg'] = f'Unable to destroy remote snapshot: {", ".join(failed)}'
+                continue
+
+            for send in step['sends']:
+                fromsnap, tosnap = send['from'], send['to']
+                progress.describe(f'Sending {dataset}@{tosnap}')
+                with self.streams.stream(progress.queued):
+                    success, output = pipe_stream(
+                        send_argv(dataset, fromsnap, tosnap, task['followdelete']), receive, compression,
+                        task['limit'], progress,
+                    )
+                self.logger.debug('Replication of %s@%s result: %s', dataset, tosnap, output)
+                if not success:
+                    if fromsnap is None:
+                        self.__notify(task, f'Replication failed when sending {dataset}@{tosnap}',
+                                      f'The replication failed for the local ZFS {dataset} while attempting to '
+                                      f'send snapshot {tosnap} to {task["remote_hostname"]}:\n{output}', 7200)
+                        result['msg'] = f'Failed: {dataset} ({tosnap})'
+                    else:
+                        self.__notify(task, f'Replication failed at {dataset}@{fromsnap} -> {tosnap}',
+                                      f'The replication failed for the local ZFS {dataset} while attempting to '
+                                      f'apply incremental send of snapshot {fromsnap} -> {tosnap} to '
+                                      f'{task["remote_hostname"]}:\n{output}', 7200)
+                        result['msg'] = f'Failed: {dataset} ({fromsnap}->{tosnap})'
+                    break
+                result['last_snapshot'] = tosnap
+            else:
+                for snapshot in step['delete_snapshots']:
+                    ssh.run(f'{ZFS} destroy -d {shlex.quote(f"{target_dataset}@{snapshot}")}')
+
+        progress.sent = progress.total
+        progress.describe(result['msg'])
+        return result
 
     @accepts()
     def public_key(self):
@@ -324,6 +1012,92 @@ class ReplicationService(CRUDService):
             key = None
         return key
 
+    @accepts(
+        Str('snapshot', required=True),
+        Int('size', default=REPLICATION_BENCHMARK_SIZE, validators=[Range(min=1)]),
+        Int('bandwidth', default=0, validators=[Range(min=0)]),
+    )
+    @job(lock='replication_compression_benchmark')
+    def compression_benchmark(self, job, snapshot, size, bandwidth):
+        """
+        Measure throughput (bytes/s) and ratio of every replication stream compression and
+        level on the first `size` bytes of `snapshot` stream.
+
+        If the `bandwidth` (KiB/s) of the replication link is given, the compression sending
+        the stream the fastest through it is recommended.
+        """
+        with tempfile.TemporaryFile() as sample:
+            job.set_progress(0, f'Reading {snapshot} stream')
+            proc = subprocess.Popen([ZFS, 'send', snapshot], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            read = 0
+            while read < size:
+                chunk = proc.stdout.read1(min(REPLICATION_BUFSIZE, size - read))
+                if not chunk:
+                    break
+                sample.write(chunk)
+                read += len(chunk)
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+            if not read:
+                raise CallError(f'Unable to send {snapshot}')
+
+            results = [{'compression': 'OFF', 'level': None, 'throughput': None, 'ratio': 1.0}]
+            candidates = [(compression, level) for compression, levels in COMPRESSION_LEVELS.items() for level in levels]
+            for i, (compression, level) in enumerate(candidates):
+                job.set_progress(int(i * 100 / len(candidates)), f'Measuring {compression} level {level}')
+                sample.seek(0)
+                with tempfile.TemporaryFile() as output:
+                    start = monotonic()
+                    cp = subprocess.run(
+                        compress_argv(compression, level), stdin=sample, stdout=output, stderr=subprocess.DEVNULL,
+                    )
+                    elapsed = monotonic() - start
+                    compressed = os.fstat(output.fileno()).st_size
+                if cp.returncode != 0:
+                    self.logger.debug('Compression %s level %d failed', compression, level)
+                    continue
+                results.append({
+                    'compression': compression,
+                    'level': level,
+                    'throughput': int(read / elapsed) if elapsed else None,
+                    'ratio': round(read / max(compressed, 1), 2),
+                })
+
+        job.set_progress(100, 'Compressions measured')
+        return {
+            'size': read,
+            'results': results,
+            'recommended': recommend_compression(results, bandwidth) if bandwidth else None,
+        }
+
+    @accepts(Int('id'))
+    def plan(self, id):
+        """
+        Dry run of replication task `id`, nothing is changed on either side.
+
+        Returns the steps replication would take for every dataset with estimated size
+        (bytes) of each stream, interrupted receives that would be resumed and the
+        estimated `size` of the whole run.
+        """
+        task = self.middleware.call_sync('replication.query', [('id', '=', id)], {'get': True})
+        ssh = SSHConnection(task)
+        ssh.connect()
+        remote_datasets, resume, steps = self.__plan(task, ssh)
+        resume, steps = self.__estimate(task, resume, steps)
+
+        remotefs_final = remote_dataset(task['zfs'], task['filesystem'])
+        return {
+            'id': id,
+            'resume': [{'dataset': item['dataset'], 'size': item['size']} for item in resume],
+            'steps': [
+                dict(step, target=remotefs_final + step['dataset'][len(task['filesystem']):]) for step in steps
+            ],
+            'size': sum(item['size'] for item in resume) + sum(
+                send['size'] for step in steps for send in step['sends']
+            ),
+        }
+
     @accepts(
         Str('host', required=True),
         Int('port', required=True),
@@ -183,6 +183,7 @@ class SharingSMBService(CRUDService):
         datastore = 'sharing.cifs_share'
         datastore_prefix = 'cifs_'
         datastore_extend = 'sharing.smb.extend'
+        datastore_raw_fields = ['name', 'path']
 
     @accepts(Dict(
         'sharingsmb_create',
@@ -1,9 +1,165 @@
-from datetime import time
+import asyncio
+from collections import defaultdict, OrderedDict
+import contextlib
+from datetime import datetime, time, timedelta
+import fcntl
+import heapq
+import os
+import re
 
 from middlewared.schema import accepts, Bool, Dict, Int, List, Patch, Str
-from middlewared.service import CRUDService, private, ValidationErrors
+from middlewared.service import CallError, CRUDService, job, private, ValidationErrors
 from middlewared.validators import Range, Time
 
+AUTOSNAP_NAME = re.compile(
+    r'^auto-(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})\.(?P<hour>\d{2})(?P<minute>\d{2})-'
+    r'(?P<retcount>\d+)(?P<retunit>[hdwmy])$'
+)
+MNTPT = '/mnt'
+# Snapshots created or destroyed by anything else than the scheduler show up in its index after this long
+SNAPSHOT_INDEX_MAX_AGE = timedelta(hours=1)
+
+
+def retention_policy(task):
+    return f'{task["ret_count"]}{task["ret_unit"][0]}'
+
+
+def parse_autosnap(name):
+    """
+    Returns (dataset, creation time, retention policy) of automatic snapshot `name`
+    or None if it is not one.
+    """
+    dataset, sep, snapname = name.partition('@')
+    match = AUTOSNAP_NAME.match(snapname)
+    if not sep or match is None:
+        return None
+    created = datetime(*[int(match.group(i)) for i in ('year', 'month', 'day', 'hour', 'minute')])
+    return dataset, created, f'{match.group("retcount")}{match.group("retunit")}'
+
+
+def snapshot_expiration(created, policy):
+    count, unit = int(policy[:-1]), policy[-1]
+    if unit == 'h':
+        return created + timedelta(hours=count)
+    elif unit == 'd':
+        return created + timedelta(days=count)
+    elif unit == 'w':
+        return created + timedelta(days=7 * count)
+    elif unit == 'm':
+        return created + timedelta(days=int(30.436875 * count))
+    elif unit == 'y':
+        return created + timedelta(days=int(365.2425 * count))
+    return created
+
+
+def task_matches_time(task, snaptime):
+    curtime = time(snaptime.hour, snaptime.minute)
+    if task['begin'] <= task['end']:
+        # e.g. from 9:00 to 18:00, 18:00 to 18:00 meaning exactly at 18:00
+        if not task['begin'] <= curtime <= task['end']:
+            return False
+    elif not (curtime >= task['begin'] or curtime <= task['end']):
+        # e.g. from 18:00 to 9:00
+        return False
+
+    if task['repeat_unit'] == 'daily':
+        return True
+    if task['repeat_unit'] == 'weekly':
+        return str(snaptime.isoweekday()) in task['byweekday'].split(',')
+    return False
+
+
+def task_covers(task, dataset):
+    return dataset == task['filesystem'] or (task['recursive'] and dataset.startswith(task['filesystem'] + '/'))
+
+
+class SnapshotIndex(object):
+    """
+    Automatic snapshots ordered by expiration, along with the latest one
+    of every dataset and retention policy.
+    """
+
+    def __init__(self, names=None):
+        self.expirations = []
+        self.latest = {}
+        for name in names or []:
+            self.add(name)
+
+    def add(self, name):
+        parsed = parse_autosnap(name)
+        if parsed is None:
+            return
+        dataset, created, policy = parsed
+        heapq.heappush(self.expirations, (snapshot_expiration(created, policy), name))
+        if self.latest.get((dataset, policy), created) <= created:
+            self.latest[(dataset, policy)] = created
+
+    def last_snapshot(self, dataset, policy, snaptime):
+        """
+        Creation time of the latest snapshot of `dataset` with retention `policy`
+        not yet expired at `snaptime`, if any.
+        """
+        created = self.latest.get((dataset, policy))
+        if created is not None and snapshot_expiration(created, policy) > snaptime:
+            return created
+
+    def pop_expired(self, snaptime):
+        rv = []
+        while self.expirations and self.expirations[0][0] <= snaptime:
+            rv.append(heapq.heappop(self.expirations)[1])
+        return rv
+
+
+def plan_snapshots(tasks, snaptime, index):
+    """
+    Returns snapshots to be taken by `tasks` due at `snaptime`
+    as a list of [filesystem, retention policy, recursive].
+    """
+    due = OrderedDict()
+    for task in tasks:
+        due.setdefault((task['filesystem'], retention_policy(task), task['recursive']), []).append(task)
+
+    for key, key_tasks in list(due.items()):
+        last = index.last_snapshot(key[0], key[1], snaptime)
+        if last is not None and all(last + timedelta(minutes=t['interval']) > snaptime for t in key_tasks):
+            del due[key]
+
+    # A recursive snapshot of an ancestor already takes the snapshot with the same name,
+    # taking it again would fail
+    recursive = [key for key in due if key[2]]
+    return [
+        list(key) for key in due
+        if key[2] or not any((key[0] + '/').startswith(r[0] + '/') and key[1] == r[1] for r in recursive)
+    ]
+
+
+def prune_snapshots(names, tasks):
+    """
+    Returns expired snapshots among `names` to be destroyed, i.e. taken for a filesystem
+    of `tasks`. Snapshots destroyed recursively along with an ancestor are left out.
+    """
+    covered = {name for name in names if any(task_covers(task, name.split('@', 1)[0]) for task in tasks)}
+    rv = []
+    for name in sorted(covered):
+        dataset, snapname = name.split('@', 1)
+        parts = dataset.split('/')
+        if not any(f'{"/".join(parts[:i])}@{snapname}' in covered for i in range(1, len(parts))):
+            rv.append(name)
+    return rv
+
+
+@contextlib.contextmanager
+def mount_lock():
+    """
+    Lock serializing tasks which need direct access to mountpoints, shared with legacy tools.
+    """
+    fd = os.open(MNTPT, os.O_DIRECTORY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
 
 class PeriodicSnapshotTaskService(CRUDService):
 
@@ -13,6 +169,11 @@ class PeriodicSnapshotTaskService(CRUDService):
         datastore_extend = 'pool.snapshottask.periodic_snapshot_extend'
         namespace = 'pool.snapshottask'
 
+    index = None
+    index_built = None
+    index_tasks = None
+    running = None
+
     @private
     def periodic_snapshot_extend(self, data):
         data['begin'] = str(data['begin'])
@@ -81,8 +242,6 @@ class PeriodicSnapshotTaskService(CRUDService):
             {'prefix': self._config.datastore_prefix}
         )
 
-        await self.middleware.call('service.restart', 'cron')
-
         return await self._get_instance(data['id'])
 
     @accepts(
@@ -115,8 +274,6 @@ class PeriodicSnapshotTaskService(CRUDService):
             {'prefix': self._config.datastore_prefix}
         )
 
-        await self.middleware.call('service.restart', 'cron')
-
         return await self._get_instance(id)
 
     @accepts(
@@ -129,6 +286,168 @@ class PeriodicSnapshotTaskService(CRUDService):
             id
         )
 
-        await self.middleware.call('service.restart', 'cron')
-
         return response
+
+    @private
+    async def tick(self, snaptime):
+        """
+        Start a run taking snapshots of tasks due at `snaptime` and destroying expired ones.
+        """
+        if self.running is not None and self.running.time_finished is None:
+            self.logger.debug('Previous periodic snapshot run still in progress, skipping')
+            return
+
+        tasks = await self.middleware.call(
+            'datastore.query', self._config.datastore, [('enabled', '=', True)],
+            {'prefix': self._config.datastore_prefix},
+        )
+
+        if not tasks:
+            self.index = self.index_tasks = None
+        elif self.index is None or tasks != self.index_tasks or snaptime - self.index_built >= SNAPSHOT_INDEX_MAX_AGE:
+            await self.build_index(tasks, snaptime)
+
+        pools = {pool['name'] for pool in await self.middleware.call('zfs.pool.query')}
+        due = []
+        for task in tasks:
+            if task_matches_time(task, snaptime):
+                if task['filesystem'].split('/')[0] not in pools:
+                    self.logger.warn(f'Volume {task["filesystem"].split("/")[0]} not imported, '
+                                     f'skipping snapshot task #{task["id"]}')
+                    continue
+                due.append(task)
+
+        snapshots = plan_snapshots(due, snaptime, self.index) if due else []
+        expired = prune_snapshots(self.index.pop_expired(snaptime), tasks) if self.index else []
+
+        # Replication used to be started by each periodic snapshot run (autosnap.py)
+        # which ran weekly when there were no periodic snapshot tasks
+        replicate = bool(tasks) or (snaptime.isoweekday() == 6 and (snaptime.hour, snaptime.minute) == (4, 15))
+        if replicate:
+            replicate = bool(await self.middleware.call('datastore.query', 'storage.replication', [], {'count': True}))
+
+        if snapshots or expired:
+            self.running = await self.middleware.call(
+                'pool.snapshottask.run', snaptime.strftime('%Y%m%d.%H%M'), snapshots, expired, replicate,
+            )
+        elif replicate:
+            await self.replicate()
+
+    @private
+    async def build_index(self, tasks, snaptime):
+        snapshots = await self.middleware.call(
+            'zfs.snapshot.query', [('pool', 'in', list({task['filesystem'].split('/')[0] for task in tasks}))],
+            {'extra': {'properties': []}, 'select': ['name']},
+        )
+        # Snapshots of descendants of non recursive tasks filesystems are indexed as well,
+        # `prune_snapshots` only destroys the ones a task covers
+        covering = [dict(task, recursive=True) for task in tasks]
+        self.index = SnapshotIndex(
+            snapshot['name'] for snapshot in snapshots
+            if any(task_covers(task, snapshot['name'].split('@', 1)[0]) for task in covering)
+        )
+        self.index_built = snaptime
+        self.index_tasks = tasks
+
+    @private
+    @job(lock='periodic_snapshot')
+    def run(self, job, snaptime, snapshots, expired, replicate):
+        """
+        Take `snapshots` ([filesystem, retention policy, recursive]) named after `snaptime`,
+        destroy `expired` snapshots and start replication if `replicate`.
+        """
+        plain = defaultdict(list)
+        for i, (filesystem, policy, recursive) in enumerate(snapshots):
+            name = f'{filesystem}@auto-{snaptime}-{policy}'
+            # Snapshots of datasets used as VMware datastores are taken along with VM snapshots
+            context = self.middleware.call_sync('vmware.snapshot_begin', name, recursive)
+            if context is None:
+                plain[recursive].append(name)
+                continue
+            try:
+                self.__create([name], recursive, {'freenas:vmsynced': 'Y'} if context['vmsynced'] else {})
+            finally:
+                self.middleware.call_sync('vmware.snapshot_end', context)
+            job.set_progress(int(i / len(snapshots) * 50), f'Took snapshot {name}')
+
+        for recursive, names in plain.items():
+            self.__create(names, recursive, {})
+        job.set_progress(50, 'Snapshots taken')
+
+        if expired:
+            if self.middleware.call_sync('replication.running'):
+                self.logger.debug('Replication running, skip destroying snapshots')
+                for name in expired:
+                    self.index.add(name)
+            else:
+                existing = [
+                    snapshot['name'] for snapshot in self.middleware.call_sync(
+                        'zfs.snapshot.query', [('id', 'in', expired)], {'extra': {'properties': []}, 'select': ['name']},
+                    )
+                ]
+                if existing:
+                    with mount_lock():
+                        # Destruction of snapshots with clones is deferred
+                        destroy_job = self.middleware.call_sync('zfs.snapshot.destroy_many', {
+                            'snapshots': existing,
+                            'recursive': True,
+                            'defer': True,
+                        })
+                        destroy_job.wait_sync()
+                    if destroy_job.error:
+                        self.logger.error('Failed to destroy snapshots: %s', destroy_job.error)
+        job.set_progress(100, 'Expired snapshots destroyed')
+
+        if replicate:
+            self.middleware.call_sync('pool.snapshottask.replicate')
+
+    def __create(self, names, recursive, properties):
+        try:
+            with mount_lock():
+                self.middleware.call_sync('zfs.snapshot.create_many', {
+                    'snapshots': names,
+                    'recursive': recursive,
+                    'properties': properties,
+                })
+        except CallError as e:
+            if len(names) > 1:
+                # Snapshots are taken atomically, find out which ones fail
+                for name in names:
+                    self.__create([name], recursive, properties)
+                return
+            self.logger.error('Failed to create snapshot %r: %s', names[0], e)
+            self.middleware.call_sync('mail.send', {
+                'subject': f'Snapshot failed! ({names[0]})',
+                'text': f'Hello,\n    Snapshot {names[0]} failed with the following error: {e}',
+                'interval': 3600,
+                'channel': 'autosnap',
+            })
+            return
+
+        for name in names:
+            self.index.add(name)
+
+    @private
+    async def replicate(self):
+        await self.middleware.call('replication.run_all')
+
+
+async def _scheduler(middleware):
+    while True:
+        now = datetime.now()
+        await asyncio.sleep(60 - now.second - now.microsecond / 1000000)
+
+        # Rounded to the nearest minute
+        now = datetime.now()
+        snaptime = now.replace(second=0, microsecond=0)
+        if now.second >= 30:
+            snaptime += timedelta(minutes=1)
+
+        try:
+            await middleware.call('pool.snapshottask.tick', snaptime)
+        except Exception:
+            middleware.logger.error('Failed to run periodic snapshot tasks', exc_info=True)
+
+
+def setup(middleware):
+    asyncio.ensure_future(_scheduler(middleware))
@@ -2,9 +2,10 @@ from datetime import datetime, date
 from middlewared.event import EventSource
 from middlewared.schema import accepts, Bool, Dict, Int, IPAddr, Str
 from middlewared.service import ConfigService, no_auth_required, job, private, Service, ValidationErrors
-from middlewared.utils import Popen, start_daemon_thread, sw_buildtime, sw_version
+from middlewared.utils import Popen, sw_buildtime, sw_version
 from middlewared.validators import Range
 
+import asyncio
 import csv
 import os
 import psutil
@@ -773,12 +774,11 @@ class SystemHealthEventSource(EventSource):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._check_update = None
-        start_daemon_thread(target=self.check_update)
 
-    def check_update(self):
-        while not self._cancel.is_set():
-            self._check_update = self.middleware.call_sync('update.check_available')['status']
-            self._cancel.wait(timeout=60 * 60 * 24)
+    async def check_update(self):
+        while True:
+            self._check_update = (await self.middleware.call('update.check_available'))['status']
+            await asyncio.sleep(60 * 60 * 24)
 
     def pools_statuses(self):
         return {
@@ -786,7 +786,7 @@ class SystemHealthEventSource(EventSource):
             for p in self.middleware.call_sync('pool.query')
         }
 
-    def run(self):
+    async def run(self):
 
         try:
             if self.arg:
@@ -803,28 +803,32 @@ class SystemHealthEventSource(EventSource):
         cp_time = sysctl.filter('kern.cp_time')[0].value
         cp_old = cp_time
 
-        while not self._cancel.is_set():
-            time.sleep(delay)
+        check_update = asyncio.ensure_future(self.check_update())
+        try:
+            while True:
+                await asyncio.sleep(delay)
 
-            cp_time = sysctl.filter('kern.cp_time')[0].value
-            cp_diff = list(map(lambda x: x[0] - x[1], zip(cp_time, cp_old)))
-            cp_old = cp_time
+                cp_time = sysctl.filter('kern.cp_time')[0].value
+                cp_diff = list(map(lambda x: x[0] - x[1], zip(cp_time, cp_old)))
+                cp_old = cp_time
 
-            cpu_percent = round((sum(cp_diff[:3]) / sum(cp_diff)) * 100, 2)
+                cpu_percent = round((sum(cp_diff[:3]) / sum(cp_diff)) * 100, 2)
 
-            pools = self.middleware.call_sync(
-                'cache.get_or_put',
-                CACHE_POOLS_STATUSES,
-                1800,
-                self.pools_statuses,
-            )
+                pools = await self.middleware.call(
+                    'cache.get_or_put',
+                    CACHE_POOLS_STATUSES,
+                    1800,
+                    self.pools_statuses,
+                )
 
-            self.send_event('ADDED', fields={
-                'cpu_percent': cpu_percent,
-                'memory': psutil.virtual_memory()._asdict(),
-                'pools': pools,
-                'update': self._check_update,
-            })
+                self.send_event('ADDED', fields={
+                    'cpu_percent': cpu_percent,
+                    'memory': psutil.virtual_memory()._asdict(),
+                    'pools': pools,
+                    'update': self._check_update,
+                })
+        finally:
+            check_update.cancel()
 
 
 def setup(middleware):
@@ -1,13 +1,13 @@
 from middlewared.event import EventSource
+from middlewared.utils import run as run_command
 
+import asyncio
 import json
-import subprocess
-import time
 
 
 class TrueViewStatusEventSource(EventSource):
 
-    def run(self):
+    async def run(self):
 
         try:
             if self.arg:
@@ -21,17 +21,15 @@ class TrueViewStatusEventSource(EventSource):
         if delay < 5:
             return
 
-        while not self._cancel.is_set():
-            cp = subprocess.run(
-                ['trueview_stats.sh'], stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
+        while True:
+            cp = await run_command(['trueview_stats.sh'], check=False)
             try:
                 data = json.loads(cp.stdout)
             except ValueError:
                 pass
             else:
                 self.send_event('ADDED', fields=data)
-            time.sleep(delay)
+            await asyncio.sleep(delay)
 
 
 def setup(middleware):
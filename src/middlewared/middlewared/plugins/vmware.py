@@ -1,14 +1,69 @@
+from datetime import datetime
 import errno
+import pickle
 import socket
 import ssl
+import uuid
+
+from lockfile import LockFile
 
 from middlewared.async_validators import resolve_hostname
 from middlewared.schema import accepts, Dict, Int, Str, Patch
 from middlewared.service import CallError, CRUDService, private, ValidationErrors
 
-from pyVim import connect
+from pyVim import connect, task as VimTask
 from pyVmomi import vim, vmodl
 
+VMWARE_FAILS = '/var/tmp/.vmwaresnap_fails'
+VMWARELOGIN_FAILS = '/var/tmp/.vmwarelogin_fails'
+VMWARESNAPDELETE_FAILS = '/var/tmp/.vmwaresnapdelete_fails'
+
+
+def vm_depends_on_datastore(vm, datastore):
+    # VM config data is on the datastore
+    for i in vm.datastore:
+        if i.info.name.startswith(datastore):
+            return True
+    # VM has disks ("diskDescriptor" and "diskExtent" files) on the datastore
+    for device in vm.config.hardware.device:
+        if device.backing is None:
+            continue
+        if hasattr(device.backing, 'fileName'):
+            if device.backing.datastore.info.name == datastore:
+                return True
+    return False
+
+
+def vm_can_snapshot(vm):
+    # PCI pass-through devices prevent snapshots, see
+    # https://kb.vmware.com/selfservice/microsites/search.do?language=en_US&cmd=displayKC&externalId=1006392
+    for device in vm.config.hardware.device:
+        if isinstance(device, vim.VirtualPCIPassthrough):
+            return False
+    return True
+
+
+def vm_find_snapshot(vm, name):
+    tree = vm.snapshot.rootSnapshotList if vm.snapshot else []
+    while tree:
+        if tree[0].name == name:
+            return tree[0].snapshot
+        tree = tree[0].childSnapshotList
+    return None
+
+
+def update_fails_file(path, key, value):
+    try:
+        with LockFile(path):
+            with open(path, 'rb') as f:
+                fails = pickle.load(f)
+    except Exception:
+        fails = {}
+    fails[key] = value
+    with LockFile(path):
+        with open(path, 'wb') as f:
+            pickle.dump(fails, f)
+
 
 class VMWareService(CRUDService):
 
@@ -231,3 +286,147 @@ class VMWareService(CRUDService):
             }
             vms[vm.config.uuid] = data
         return vms
+
+    def __connect(self, item):
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.verify_mode = ssl.CERT_NONE
+        return connect.SmartConnect(
+            host=item['hostname'],
+            user=item['username'],
+            pwd=item['password'],
+            sslContext=ssl_context,
+        )
+
+    @private
+    def snapshot_begin(self, snapshot, recursive):
+        """
+        Take VMware snapshots of powered on VMs using datastores backed by the dataset of
+        ZFS `snapshot` (or its descendants if `recursive`), right before it is taken.
+
+        Returns a context for `vmware.snapshot_end`, None if no VMware host uses the dataset.
+        """
+        dataset = snapshot.split('@', 1)[0]
+        items = [
+            item for item in self.middleware.call_sync('vmware.query')
+            if item['filesystem'] == dataset or (recursive and item['filesystem'].startswith(dataset + '/'))
+        ]
+        if not items:
+            return None
+
+        context = {
+            'snapshot': snapshot,
+            # Unique name which (hopefully) won't collide with anything on the VMware side
+            'vmsnapname': str(uuid.uuid4()),
+            'hosts': [],
+        }
+        description = f'{str(datetime.now()).split(".")[0]} FreeNAS Created Snapshot'
+
+        login_fails = {}
+        for item in items:
+            host = {'item': item, 'vms': [], 'fails': [], 'skips': []}
+            context['hosts'].append(host)
+            try:
+                si = self.__connect(item)
+                content = si.RetrieveContent()
+            except Exception as e:
+                self.logger.warn('VMware login failed to %s', item['hostname'], exc_info=True)
+                login_fails[item['id']] = getattr(e, 'msg', str(e))
+                continue
+
+            vm_view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+            for vm in vm_view.view:
+                # There's no point to even consider VMs that are paused or powered off
+                if vm.summary.runtime.powerState != 'poweredOn':
+                    continue
+                try:
+                    if not vm_depends_on_datastore(vm, item['datastore']):
+                        continue
+                except Exception:
+                    self.logger.debug('Failed to check datastores of VM %s', vm.name, exc_info=True)
+                    continue
+
+                try:
+                    if vm_can_snapshot(vm):
+                        # A VM using two datasets of the same ZFS volume may have been snapshotted already
+                        if vm_find_snapshot(vm, context['vmsnapname']) is None:
+                            VimTask.WaitForTask(vm.CreateSnapshot_Task(
+                                name=context['vmsnapname'],
+                                description=description,
+                                memory=False, quiesce=False,
+                            ))
+                    else:
+                        self.logger.info(
+                            'Can\'t snapshot VM %s that depends on datastore %s and filesystem %s. '
+                            'Possibly using PT devices. Skipping.', vm.name, item['datastore'], dataset,
+                        )
+                        host['skips'].append(vm.config.uuid)
+                except Exception as e:
+                    self.logger.warn('Snapshot of VM %s failed', vm.name, exc_info=True)
+                    host['fails'].append((vm.config.uuid, vm.name, str(e)))
+                host['vms'].append(vm.config.uuid)
+            connect.Disconnect(si)
+
+        try:
+            with LockFile(VMWARELOGIN_FAILS):
+                with open(VMWARELOGIN_FAILS, 'wb') as f:
+                    pickle.dump(login_fails, f)
+        except Exception:
+            self.logger.debug('Failed to write vmware login fails file', exc_info=True)
+
+        for host in context['hosts']:
+            if host['fails']:
+                fails = [f'{i[1]}: {i[2]}' for i in host['fails']]
+                update_fails_file(VMWARE_FAILS, snapshot, fails)
+                self.middleware.call_sync('mail.send', {
+                    'subject': f'VMware Snapshot failed! ({snapshot})',
+                    'text': f'Hello,\n    The following VM failed to snapshot {snapshot}:\n' + '    \n'.join(fails),
+                    'channel': 'snapvmware',
+                })
+
+        # ZFS snapshot holds consistent VM snapshots only if every host had VMs snapshotted without failures
+        context['vmsynced'] = all(host['vms'] and not host['fails'] for host in context['hosts'])
+        return context
+
+    @private
+    def snapshot_end(self, context):
+        """
+        Delete VMware snapshots taken by `vmware.snapshot_begin` once the ZFS snapshot is taken.
+        """
+        delete_fails = []
+        for host in context['hosts']:
+            item = host['item']
+            try:
+                si = self.__connect(item)
+            except Exception:
+                # FIXME: alert, this leaves dangling VMware snapshots
+                self.logger.warn('VMware login failed to %s', item['hostname'])
+                continue
+
+            failed = {i[0] for i in host['fails']}
+            for vm_uuid in host['vms']:
+                if vm_uuid in failed or vm_uuid in host['skips']:
+                    continue
+                vm = si.content.searchIndex.FindByUuid(None, vm_uuid, True)
+                if not vm:
+                    self.logger.debug('Could not find VM %s', vm_uuid)
+                    continue
+                try:
+                    snap = vm_find_snapshot(vm, context['vmsnapname'])
+                    if snap is not None:
+                        VimTask.WaitForTask(snap.RemoveSnapshot_Task(True))
+                except Exception:
+                    self.logger.debug('Failed to remove snapshot %s of VM %s', context['vmsnapname'], vm.name,
+                                      exc_info=True)
+                    delete_fails.append(vm.name)
+
+            if delete_fails:
+                update_fails_file(VMWARESNAPDELETE_FAILS, context['snapshot'], delete_fails)
+                self.middleware.call_sync('mail.send', {
+                    'subject': f'VMware Snapshot deletion failed! ({context["snapshot"]})',
+                    'text': (
+                        f'Hello,\n    The following VM snapshot(s) failed to delete {context["snapshot"]}:\n' +
+                        '    \n'.join(delete_fails)
+                    ),
+                    'channel': 'snapvmware',
+                })
+            connect.Disconnect(si)
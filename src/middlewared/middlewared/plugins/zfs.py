@@ -1,8 +1,11 @@
+import asyncio
+import contextlib
 import errno
+import pickle
 import subprocess
 import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from bsd import geom
 import libzfs
@@ -11,9 +14,24 @@ from middlewared.schema import Dict, List, Str, Bool, Int, accepts
 from middlewared.service import (
     CallError, CRUDService, ValidationError, ValidationErrors, filterable, job,
 )
-from middlewared.utils import filter_list, start_daemon_thread
-
-SCAN_THREADS = {}
+from middlewared.utils import filter_list, IndexedList, start_daemon_thread
+from middlewared.utils.zfs_handle import invalidate_zfs_handles, zfs_handle
+
+# Scrub/resilver progress polling interval bounds (seconds), see `ScanMonitor`
+SCAN_INTERVAL_MIN = 1
+SCAN_INTERVAL_MAX = 30
+# Minimum progress (percent) reported by a `zfs.pool.scan` event
+SCAN_EVENT_STEP = 0.1
+# Maximum number of snapshots kept in the inventory, least recently queried datasets are evicted first
+INVENTORY_SNAPSHOTS_MAX = 100000
+# History events which can change datasets other than `history_dsname`
+INVENTORY_POOL_HISTORY_EVENTS = ('rename', 'promote', 'clone swap', 'receive', 'finish receiving')
+# History events changing properties inherited by descendants of `history_dsname`
+INVENTORY_RECURSIVE_HISTORY_EVENTS = ('set', 'inherit')
+# Pool namespace changes done outside of middlewared, libzfs handles are reopened after them
+ZFS_HANDLES_INVALIDATING_EVENTS = ('misc.fs.zfs.pool_create', 'misc.fs.zfs.pool_destroy', 'misc.fs.zfs.pool_import')
+# Maximum number of snapshots of a dataset destroyed by a single `zfs destroy`
+SNAPSHOT_DESTROY_BATCH = 500
 
 
 def convert_topology(zfs, vdevs):
@@ -61,6 +79,372 @@ def find_vdev(pool, vname):
         children += list(child.children)
 
 
+def snapshot_state(snapshot, properties, holds):
+    if properties is None and holds:
+        return snapshot.__getstate__()
+
+    dataset, snapshot_name = snapshot.name.split('@', 1)
+    state = {
+        'id': snapshot.name,
+        'name': snapshot.name,
+        'pool': dataset.split('/', 1)[0],
+        'type': 'SNAPSHOT',
+        'dataset': dataset,
+        'snapshot_name': snapshot_name,
+        'properties': {},
+    }
+    all_properties = snapshot.properties
+    for k in (all_properties.keys() if properties is None else properties):
+        prop = all_properties.get(k)
+        if prop is not None:
+            state['properties'][k] = prop.__getstate__()
+    if holds:
+        state['holds'] = snapshot.holds
+    return state
+
+
+def snapshot_scope(filters):
+    """
+    Returns a tuple (names, datasets, pools, prefixes) of snapshot names, datasets and pools
+    snapshots matching `filters` must belong to (None for any) and of prefixes their names must start with.
+    """
+    names = None
+    prefixes = []
+    datasets = None
+    pools = None
+    for f in filters:
+        if not isinstance(f, (list, tuple)) or len(f) != 3:
+            continue
+        name, op, value = f
+        if op == 'in' and isinstance(value, (list, tuple)):
+            values = set(value)
+        elif op == '=':
+            values = {value}
+        elif op == '^' and name in ('id', 'name') and isinstance(value, str):
+            prefixes.append(value)
+            continue
+        else:
+            continue
+        if not all(isinstance(v, str) for v in values):
+            continue
+        if name in ('id', 'name'):
+            names = values if names is None else names & values
+        elif name == 'dataset':
+            datasets = values if datasets is None else datasets & values
+        elif name == 'pool':
+            pools = values if pools is None else pools & values
+    return names, datasets, pools, prefixes
+
+
+def own_snapshots_match(name, prefixes):
+    # Whether snapshots of dataset `name` can match every name prefix
+    for prefix in prefixes:
+        if '@' in prefix:
+            if name != prefix.split('@', 1)[0]:
+                return False
+        elif not name.startswith(prefix):
+            return False
+    return True
+
+
+def children_snapshots_match(name, prefixes):
+    # Whether snapshots of any descendant of dataset `name` can match every name prefix
+    child = name + '/'
+    for prefix in prefixes:
+        if '@' in prefix:
+            if not prefix.split('@', 1)[0].startswith(child):
+                return False
+        elif not (prefix.startswith(child) or child.startswith(prefix)):
+            return False
+    return True
+
+
+def detach(result):
+    """
+    Copies a query result built from inventory entries so the caller can modify it.
+    Items of a list are copied separately, a dataset and its parent never share their state.
+    """
+    if isinstance(result, list):
+        return [detach(i) for i in result]
+    if isinstance(result, dict):
+        return pickle.loads(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+    return result
+
+
+class ZFSInventory(object):
+    """
+    In-memory inventory of pools, datasets and snapshots backing `zfs.*.query`.
+
+    Each part is loaded on first use, afterwards only invalidated entries are
+    reloaded. `devd.zfs` events and `zfs.*` methods invalidate what they change
+    while `reconcile` periodically reloads everything which is loaded, catching
+    changes no event is sent for (e.g. space accounting). Nothing is reloaded
+    if the inventory has not been read since the previous reconcile.
+
+    Returned entries are shared and must not be modified, see `detach`.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.pools = None
+        # Datasets states without children, by name
+        self.datasets = None
+        # Names of children datasets, by dataset name
+        self.children = {}
+        # Datasets to be reloaded (and whether along with their descendants)
+        self.dirty = {}
+        # IndexedList of datasets states with nested children, built from `datasets`
+        self.views = None
+        self.snapshots = OrderedDict()
+        self.snapshots_count = 0
+        # Invalidations happening while reconciling, applied to the reconciled inventory
+        self.replay = None
+        # Whether the inventory has been read since the last reconcile
+        self.read = False
+
+    def _record(self, method, *args):
+        if self.replay is not None:
+            self.replay.append((method, args))
+
+    def invalidate_pools(self):
+        with self.lock:
+            self._record('invalidate_pools')
+            self.pools = None
+            self.views = None
+
+    def invalidate_pool(self, name):
+        """
+        Invalidates pool `name` along with all of its datasets and snapshots.
+        """
+        with self.lock:
+            self.invalidate_pools()
+            self.invalidate_dataset(name, recursive=True)
+
+    def invalidate_dataset(self, name, recursive=False):
+        """
+        Invalidates dataset `name` and its snapshots, along with its descendants if `recursive`.
+        A snapshot name invalidates snapshots of its dataset.
+        """
+        with self.lock:
+            self._record('invalidate_dataset', name, recursive)
+            if '@' in name:
+                name = name.split('@', 1)[0]
+                recursive = False
+            for dataset in list(self.snapshots):
+                if dataset == name or (recursive and dataset.startswith(name + '/')):
+                    self._forget_snapshots(dataset)
+            self.dirty[name] = self.dirty.get(name, False) or recursive
+
+    def handle_event(self, data):
+        pool = data.get('pool_name')
+        if data.get('type') == 'misc.fs.zfs.history_event':
+            name = data.get('history_dsname')
+            internal_name = data.get('history_internal_name')
+            if name and internal_name not in INVENTORY_POOL_HISTORY_EVENTS:
+                self.invalidate_dataset(name, recursive=internal_name in INVENTORY_RECURSIVE_HISTORY_EVENTS)
+                return
+        elif data.get('type') not in (
+            'misc.fs.zfs.pool_create', 'misc.fs.zfs.pool_destroy', 'misc.fs.zfs.pool_import',
+        ):
+            # Pool state changes, e.g. vdev state or scan
+            pool = None
+
+        if pool:
+            self.invalidate_pool(pool)
+        else:
+            self.invalidate_pools()
+
+    def get_pools(self):
+        with self.lock:
+            self.read = True
+            if self.pools is None:
+                with zfs_handle() as zfs:
+                    self.pools = IndexedList([i.__getstate__() for i in zfs.pools], ['id', 'name'])
+                self.views = None
+            return self.pools
+
+    def get_datasets(self):
+        with self.lock:
+            pools = self.get_pools()
+            if self.datasets is None or self.dirty or self.views is None:
+                with zfs_handle() as zfs:
+                    self._load_datasets(zfs, [i['name'] for i in pools])
+            return self.views
+
+    def get_snapshots(self, datasets, properties, holds):
+        """
+        Yields snapshots states of `datasets` having at least `properties` and holds if `holds`.
+        """
+        with contextlib.ExitStack() as stack:
+            zfs = None
+            for name in datasets:
+                with self.lock:
+                    self.read = True
+                    entry = self.snapshots.get(name)
+                    if entry is None or not properties <= entry['properties'] or (holds and not entry['holds']):
+                        if entry is not None:
+                            properties = properties | entry['properties']
+                            holds = holds or entry['holds']
+                        if zfs is None:
+                            zfs = stack.enter_context(zfs_handle())
+                        entry = self._load_snapshots(zfs, name, properties, holds)
+                    else:
+                        self.snapshots.move_to_end(name)
+                yield from entry['snapshots']
+
+    def reconcile(self):
+        """
+        Reloads everything which is currently loaded, without blocking readers meanwhile.
+        Returns `False` if the inventory has not been read since the last reconcile.
+        """
+        with self.lock:
+            if self.replay is not None:
+                return True
+            if not self.read:
+                return False
+            self.read = False
+            load_pools = self.pools is not None
+            load_datasets = self.datasets is not None
+            snapshots = [(name, e['properties'], e['holds']) for name, e in self.snapshots.items()]
+            self.replay = []
+
+        fresh = ZFSInventory()
+        try:
+            if load_datasets:
+                fresh.get_datasets()
+            elif load_pools:
+                fresh.get_pools()
+            for name, properties, holds in snapshots:
+                for i in fresh.get_snapshots([name], properties, holds):
+                    pass
+        except Exception:
+            with self.lock:
+                self.replay = None
+                self.read = True
+            raise
+
+        with self.lock:
+            replay, self.replay = self.replay, None
+            self.pools = fresh.pools
+            self.datasets = fresh.datasets
+            self.children = fresh.children
+            self.dirty = {}
+            self.views = fresh.views
+            self.snapshots = fresh.snapshots
+            self.snapshots_count = fresh.snapshots_count
+            for method, args in replay:
+                getattr(self, method)(*args)
+        return True
+
+    def _load_datasets(self, zfs, roots):
+        if self.datasets is None:
+            self.datasets = {}
+            self.children = {}
+            self.dirty = {}
+            for pool in zfs.pools:
+                self._walk(pool.root_dataset)
+        else:
+            dirty, self.dirty = self.dirty, {}
+            walked = []
+            # Parents first so descendants walked along with them are not reloaded again
+            for name in sorted(dirty, key=lambda i: i.count('/')):
+                if not any(name == i or name.startswith(i + '/') for i in walked):
+                    subtree = self._reload_dataset(zfs, name, dirty[name])
+                    if subtree is not None:
+                        walked.append(subtree)
+
+            for name in [i for i in self.datasets if '/' not in i and i not in roots]:
+                self._forget(name)
+            for name in roots:
+                if name not in self.datasets:
+                    self._reload_dataset(zfs, name, True)
+
+        views = []
+
+        def build(name):
+            view = dict(self.datasets[name])
+            index = len(views)
+            views.append(None)
+            view['children'] = [build(i) for i in self.children[name]]
+            views[index] = view
+            return view
+
+        for name in roots:
+            if name in self.datasets:
+                build(name)
+        self.views = IndexedList(views, ['id', 'name', 'pool'])
+
+    def _walk(self, dataset):
+        children = list(dataset.children)
+        self.datasets[dataset.name] = dataset.__getstate__(recursive=False)
+        self.children[dataset.name] = [i.name for i in children]
+        for child in children:
+            self._walk(child)
+
+    def _reload_dataset(self, zfs, name, recursive):
+        """
+        Reloads dataset `name`, returns the name of the dataset whose whole subtree was walked, if any.
+        """
+        parent = name.rsplit('/', 1)[0] if '/' in name else None
+        if parent is not None and parent not in self.datasets:
+            return self._reload_dataset(zfs, parent, True)
+
+        try:
+            dataset = zfs.get_dataset(name)
+        except libzfs.ZFSException:
+            self._forget(name)
+            if parent is not None:
+                self.children[parent] = [i for i in self.children[parent] if i != name]
+            return name
+
+        if recursive or name not in self.datasets:
+            self._forget(name)
+            self._walk(dataset)
+            walked = name
+        else:
+            children = list(dataset.children)
+            self.datasets[name] = dataset.__getstate__(recursive=False)
+            for gone in set(self.children[name]) - {i.name for i in children}:
+                self._forget(gone)
+            self.children[name] = [i.name for i in children]
+            for child in children:
+                if child.name not in self.datasets:
+                    self._walk(child)
+            walked = None
+
+        if parent is not None and name not in self.children[parent]:
+            self.children[parent] = self.children[parent] + [name]
+        return walked
+
+    def _forget(self, name):
+        prefix = name + '/'
+        for i in [i for i in self.datasets if i == name or i.startswith(prefix)]:
+            del self.datasets[i]
+            self.children.pop(i, None)
+        for i in [i for i in self.snapshots if i == name or i.startswith(prefix)]:
+            self._forget_snapshots(i)
+
+    def _load_snapshots(self, zfs, name, properties, holds):
+        try:
+            snapshots = [snapshot_state(i, properties, holds) for i in zfs.get_dataset(name).snapshots]
+        except libzfs.ZFSException:
+            snapshots = []
+        self._forget_snapshots(name)
+        entry = self.snapshots[name] = {'properties': properties, 'holds': holds, 'snapshots': snapshots}
+        self.snapshots_count += len(snapshots)
+        while self.snapshots_count > INVENTORY_SNAPSHOTS_MAX and len(self.snapshots) > 1:
+            self._forget_snapshots(next(iter(self.snapshots)))
+        return entry
+
+    def _forget_snapshots(self, name):
+        entry = self.snapshots.pop(name, None)
+        if entry is not None:
+            self.snapshots_count -= len(entry['snapshots'])
+
+
+INVENTORY = ZFSInventory()
+
+
 class ZFSPoolService(CRUDService):
 
     class Config:
@@ -69,16 +453,7 @@ class ZFSPoolService(CRUDService):
 
     @filterable
     def query(self, filters, options):
-        with libzfs.ZFS() as zfs:
-            # Handle `id` filter specially to avoiding getting all pool
-            if filters and len(filters) == 1 and list(filters[0][:2]) == ['id', '=']:
-                try:
-                    pools = [zfs.get(filters[0][2]).__getstate__()]
-                except libzfs.ZFSException:
-                    pools = []
-            else:
-                pools = [i.__getstate__() for i in zfs.pools]
-        return filter_list(pools, filters, options)
+        return detach(filter_list(INVENTORY.get_pools(), filters, options))
 
     @accepts(
         Dict(
@@ -97,9 +472,11 @@ class ZFSPoolService(CRUDService):
         ),
     )
     def do_create(self, data):
-        with libzfs.ZFS() as zfs:
+        with zfs_handle() as zfs:
             topology = convert_topology(zfs, data['vdevs'])
             zfs.create(data['name'], topology, data['options'], data['fsoptions'])
+        invalidate_zfs_handles()
+        INVENTORY.invalidate_pool(data['name'])
 
         return self.middleware.call_sync('zfs.pool._get_instance', data['name'])
 
@@ -109,16 +486,19 @@ class ZFSPoolService(CRUDService):
     ))
     def do_delete(self, name, options):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 zfs.destroy(name, force=options['force'])
+            invalidate_zfs_handles()
+            INVENTORY.invalidate_pool(name)
         except libzfs.ZFSException as e:
             raise CallError(str(e))
 
     @accepts(Str('pool', required=True))
     def upgrade(self, pool):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 zfs.get(pool).upgrade()
+            INVENTORY.invalidate_pools()
         except libzfs.ZFSException as e:
             raise CallError(str(e))
 
@@ -128,17 +508,19 @@ class ZFSPoolService(CRUDService):
     ))
     def export(self, name, options):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 # FIXME: force not yet implemented
                 pool = zfs.get(name)
                 zfs.export_pool(pool)
+            invalidate_zfs_handles()
+            INVENTORY.invalidate_pool(name)
         except libzfs.ZFSException as e:
             raise CallError(str(e))
 
     @accepts(Str('pool'))
     def get_devices(self, name):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 return [i.replace('/dev/', '') for i in zfs.get(name).disks]
         except libzfs.ZFSException as e:
             raise CallError(str(e), errno.ENOENT)
@@ -187,7 +569,7 @@ class ZFSPoolService(CRUDService):
             raise CallError('New or existing vdevs must be provided', errno.EINVAL)
 
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 pool = zfs.get(name)
 
                 if new:
@@ -205,18 +587,20 @@ class ZFSPoolService(CRUDService):
                     newvdev = libzfs.ZFSVdev(zfs, i['type'].lower())
                     newvdev.path = i['path']
                     i['target'].attach(newvdev)
+            INVENTORY.invalidate_pools()
 
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
 
     def __zfs_vdev_operation(self, name, label, op):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 pool = zfs.get(name)
                 target = find_vdev(pool, label)
                 if target is None:
                     raise CallError(f'Failed to find vdev for {label}', errno.EINVAL)
                 op(target)
+            INVENTORY.invalidate_pools()
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
 
@@ -254,7 +638,7 @@ class ZFSPoolService(CRUDService):
         Replace device `label` with `dev` in pool `name`.
         """
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 pool = zfs.get(name)
                 target = find_vdev(pool, label)
                 if target is None:
@@ -263,6 +647,7 @@ class ZFSPoolService(CRUDService):
                 newvdev = libzfs.ZFSVdev(zfs, 'disk')
                 newvdev.path = f'/dev/{dev}'
                 target.replace(newvdev)
+            INVENTORY.invalidate_pools()
         except libzfs.ZFSException as e:
             raise CallError(str(e), e.code)
 
@@ -277,13 +662,14 @@ class ZFSPoolService(CRUDService):
         """
         if action != 'PAUSE':
             try:
-                with libzfs.ZFS() as zfs:
+                with zfs_handle() as zfs:
                     pool = zfs.get(name)
 
                     if action == 'START':
                         pool.start_scrub()
                     else:
                         pool.stop_scrub()
+                INVENTORY.invalidate_pools()
             except libzfs.ZFSException as e:
                 raise CallError(str(e), e.code)
         else:
@@ -296,37 +682,33 @@ class ZFSPoolService(CRUDService):
             if proc.returncode != 0:
                 raise CallError('Unable to pause scrubbing')
 
-        def watch():
-            while True:
-                with libzfs.ZFS() as zfs:
-                    scrub = zfs.get(name).scrub.__getstate__()
+        def update(scrub):
+            if scrub is None:
+                return True
 
-                if scrub['pause']:
-                    job.set_progress(100, 'Scrub paused')
-                    break
+            if scrub['pause']:
+                job.set_progress(100, 'Scrub paused')
+                return True
 
-                if scrub['function'] != 'SCRUB':
-                    break
+            if scrub['function'] != 'SCRUB':
+                return True
 
-                if scrub['state'] == 'FINISHED':
-                    job.set_progress(100, 'Scrub finished')
-                    break
+            if scrub['state'] == 'FINISHED':
+                job.set_progress(100, 'Scrub finished')
+                return True
 
-                if scrub['state'] == 'CANCELED':
-                    break
+            if scrub['state'] == 'CANCELED':
+                return True
 
-                if scrub['state'] == 'SCANNING':
-                    job.set_progress(scrub['percentage'], 'Scrubbing')
-                time.sleep(1)
+            if scrub['state'] == 'SCANNING':
+                job.set_progress(scrub['percentage'], 'Scrubbing')
 
         if action == 'START':
-            t = threading.Thread(target=watch, daemon=True)
-            t.start()
-            t.join()
+            SCAN_MONITOR.wait(name, update)
 
     @accepts()
     def find_import(self):
-        with libzfs.ZFS() as zfs:
+        with zfs_handle() as zfs:
             return [i.__getstate__() for i in zfs.find_import()]
 
     @accepts(
@@ -336,7 +718,7 @@ class ZFSPoolService(CRUDService):
     )
     def import_pool(self, name_or_guid, options, any_host):
         found = False
-        with libzfs.ZFS() as zfs:
+        with zfs_handle() as zfs:
             for pool in zfs.find_import():
                 if pool.name == name_or_guid or str(pool.guid) == name_or_guid:
                     found = pool
@@ -346,6 +728,8 @@ class ZFSPoolService(CRUDService):
                 raise CallError(f'Pool {name_or_guid} not found.')
 
             zfs.import_pool(found, found.name, options, any_host=any_host)
+        invalidate_zfs_handles()
+        INVENTORY.invalidate_pool(found.name)
 
 
 class ZFSDatasetService(CRUDService):
@@ -356,16 +740,7 @@ class ZFSDatasetService(CRUDService):
 
     @filterable
     def query(self, filters=None, options=None):
-        with libzfs.ZFS() as zfs:
-            # Handle `id` filter specially to avoiding getting all datasets
-            if filters and len(filters) == 1 and list(filters[0][:2]) == ['id', '=']:
-                try:
-                    datasets = [zfs.get_dataset(filters[0][2]).__getstate__()]
-                except libzfs.ZFSException:
-                    datasets = []
-            else:
-                datasets = [i.__getstate__() for i in zfs.datasets]
-        return filter_list(datasets, filters, options)
+        return detach(filter_list(INVENTORY.get_datasets(), filters, options))
 
     @accepts(Dict(
         'dataset_create',
@@ -398,9 +773,10 @@ class ZFSDatasetService(CRUDService):
             params[k] = v
 
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 pool = zfs.get(data['name'].split('/')[0])
                 pool.create(data['name'], params, fstype=getattr(libzfs.DatasetType, data['type']), sparse_vol=sparse)
+            INVENTORY.invalidate_dataset(data['name'])
         except libzfs.ZFSException as e:
             self.logger.error('Failed to create dataset', exc_info=True)
             raise CallError(f'Failed to create dataset: {e}')
@@ -417,7 +793,7 @@ class ZFSDatasetService(CRUDService):
     )
     def do_update(self, id, data):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 dataset = zfs.get_dataset(id)
 
                 if 'properties' in data:
@@ -452,13 +828,15 @@ class ZFSDatasetService(CRUDService):
                                 prop = libzfs.ZFSUserProperty(v['value'])
                                 dataset.properties[k] = prop
 
+            # Inherited values of descendants may have changed as well
+            INVENTORY.invalidate_dataset(id, recursive=True)
         except libzfs.ZFSException as e:
             self.logger.error('Failed to update dataset', exc_info=True)
             raise CallError(f'Failed to update dataset: {e}')
 
     def do_delete(self, id, recursive=False):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 ds = zfs.get_dataset(id)
 
                 if ds.type == libzfs.DatasetType.FILESYSTEM:
@@ -469,24 +847,28 @@ class ZFSDatasetService(CRUDService):
                         dependent.delete()
 
                 ds.delete()
+            # Dependents (e.g. clones) may live anywhere in the pool
+            INVENTORY.invalidate_dataset(id.split('/')[0] if recursive else id, recursive=True)
         except libzfs.ZFSException as e:
             self.logger.error('Failed to delete dataset', exc_info=True)
             raise CallError(f'Failed to delete dataset: {e}')
 
     def mount(self, name):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 dataset = zfs.get_dataset(name)
                 dataset.mount()
+            INVENTORY.invalidate_dataset(name)
         except libzfs.ZFSException as e:
             self.logger.error('Failed to mount dataset', exc_info=True)
             raise CallError(f'Failed to mount dataset: {e}')
 
     def promote(self, name):
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 dataset = zfs.get_dataset(name)
                 dataset.promote()
+            INVENTORY.invalidate_dataset(name.split('/')[0], recursive=True)
         except libzfs.ZFSException as e:
             self.logger.error('Failed to promote dataset', exc_info=True)
             raise CallError(f'Failed to promote dataset: {e}')
@@ -499,10 +881,108 @@ class ZFSSnapshot(CRUDService):
 
     @filterable
     def query(self, filters=None, options=None):
-        with libzfs.ZFS() as zfs:
-            snapshots = [i.__getstate__() for i in list(zfs.snapshots)]
-        # FIXME: awful performance with hundreds/thousands of snapshots
-        return filter_list(snapshots, filters, options)
+        """
+        Query snapshots.
+
+        Only the datasets which can hold matching snapshots are walked when filtering
+        by `id`/`name` (`=`, `in`, `^`), `dataset` (`=`, `in`) or `pool` (`=`, `in`).
+
+        `extra.properties` is a list of properties to retrieve (`createtxg` is always included),
+        all of them are retrieved by default. `extra.holds` tells whether holds should be
+        retrieved, defaults to true only when all properties are.
+
+        Snapshots are served from the ZFS inventory when `extra.properties` is given,
+        otherwise they are read from ZFS.
+        """
+        options = options or {}
+        extra = options.get('extra') or {}
+        properties = extra.get('properties')
+        if properties is not None:
+            properties = set(properties) | {'createtxg'}
+        holds = extra.get('holds', properties is None)
+
+        if properties is None:
+            with zfs_handle() as zfs:
+                # Snapshots are serialized while `filter_list` consumes them so `get`
+                # and `limit` without ordering stop walking as soon as they are satisfied
+                snapshots = (
+                    snapshot_state(snapshot, properties, holds) for snapshot in self._iterate(zfs, filters or [])
+                )
+                return filter_list(snapshots, filters, options)
+
+        snapshots = (
+            self._project(state, properties, holds)
+            for state in INVENTORY.get_snapshots(self._datasets(filters or []), properties, holds)
+        )
+        return detach(filter_list(snapshots, filters, options))
+
+    def _project(self, state, properties, holds):
+        # Inventory entries may hold more than what was asked for
+        state = dict(state)
+        state['properties'] = {k: v for k, v in state['properties'].items() if k in properties}
+        if not holds:
+            state.pop('holds', None)
+        return state
+
+    def _datasets(self, filters):
+        """
+        Returns names of datasets in the inventory which can hold snapshots matching `filters`.
+        """
+        names, datasets, pools, prefixes = snapshot_scope(filters)
+        if names is not None:
+            return sorted({name.split('@', 1)[0] for name in names})
+
+        if datasets is not None:
+            return sorted(datasets)
+
+        return [
+            dataset['name'] for dataset in INVENTORY.get_datasets()
+            if (
+                (pools is None or dataset['name'].split('/', 1)[0] in pools) and
+                own_snapshots_match(dataset['name'], prefixes)
+            )
+        ]
+
+    def _iterate(self, zfs, filters):
+        """
+        Yields snapshots of datasets which can match `filters`.
+        """
+        names, datasets, pools, prefixes = snapshot_scope(filters)
+
+        if names is not None:
+            for name in sorted(names):
+                try:
+                    yield zfs.get_snapshot(name)
+                except libzfs.ZFSException:
+                    pass
+            return
+
+        if datasets is not None:
+            for name in sorted(datasets):
+                try:
+                    yield from zfs.get_dataset(name).snapshots
+                except libzfs.ZFSException:
+                    pass
+            return
+
+        def walk(dataset):
+            if own_snapshots_match(dataset.name, prefixes):
+                yield from dataset.snapshots
+            if children_snapshots_match(dataset.name, prefixes):
+                for child in dataset.children:
+                    yield from walk(child)
+
+        if pools is None:
+            roots = [pool.root_dataset for pool in zfs.pools]
+        else:
+            roots = []
+            for name in sorted(pools):
+                try:
+                    roots.append(zfs.get_dataset(name))
+                except libzfs.ZFSException:
+                    pass
+        for root in roots:
+            yield from walk(root)
 
     @accepts(Dict(
         'snapshot_create',
@@ -530,12 +1010,13 @@ class ZFSSnapshot(CRUDService):
             return False
 
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 ds = zfs.get_dataset(dataset)
                 ds.snapshot(f'{dataset}@{name}', recursive=recursive, fsopts=properties)
 
                 if vmsnaps_count > 0:
                     ds.properties['freenas:vmsynced'] = libzfs.ZFSUserProperty('Y')
+            INVENTORY.invalidate_dataset(dataset, recursive=recursive)
 
             self.logger.info(f"Snapshot taken: {dataset}@{name}")
             return True
@@ -559,9 +1040,10 @@ class ZFSSnapshot(CRUDService):
         snapshot_name = data['dataset'] + '@' + data['name']
 
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 snap = zfs.get_snapshot(snapshot_name)
                 snap.delete(True if data.get('defer_delete') else False)
+            INVENTORY.invalidate_dataset(snapshot_name)
         except libzfs.ZFSException as err:
             self.logger.error("{0}".format(err))
             return False
@@ -570,6 +1052,114 @@ class ZFSSnapshot(CRUDService):
 
         return True
 
+    @accepts(Dict(
+        'snapshot_create_many',
+        List('snapshots', items=[Str('snapshot')], required=True),
+        Bool('recursive', default=False),
+        Dict('properties', additional_attrs=True),
+    ))
+    def create_many(self, data):
+        """
+        Take `snapshots` (`dataset@name`) of many datasets at once.
+
+        Snapshots are taken atomically: either all of them are, in the same
+        transaction group, or none is.
+
+        Returns:
+            list: names of the snapshots taken.
+        """
+        verrors = ValidationErrors()
+        for i, snapshot in enumerate(data['snapshots']):
+            if '@' not in snapshot:
+                verrors.add(f'snapshot_create_many.snapshots.{i}', 'Snapshot name must be in the form dataset@name')
+        if verrors:
+            raise verrors
+
+        if not data['snapshots']:
+            return []
+
+        args = ['zfs', 'snapshot']
+        if data['recursive']:
+            args.append('-r')
+        for k, v in data['properties'].items():
+            args += ['-o', f'{k}={v}']
+
+        proc = subprocess.run(
+            args + data['snapshots'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8',
+        )
+        for snapshot in data['snapshots']:
+            INVENTORY.invalidate_dataset(snapshot.split('@', 1)[0], recursive=data['recursive'])
+        if proc.returncode != 0:
+            raise CallError(f'Failed to create snapshots: {proc.stderr.strip()}')
+
+        self.logger.info(f"Snapshots taken: {', '.join(data['snapshots'])}")
+        return data['snapshots']
+
+    @accepts(Dict(
+        'snapshot_destroy_many',
+        List('snapshots', items=[Str('snapshot')], required=True),
+        Bool('recursive', default=False),
+        Bool('defer', default=False),
+    ))
+    @job()
+    def destroy_many(self, job, data):
+        """
+        Destroy `snapshots`, each of them being either `dataset@name` or a range
+        `dataset@first%last` of snapshots of a dataset.
+
+        Snapshots of the same dataset are destroyed together, up to 500 per transaction.
+        When a batch fails its snapshots are destroyed one by one so a single snapshot
+        which can not be destroyed does not keep the others around.
+
+        `recursive` destroys snapshots with the same name of descendant datasets as well.
+        `defer` marks snapshots which can not be destroyed yet (e.g. with clones or holds)
+        for deferred destruction instead of failing.
+        """
+        verrors = ValidationErrors()
+        snapshots = OrderedDict()
+        for i, snapshot in enumerate(data['snapshots']):
+            if '@' not in snapshot:
+                verrors.add(f'snapshot_destroy_many.snapshots.{i}', 'Snapshot name must be in the form dataset@name')
+                continue
+            dataset, name = snapshot.split('@', 1)
+            snapshots.setdefault(dataset, []).append(name)
+        if verrors:
+            raise verrors
+
+        args = ['zfs', 'destroy']
+        if data['defer']:
+            args.append('-d')
+        if data['recursive']:
+            args.append('-r')
+
+        def destroy(dataset, names):
+            proc = subprocess.run(
+                args + [f'{dataset}@{",".join(names)}'],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf8',
+            )
+            if proc.returncode == 0:
+                return []
+            if len(names) == 1:
+                return [proc.stderr.strip()]
+            errors = []
+            for name in names:
+                errors.extend(destroy(dataset, [name]))
+            return errors
+
+        total = len(data['snapshots'])
+        done = 0
+        errors = []
+        for dataset, names in snapshots.items():
+            for i in range(0, len(names), SNAPSHOT_DESTROY_BATCH):
+                batch = names[i:i + SNAPSHOT_DESTROY_BATCH]
+                errors.extend(destroy(dataset, batch))
+                INVENTORY.invalidate_dataset(dataset, recursive=data['recursive'])
+                done += len(batch)
+                job.set_progress(int(done / total * 100), f'Destroyed snapshots of {dataset}')
+
+        if errors:
+            raise CallError('Failed to destroy snapshots:\n' + '\n'.join(errors))
+
     @accepts(Dict(
         'snapshot_clone',
         Str('snapshot'),
@@ -590,9 +1180,11 @@ class ZFSSnapshot(CRUDService):
             return False
 
         try:
-            with libzfs.ZFS() as zfs:
+            with zfs_handle() as zfs:
                 snp = zfs.get_snapshot(snapshot)
                 snp.clone(dataset_dst)
+            INVENTORY.invalidate_dataset(snapshot)
+            INVENTORY.invalidate_dataset(dataset_dst)
             self.logger.info("Cloned snapshot {0} to dataset {1}".format(snapshot, dataset_dst))
             return True
         except libzfs.ZFSException as err:
@@ -600,49 +1192,157 @@ class ZFSSnapshot(CRUDService):
             return False
 
 
-class ScanWatch(object):
+class ScanMonitor(object):
+    """
+    Watches scrub/resilver progress of all pools being scanned from a single thread using
+    one libzfs handle per pass.
+
+    Every pool is polled each SCAN_INTERVAL_MIN seconds, backing off up to SCAN_INTERVAL_MAX
+    while its progress is slower than SCAN_EVENT_STEP percent per poll. `zfs.pool.scan` events
+    and subscribers updates are only sent once progress moved by SCAN_EVENT_STEP or the scan
+    state changed.
+    """
+
+    def __init__(self):
+        self.middleware = None
+        self.cond = threading.Condition()
+        self.pools = {}
+        self.subscribers = defaultdict(list)
+        self.thread = None
+
+    def watch(self, pool):
+        with self.cond:
+            if pool not in self.pools:
+                self.pools[pool] = {'interval': SCAN_INTERVAL_MIN, 'next': 0, 'last': None, 'final': False}
+            if self.thread is None:
+                self.thread = start_daemon_thread(target=self.run)
+            self.cond.notify_all()
+
+    def finish(self, pool):
+        """
+        Scan of `pool` is over, send its final state right away.
+        """
+        with self.cond:
+            state = self.pools.get(pool)
+            if state is None:
+                return
+            state['final'] = True
+            state['next'] = 0
+            self.cond.notify_all()
+
+    def wait(self, pool, callback):
+        """
+        Blocks until scan of `pool` stops or `callback`, called with every update of the scan state,
+        returns True.
+        """
+        done = threading.Event()
 
-    def __init__(self, middleware, pool):
-        self.middleware = middleware
-        self.pool = pool
-        self._cancel = threading.Event()
+        def update(scan, final):
+            if callback(scan) or final:
+                done.set()
+                return True
+
+        with self.cond:
+            last = self.pools[pool]['last'] if pool in self.pools else None
+            if last is None or not update(last, False):
+                self.subscribers[pool].append(update)
+        if not done.is_set():
+            self.watch(pool)
+            done.wait()
 
     def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.pools:
+                        self.thread = None
+                        return
+                    now = time.monotonic()
+                    due = [name for name, state in self.pools.items() if state['next'] <= now]
+                    if due:
+                        break
+                    self.cond.wait(min(state['next'] for state in self.pools.values()) - now)
+
+            scans = dict.fromkeys(due)
+            try:
+                with zfs_handle() as zfs:
+                    for name in due:
+                        try:
+                            scans[name] = zfs.get(name).scrub.__getstate__()
+                        except libzfs.ZFSException:
+                            # Pool is gone
+                            pass
+            except Exception:
+                # Scan state is unknown, not over: keep watching and try again later
+                self.middleware.logger.warn('Failed to get pools scan state', exc_info=True)
+                self.retry(due)
+                continue
+            for name, scan in scans.items():
+                try:
+                    self.update(name, scan)
+                except Exception:
+                    self.middleware.logger.warn('Failed to update %r scan state', name, exc_info=True)
+
+    def retry(self, names):
+        with self.cond:
+            retry_at = time.monotonic() + SCAN_INTERVAL_MAX
+            for name in names:
+                state = self.pools.get(name)
+                if state is not None:
+                    state['interval'] = SCAN_INTERVAL_MAX
+                    state['next'] = retry_at
+
+    def update(self, name, scan):
+        with self.cond:
+            state = self.pools.get(name)
+            if state is None:
+                return
+            final = scan is None or state['final'] or scan['state'] != 'SCANNING' or bool(scan['pause'])
+            last = state['last']
+            changed = scan is not None and (
+                final or last is None or scan['state'] != last['state'] or
+                (scan['percentage'] or 0) - (last['percentage'] or 0) >= SCAN_EVENT_STEP
+            )
+            if changed:
+                state['last'] = scan
+                state['interval'] = max(SCAN_INTERVAL_MIN, state['interval'] / 2)
+            else:
+                state['interval'] = min(SCAN_INTERVAL_MAX, state['interval'] * 2)
+            state['next'] = time.monotonic() + state['interval']
+            if final:
+                self.pools.pop(name)
+                subscribers = self.subscribers.pop(name, [])
+            else:
+                subscribers = list(self.subscribers.get(name, []))
 
-        while not self._cancel.wait(2):
-            with libzfs.ZFS() as zfs:
-                scan = zfs.get(self.pool).scrub.__getstate__()
-            if scan['state'] == 'SCANNING':
-                self.send_scan(scan)
-            elif scan['state'] == 'FINISHED':
-                # Since this thread finishes on scrub/resilver end the event is sent
-                # on devd event arrival
-                break
-
-    def send_scan(self, scan=None):
-        if not scan:
-            with libzfs.ZFS() as zfs:
-                scan = zfs.get(self.pool).scrub.__getstate__()
-        self.middleware.send_event('zfs.pool.scan', 'CHANGED', fields={
-            'scan': scan,
-            'name': self.pool,
-        })
+        if changed:
+            INVENTORY.invalidate_pools()
+            self.middleware.send_event('zfs.pool.scan', 'CHANGED', fields={
+                'scan': scan,
+                'name': name,
+            })
+
+        if changed or final:
+            for subscriber in subscribers:
+                if subscriber(scan, final) and not final:
+                    with self.cond:
+                        self.subscribers[name].remove(subscriber)
 
-    def cancel(self):
-        self._cancel.set()
+
+SCAN_MONITOR = ScanMonitor()
 
 
 async def _handle_zfs_events(middleware, event_type, args):
     data = args['data']
+    if data.get('type') in ZFS_HANDLES_INVALIDATING_EVENTS:
+        invalidate_zfs_handles()
+    await middleware.run_in_thread(INVENTORY.handle_event, data)
+
     if data.get('type') in ('misc.fs.zfs.resilver_start', 'misc.fs.zfs.scrub_start'):
         pool = data.get('pool_name')
         if not pool:
             return
-        if pool in SCAN_THREADS:
-            return
-        scanwatch = ScanWatch(middleware, pool)
-        SCAN_THREADS[pool] = scanwatch
-        start_daemon_thread(target=scanwatch.run)
+        SCAN_MONITOR.watch(pool)
 
     elif data.get('type') in (
         'misc.fs.zfs.resilver_finish', 'misc.fs.zfs.scrub_finish', 'misc.fs.zfs.scrub_abort',
@@ -650,13 +1350,8 @@ async def _handle_zfs_events(middleware, event_type, args):
         pool = data.get('pool_name')
         if not pool:
             return
-        scanwatch = SCAN_THREADS.pop(pool, None)
-        if not scanwatch:
-            return
-        await middleware.run_in_thread(scanwatch.cancel)
-
         # Send the last event with SCRUB/RESILVER as FINISHED
-        await middleware.run_in_thread(scanwatch.send_scan)
+        SCAN_MONITOR.finish(pool)
 
     if data.get('type') == 'misc.fs.zfs.scrub_finish':
         await middleware.call('mail.send', {
@@ -665,5 +1360,16 @@ async def _handle_zfs_events(middleware, event_type, args):
         })
 
 
+async def _reconcile_inventory(middleware):
+    while True:
+        await asyncio.sleep(middleware.zfs_inventory_interval)
+        try:
+            await middleware.run_in_thread(INVENTORY.reconcile)
+        except Exception:
+            middleware.logger.warn('Failed to reconcile ZFS inventory', exc_info=True)
+
+
 def setup(middleware):
+    SCAN_MONITOR.middleware = middleware
     middleware.event_subscribe('devd.zfs', _handle_zfs_events)
+    asyncio.ensure_future(_reconcile_inventory(middleware))
@@ -0,0 +1,117 @@
+import asyncio
+from datetime import datetime, timezone
+
+from aiohttp import web, WSMsgType
+import pytest
+
+from middlewared.client import ClientException, ejson, emsgpack
+from middlewared.client.asyncio_ import AsyncClient, AsyncClientPool
+
+
+async def ws_handler(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    use_msgpack = False
+
+    async def send(data):
+        if use_msgpack:
+            await ws.send_bytes(emsgpack.dumps(data))
+        else:
+            await ws.send_str(ejson.dumps(data))
+
+    async def reply(message):
+        method = message['method']
+        params = message['params']
+        if method == 'test.sleep':
+            await asyncio.sleep(params[0] / 10)
+            await send({'msg': 'result', 'id': message['id'], 'result': params[0]})
+        elif method == 'test.now':
+            await send({'msg': 'result', 'id': message['id'], 'result': datetime(2018, 1, 1, tzinfo=timezone.utc)})
+        elif method == 'test.job':
+            await send({'msg': 'result', 'id': message['id'], 'result': 1})
+            for state in ('RUNNING', 'SUCCESS'):
+                await asyncio.sleep(0.1)
+                await send({'msg': 'changed', 'collection': 'core.get_jobs', 'id': 1, 'fields': {
+                    'id': 1, 'state': state, 'result': 'done', 'error': None, 'exception': None, 'exc_info': None,
+                }})
+        else:
+            await send({'msg': 'result', 'id': message['id'], 'error': {
+                'error': 201, 'reason': 'Method not found', 'trace': None, 'type': None, 'extra': None,
+            }})
+
+    async for msg in ws:
+        if msg.type == WSMsgType.BINARY:
+            message = emsgpack.loads(msg.data)
+        else:
+            message = ejson.loads(msg.data)
+
+        if message['msg'] == 'connect':
+            use_msgpack = 'MSGPACK' in message['features']
+            await send({'msg': 'connected', 'session': 'test'})
+        elif message['msg'] == 'ping':
+            await send({'msg': 'pong', 'id': message['id']})
+        elif message['msg'] == 'sub':
+            await send({'msg': 'ready', 'subs': [message['id']]})
+        elif message['msg'] == 'method':
+            asyncio.ensure_future(reply(message))
+
+    return ws
+
+
+class Server(object):
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_route('GET', '/websocket', ws_handler)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        return 'ws://127.0.0.1:%d/websocket' % self.runner.addresses[0][1]
+
+    async def __aexit__(self, typ, value, traceback):
+        await self.runner.cleanup()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('msgpack', [False, True])
+async def test__async_client__concurrent_calls(msgpack):
+    async with Server() as uri:
+        async with AsyncClient(uri, msgpack=msgpack) as c:
+            assert await c.ping()
+            assert await asyncio.gather(*[c.call('test.sleep', 3 - i) for i in range(3)]) == [3, 2, 1]
+            assert await c.call('test.now') == datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test__async_client__call_error():
+    async with Server() as uri:
+        async with AsyncClient(uri) as c:
+            with pytest.raises(ClientException) as e:
+                await c.call('test.unknown')
+
+            assert e.value.errno == 201
+
+
+@pytest.mark.asyncio
+async def test__async_client__job():
+    async with Server() as uri:
+        progress = []
+        async with AsyncClient(uri) as c:
+            assert await c.call('test.job', job=True, callback=lambda job: progress.append(job['state'])) == 'done'
+
+        assert progress == ['RUNNING', 'SUCCESS']
+
+
+@pytest.mark.asyncio
+async def test__async_client_pool__reuses_connections():
+    async with Server() as uri:
+        pool = AsyncClientPool(size=2)
+        try:
+            await asyncio.gather(*[pool.call('test.sleep', 1, uri=uri) for i in range(10)])
+
+            assert len(pool._clients[uri]) == 2
+            assert await pool.call('test.sleep', 0, uri=uri) == 0
+            assert len(pool._clients[uri]) == 2
+        finally:
+            await pool.close()
@@ -0,0 +1,35 @@
+from datetime import date, datetime, time, timezone
+
+import pytest
+
+from middlewared.client import ejson, emsgpack
+
+
+@pytest.mark.parametrize('value', [
+    {'id': 1, 'name': 'tank', 'children': [{'name': 'tank/a'}], 'used': 1.5, 'readonly': None},
+    [1, 'two', True, b'\x00\x01'],
+    {1: 'integer keys'},
+])
+def test__emsgpack__roundtrip(value):
+    assert emsgpack.loads(emsgpack.dumps(value)) == value
+
+
+@pytest.mark.parametrize('value', [
+    date(2018, 5, 4),
+    datetime(2018, 5, 4, 10, 20, 30, 123000),
+    datetime(2018, 5, 4, 10, 20, 30, tzinfo=timezone.utc),
+    time(10, 20, 30),
+])
+def test__emsgpack__decodes_like_ejson(value):
+    assert emsgpack.loads(emsgpack.dumps({'value': value})) == ejson.loads(ejson.dumps({'value': value}))
+
+
+def test__emsgpack__is_smaller_than_ejson():
+    value = [{'id': i, 'name': f'tank/dataset{i}', 'time': datetime(2018, 5, 4)} for i in range(100)]
+
+    assert len(emsgpack.dumps(value)) < len(ejson.dumps(value).encode())
+
+
+def test__emsgpack__unknown_type():
+    with pytest.raises(TypeError):
+        emsgpack.dumps(object())
@@ -0,0 +1,31 @@
+import os
+
+from mock import patch
+
+from middlewared.plugins.pool import DatasetShareTypes
+
+
+def test__dataset_share_types__marker_files(tmpdir):
+    tmpdir.mkdir('tank').mkdir('win').join('.windows').write('')
+    tmpdir.join('tank').mkdir('mac').join('.apple').write('')
+
+    assert DatasetShareTypes(str(tmpdir)).get(['tank', 'tank/win', 'tank/mac', 'tank/missing']) == {
+        'tank': 'UNIX',
+        'tank/win': 'WINDOWS',
+        'tank/mac': 'MAC',
+        'tank/missing': 'UNIX',
+    }
+
+
+def test__dataset_share_types__cached_until_mountpoint_changes(tmpdir):
+    path = tmpdir.mkdir('tank')
+    share_types = DatasetShareTypes(str(tmpdir))
+    assert share_types.get(['tank']) == {'tank': 'UNIX'}
+
+    with patch('middlewared.plugins.pool.os.path.exists') as exists:
+        assert share_types.get(['tank']) == {'tank': 'UNIX'}
+        exists.assert_not_called()
+
+    path.join('.windows').write('')
+    os.utime(str(path), ns=(0, 1))
+    assert share_types.get(['tank']) == {'tank': 'WINDOWS'}
@@ -0,0 +1,151 @@
+import threading
+import time
+
+from middlewared.plugins.replication import (
+    estimate_sizes, parse_snapshots, plan_replication, recommend_compression, remote_dataset, SSHConnection,
+    StreamLimiter,
+)
+
+
+def snapshots(*names):
+    return [(name, f'guid-{name}', i) for i, name in enumerate(names)]
+
+
+def test__remote_dataset():
+    assert remote_dataset('backup', 'tank') == 'backup'
+    assert remote_dataset('backup/tank', 'tank/data/child') == 'backup/tank/data/child'
+
+
+def test__ssh_connection__argv_hostname_before_command():
+    ssh = SSHConnection({
+        'remote_cipher': 'standard', 'remote_dedicateduser': None, 'remote_port': 22, 'remote_hostname': 'backup',
+    })
+
+    argv = ssh.argv('/sbin/zfs list -H')
+    assert argv[-2:] == ['backup', '/sbin/zfs list -H']
+    assert argv[-4:-2] == ['-p', '22']
+
+    argv = ssh.argv(options=['-O', 'check'])
+    assert argv[-3:] == ['-O', 'check', 'backup']
+
+
+def test__parse_snapshots__ordered_by_createtxg_and_renamed():
+    output = (
+        'backup/data@b\t2\t20\n'
+        'backup/data@a\t1\t10\n'
+        'backup/.system@a\t3\t5\n'
+        'backup/data/child@a\t4\t11\n'
+    )
+    assert parse_snapshots(output, 'backup/data', 'tank/data') == {
+        'tank/data': [('a', '1', 10), ('b', '2', 20)],
+        'tank/data/child': [('a', '4', 11)],
+    }
+
+
+def test__estimate_sizes__ordered_as_commands():
+    assert estimate_sizes([
+        ['printf', f'incremental\ta\tb\t{size}\nsize\t{size}\n'] for size in (300, 100, 200)
+    ] + [['false']]) == [300, 100, 200, 0]
+
+
+def test__plan_replication__incremental_from_common_guid():
+    source = {'tank/data': snapshots('a', 'b', 'c')}
+    target = {'tank/data': snapshots('a', 'b')}
+
+    assert plan_replication(source, target, False) == [{
+        'dataset': 'tank/data',
+        'destroy_snapshots': [],
+        'sends': [('b', 'c')],
+        'delete_snapshots': [],
+        'destroy': False,
+    }]
+
+
+def test__plan_replication__up_to_date():
+    source = {'tank/data': snapshots('a', 'b')}
+
+    assert plan_replication(source, {'tank/data': snapshots('b')}, False) == []
+
+
+def test__plan_replication__same_name_different_guid_repaved():
+    source = {'tank/data': snapshots('a', 'b')}
+    target = {'tank/data': [('b', 'other', 0)]}
+
+    assert plan_replication(source, target, False) == [{
+        'dataset': 'tank/data',
+        'destroy_snapshots': ['b'],
+        'sends': [(None, 'a'), ('a', 'b')],
+        'delete_snapshots': [],
+        'destroy': False,
+    }]
+
+
+def test__plan_replication__followdelete_and_removed_datasets_deepest_first():
+    source = {'tank/data': snapshots('b', 'c')}
+    target = {
+        'tank/data': snapshots('a', 'b'),
+        'tank/data/gone': snapshots('a'),
+    }
+
+    assert plan_replication(source, target, True) == [
+        {
+            'dataset': 'tank/data/gone',
+            'destroy_snapshots': [],
+            'sends': [],
+            'delete_snapshots': [],
+            'destroy': True,
+        },
+        {
+            'dataset': 'tank/data',
+            'destroy_snapshots': [],
+            'sends': [('b', 'c')],
+            'delete_snapshots': ['a'],
+            'destroy': False,
+        },
+    ]
+
+
+def test__recommend_compression__slow_link_prefers_ratio():
+    results = [
+        {'compression': 'OFF', 'level': None, 'throughput': None, 'ratio': 1.0},
+        {'compression': 'LZ4', 'level': 1, 'throughput': 500 * 1024 * 1024, 'ratio': 2.0},
+        {'compression': 'PLZIP', 'level': 9, 'throughput': 5 * 1024 * 1024, 'ratio': 4.0},
+    ]
+
+    assert recommend_compression(results, 1024)['compression'] == 'PLZIP'
+    assert recommend_compression(results, 100 * 1024)['compression'] == 'LZ4'
+    assert recommend_compression(results[:1] + [dict(results[1], throughput=1024)], 100 * 1024)['compression'] == 'OFF'
+
+
+def test__stream_limiter__fifo_queue():
+    limiter = StreamLimiter(1)
+    order = []
+    positions = []
+    release = threading.Event()
+
+    def hold():
+        with limiter.stream():
+            order.append('hold')
+            release.wait()
+
+    def wait(name):
+        with limiter.stream(positions.append):
+            order.append(name)
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    while limiter.stats()['running'] == 0:
+        time.sleep(0.01)
+    waiters = []
+    for name in ('first', 'second'):
+        waiters.append(threading.Thread(target=wait, args=(name,)))
+        waiters[-1].start()
+        while limiter.stats()['queued'] < len(waiters):
+            time.sleep(0.01)
+    release.set()
+    for thread in [holder] + waiters:
+        thread.join()
+
+    assert order == ['hold', 'first', 'second']
+    assert limiter.stats() == {'limit': 1, 'running': 0, 'queued': 0}
+    assert positions.count(None) == 2
@@ -0,0 +1,69 @@
+from datetime import datetime, time
+
+from middlewared.plugins.snapshot import plan_snapshots, prune_snapshots, SnapshotIndex, task_matches_time
+
+
+def task(filesystem, recursive=False, interval=60, ret_count=2, ret_unit='week', **kwargs):
+    return dict({
+        'filesystem': filesystem,
+        'recursive': recursive,
+        'interval': interval,
+        'ret_count': ret_count,
+        'ret_unit': ret_unit,
+        'begin': time(9),
+        'end': time(18),
+        'repeat_unit': 'weekly',
+        'byweekday': '1,2,3,4,5',
+    }, **kwargs)
+
+
+def test__task_matches_time():
+    # Monday
+    assert task_matches_time(task('tank'), datetime(2018, 6, 4, 9, 0))
+    assert not task_matches_time(task('tank'), datetime(2018, 6, 4, 18, 1))
+    # Saturday
+    assert not task_matches_time(task('tank'), datetime(2018, 6, 9, 12, 0))
+    assert task_matches_time(task('tank', repeat_unit='daily'), datetime(2018, 6, 9, 12, 0))
+    assert task_matches_time(task('tank', begin=time(22), end=time(2)), datetime(2018, 6, 4, 1, 0))
+
+
+def test__snapshot_index__expired_and_latest():
+    index = SnapshotIndex([
+        'tank@auto-20180604.0900-1h',
+        'tank@auto-20180604.1000-1h',
+        'tank@manual',
+        'tank/a@auto-20180604.0900-2w',
+    ])
+
+    assert index.last_snapshot('tank', '1h', datetime(2018, 6, 4, 10, 30)) == datetime(2018, 6, 4, 10, 0)
+    assert index.last_snapshot('tank', '1h', datetime(2018, 6, 4, 11, 0)) is None
+    assert index.pop_expired(datetime(2018, 6, 4, 10, 0)) == ['tank@auto-20180604.0900-1h']
+    assert index.pop_expired(datetime(2018, 6, 4, 10, 0)) == []
+
+
+def test__plan_snapshots__interval_and_recursive_collision():
+    index = SnapshotIndex(['tank/b@auto-20180604.0900-2w'])
+    tasks = [
+        task('tank', recursive=True),
+        task('tank/b'),
+        task('tank/c', ret_count=1),
+        task('tank/d', interval=120),
+    ]
+    index.add('tank/d@auto-20180604.0900-2w')
+
+    assert plan_snapshots(tasks, datetime(2018, 6, 4, 10, 0), index) == [
+        ['tank', '2w', True],
+        ['tank/c', '1w', False],
+    ]
+
+
+def test__prune_snapshots__covered_and_top_level_only():
+    tasks = [task('tank', recursive=True), task('data/a')]
+
+    assert prune_snapshots([
+        'tank/x@auto-20180604.0900-1h',
+        'tank@auto-20180604.0900-1h',
+        'data/a@auto-20180604.0900-1h',
+        'data/a/b@auto-20180604.0900-1h',
+        'other@auto-20180604.0900-1h',
+    ], tasks) == ['data/a@auto-20180604.0900-1h', 'tank@auto-20180604.0900-1h']
@@ -0,0 +1,88 @@
+from mock import MagicMock, Mock, patch
+
+from middlewared.plugins.zfs import ScanMonitor, SCAN_INTERVAL_MAX, SCAN_INTERVAL_MIN, ZFSInventory
+
+
+def scan(percentage, state='SCANNING', pause=None):
+    return {'function': 'SCRUB', 'state': state, 'percentage': percentage, 'pause': pause}
+
+
+@patch('middlewared.plugins.zfs.INVENTORY', Mock())
+def test__scan_monitor__coalesces_events_and_backs_off():
+    monitor = ScanMonitor()
+    monitor.middleware = Mock()
+    monitor.pools['tank'] = {'interval': SCAN_INTERVAL_MIN, 'next': 0, 'last': None, 'final': False}
+
+    monitor.update('tank', scan(1.0))
+    for i in range(10):
+        monitor.update('tank', scan(1.01))
+    assert monitor.middleware.send_event.call_count == 1
+    assert monitor.pools['tank']['interval'] == SCAN_INTERVAL_MAX
+
+    monitor.update('tank', scan(2.0))
+    assert monitor.middleware.send_event.call_count == 2
+    assert monitor.pools['tank']['interval'] == SCAN_INTERVAL_MAX / 2
+
+    monitor.update('tank', scan(2.0, 'FINISHED'))
+    assert monitor.middleware.send_event.call_count == 3
+    assert 'tank' not in monitor.pools
+
+
+@patch('middlewared.plugins.zfs.INVENTORY', Mock())
+def test__scan_monitor__subscribers():
+    monitor = ScanMonitor()
+    monitor.middleware = Mock()
+    monitor.pools['tank'] = {'interval': SCAN_INTERVAL_MIN, 'next': 0, 'last': None, 'final': False}
+    updates = []
+    monitor.subscribers['tank'].append(lambda scan, final: updates.append((scan['percentage'], final)))
+
+    monitor.update('tank', scan(5.0))
+    monitor.update('tank', scan(5.0))
+    monitor.update('tank', scan(10.0, pause='2018-07-01'))
+
+    assert updates == [(5.0, False), (10.0, True)]
+    assert 'tank' not in monitor.subscribers
+
+
+@patch('middlewared.plugins.zfs.INVENTORY', Mock())
+@patch('middlewared.plugins.zfs.zfs_handle', Mock(side_effect=RuntimeError('libzfs')))
+def test__scan_monitor__keeps_watching_on_zfs_error():
+    monitor = ScanMonitor()
+    monitor.middleware = Mock()
+    monitor.pools['tank'] = {'interval': SCAN_INTERVAL_MIN, 'next': 0, 'last': None, 'final': False}
+    retried = []
+
+    def retry(names):
+        ScanMonitor.retry(monitor, names)
+        retried.append(dict(monitor.pools['tank']))
+        # Stop the monitor thread loop
+        monitor.pools.clear()
+
+    monitor.retry = retry
+    monitor.run()
+
+    assert retried[0]['interval'] == SCAN_INTERVAL_MAX
+    assert retried[0]['next'] > 0
+    monitor.middleware.send_event.assert_not_called()
+
+
+def test__zfs_inventory__reconcile_skipped_if_not_read():
+    pool = Mock()
+    pool.__getstate__ = Mock(return_value={'id': '1', 'name': 'tank'})
+    handle = MagicMock()
+    handle.__enter__.return_value.pools = [pool]
+
+    with patch('middlewared.plugins.zfs.zfs_handle', Mock(return_value=handle)) as zfs_handle:
+        inventory = ZFSInventory()
+        inventory.get_pools()
+        assert zfs_handle.call_count == 1
+
+        assert inventory.reconcile() is True
+        assert zfs_handle.call_count == 2
+
+        assert inventory.reconcile() is False
+        assert zfs_handle.call_count == 2
+
+        inventory.get_pools()
+        assert inventory.reconcile() is True
+        assert zfs_handle.call_count == 3
@@ -0,0 +1,85 @@
+from mock import Mock
+
+from middlewared.service import CRUDService
+
+
+class ShareService(CRUDService):
+
+    class Config:
+        datastore = 'sharing.share'
+        datastore_extend = 'share.extend'
+        datastore_prefix = 'share_'
+        datastore_filters = [('expired', '=', False)]
+        datastore_raw_fields = ['name']
+
+
+def test__crud_plan_datastore_query__raw_filters_pushed_down():
+    s = ShareService(Mock())
+
+    assert s._plan_datastore_query(
+        [('id', '=', 1), ('expired', '=', False)], {'extend': 'share.extend', 'get': True},
+    ) == (
+        [('id', '=', 1), ('expired', '=', False)],
+        [],
+        {'extend': 'share.extend', 'get': True},
+        {},
+    )
+
+
+def test__crud_plan_datastore_query__extended_filters_applied_to_result():
+    s = ShareService(Mock())
+
+    assert s._plan_datastore_query(
+        [('name', 'in', ['a', 'b']), ('hosts', 'rin', 'h2'), ('name', '~', 'a.*')], {'count': True},
+    ) == (
+        [('name', 'in', ['a', 'b'])],
+        [('hosts', 'rin', 'h2'), ('name', '~', 'a.*')],
+        {},
+        {'count': True},
+    )
+
+
+def test__crud_plan_datastore_query__order_by_extended_field():
+    s = ShareService(Mock())
+
+    assert s._plan_datastore_query([('id', '>', 1)], {'order_by': ['name', '-hosts'], 'get': True}) == (
+        [('id', '>', 1)],
+        [],
+        {},
+        {'order_by': ['name', '-hosts'], 'get': True},
+    )
+
+
+def test__crud_plan_datastore_query__order_by_raw_field_pushed_down():
+    s = ShareService(Mock())
+
+    assert s._plan_datastore_query([], {'order_by': ['-name', 'id']}) == (
+        [],
+        [],
+        {'order_by': ['-name', 'id']},
+        {},
+    )
+
+
+def test__crud_plan_datastore_query__paging_pushed_down():
+    s = ShareService(Mock())
+
+    assert s._plan_datastore_query(
+        [('name', '=', 'a')], {'order_by': ['id'], 'offset': 10, 'limit': 5, 'select': ['hosts'], 'count': False},
+    ) == (
+        [('name', '=', 'a')],
+        [],
+        {'order_by': ['id'], 'offset': 10, 'limit': 5, 'select': ['hosts']},
+        {},
+    )
+
+
+def test__crud_plan_datastore_query__paging_extended_result():
+    s = ShareService(Mock())
+
+    assert s._plan_datastore_query([('hosts', 'rin', 'h2')], {'offset': 10, 'limit': 5}) == (
+        [],
+        [('hosts', 'rin', 'h2')],
+        {},
+        {'offset': 10, 'limit': 5},
+    )
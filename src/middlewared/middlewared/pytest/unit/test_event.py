@@ -0,0 +1,50 @@
+import asyncio
+
+from mock import Mock
+import pytest
+
+from middlewared.event import EventSource
+
+
+class CounterEventSource(EventSource):
+
+    async def run(self):
+        i = 0
+        while True:
+            i += 1
+            self.send_event('ADDED', fields={'count': i})
+            await asyncio.sleep(0.01)
+
+
+def middleware():
+    middleware = Mock()
+    middleware.event_source_finished.side_effect = lambda event_source: asyncio.sleep(0)
+    return middleware
+
+
+@pytest.mark.asyncio
+async def test__event_source__fans_out_to_subscribers():
+    app1, app2 = Mock(), Mock()
+    event_source = CounterEventSource(middleware(), 'counter', None)
+    event_source.subscribers[('1', 'a')] = app1
+    event_source.subscribers[('2', 'b')] = app2
+
+    event_source.start()
+    await asyncio.sleep(0.005)
+    event_source.cancel()
+    await asyncio.sleep(0)
+
+    app1.send_event.assert_called_once_with('counter', 'ADDED', fields={'count': 1})
+    app2.send_event.assert_called_once_with('counter', 'ADDED', fields={'count': 1})
+    event_source.middleware.event_source_finished.assert_called_once_with(event_source)
+
+
+@pytest.mark.asyncio
+async def test__event_source__replays_last_event_on_subscribe():
+    app = Mock()
+    event_source = CounterEventSource(middleware(), 'counter', None)
+    event_source.send_event('ADDED', fields={'count': 5})
+
+    event_source.on_subscribe(app)
+
+    app.send_event.assert_called_once_with('counter', 'ADDED', fields={'count': 5})
@@ -0,0 +1,220 @@
+import asyncio
+
+from mock import Mock
+import pytest
+
+from middlewared.job import Job, JobsDeque, JobsQueue, State
+from middlewared.utils.job_history import JobHistoryStore
+
+
+def make_job(middleware, method_name='test.job', lock=None, lock_queue_size=None, priority=0, max_concurrency=None):
+    return Job(middleware, method_name, Mock(), Mock(), [], {
+        'lock': lock,
+        'lock_queue_size': lock_queue_size,
+        'priority': priority,
+        'max_concurrency': max_concurrency,
+        'logs': False,
+        'process': False,
+        'pipes': [],
+        'check_pipes': True,
+        'transient': False,
+    }, None)
+
+
+def finish(queue, job):
+    job.set_state('RUNNING')
+    job.set_state('SUCCESS')
+    queue.release(job)
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__lock_fifo():
+    middleware = Mock()
+    queue = JobsQueue(middleware)
+    jobs = [queue.add(make_job(middleware, lock='disk')) for i in range(3)]
+
+    assert await queue.__next__() is jobs[0]
+    assert queue.ready == []
+
+    finish(queue, jobs[0])
+    assert await queue.__next__() is jobs[1]
+
+    finish(queue, jobs[1])
+    assert await queue.__next__() is jobs[2]
+
+    finish(queue, jobs[2])
+    assert queue.job_locks == {}
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__lock_queue_size():
+    middleware = Mock()
+    queue = JobsQueue(middleware)
+    running = queue.add(make_job(middleware, lock='cloud_sync:1', lock_queue_size=1))
+    assert await queue.__next__() is running
+    running.set_state('RUNNING')
+
+    queued = queue.add(make_job(middleware, lock='cloud_sync:1', lock_queue_size=1))
+    assert queue.add(make_job(middleware, lock='cloud_sync:1', lock_queue_size=1)) is queued
+    assert len(queue.all()) == 2
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__priority():
+    middleware = Mock()
+    queue = JobsQueue(middleware)
+    low = queue.add(make_job(middleware))
+    high = queue.add(make_job(middleware, priority=10))
+
+    assert await queue.__next__() is high
+    assert await queue.__next__() is low
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__max_concurrency():
+    middleware = Mock()
+    queue = JobsQueue(middleware)
+    first = queue.add(make_job(middleware, 'disk.sync', max_concurrency=1))
+    second = queue.add(make_job(middleware, 'disk.sync', max_concurrency=1))
+    other = queue.add(make_job(middleware, 'pool.scrub'))
+
+    assert await queue.__next__() is first
+    assert await queue.__next__() is other
+    assert queue.stats()['method_waiting'] == {'disk.sync': 1}
+
+    finish(queue, first)
+    assert await queue.__next__() is second
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__max_jobs():
+    middleware = Mock()
+    queue = JobsQueue(middleware, max_jobs=1)
+    first = queue.add(make_job(middleware))
+    second = queue.add(make_job(middleware))
+
+    assert await queue.__next__() is first
+    assert queue.stats()['running'] == 1
+    assert queue.stats()['ready'] == 1
+
+    finish(queue, first)
+    assert await queue.__next__() is second
+
+
+@pytest.mark.asyncio
+async def test__jobs_deque__evicts_oldest_finished():
+    middleware = Mock()
+    deque = JobsDeque(maxlen=2)
+    jobs = [make_job(middleware) for i in range(3)]
+    for job in jobs:
+        deque.add(job)
+
+    jobs[1].state = State.SUCCESS
+    deque.finished(jobs[1])
+    jobs[0].state = State.SUCCESS
+    deque.finished(jobs[0])
+
+    deque.add(make_job(middleware))
+
+    assert list(deque.all().keys()) == [1, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test__jobs_queue__query_merges_history():
+    middleware = Mock()
+    history = Mock()
+    history.reserve_ids.return_value = (0, 1000)
+    history.pending.return_value = [{'id': 2, 'method': 'test.job', 'state': 'SUCCESS'}]
+    history.query.return_value = [
+        {'id': 1, 'method': 'test.job', 'state': 'SUCCESS'},
+        {'id': 2, 'method': 'test.job', 'state': 'SUCCESS'},
+    ]
+    queue = JobsQueue(middleware, history=history)
+    queue.deque.count = 2
+    queue.add(make_job(middleware))
+
+    assert [j['id'] for j in queue.query([('method', '=', 'test.job')], {'order_by': ['-id'], 'limit': 2})] == [3, 2]
+    history.query.assert_called_once_with([('method', '=', 'test.job')], ['-id'], 2)
+
+
+def test__jobs_queue__unpaged_query_skips_history():
+    history = Mock()
+    history.reserve_ids.return_value = (0, 1000)
+    history.pending.return_value = [{'id': 1, 'method': 'test.job', 'state': 'SUCCESS'}]
+    queue = JobsQueue(Mock(), history=history)
+
+    assert [j['id'] for j in queue.query()] == [1]
+    history.query.assert_not_called()
+
+
+def test__jobs_queue__query_history_in_chunks():
+    archive = [{'id': i, 'method': 'test.job', 'arguments': [i % 3]} for i in range(1, 101)]
+
+    def query(filters, order_by, limit):
+        assert order_by == ['-id'] and limit == 10
+        before = dict((f[0], f[2]) for f in filters).get('id', 101)
+        return [job for job in reversed(archive) if job['id'] < before][:limit]
+
+    history = Mock()
+    history.reserve_ids.return_value = (100, 1000)
+    history.pending.return_value = []
+    history.query.side_effect = query
+    queue = JobsQueue(Mock(), history=history, history_page=10)
+
+    jobs = queue.query([('arguments', '=', [0])], {'order_by': ['-id'], 'limit': 5})
+    assert [j['id'] for j in jobs] == [99, 96, 93, 90, 87]
+    assert history.query.call_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('mounted', [True, False])
+async def test__jobs_queue__ids_unique_across_restarts(tmpdir, mounted):
+    def history():
+        store = JobHistoryStore(str(tmpdir), ids_path=str(tmpdir.join('job-ids')), ids_block=2)
+        store.available = lambda: True
+        return store
+
+    middleware = Mock()
+    middleware.dump_args.side_effect = lambda args, method: args
+    queue = JobsQueue(middleware, history=history())
+    for i in range(3):
+        finish(queue, queue.add(make_job(middleware)))
+    queue.history.flush()
+    assert [job['id'] for job in queue.history.query()] == [1, 2, 3]
+
+    # Jobs of the next run can start before the system dataset is mounted
+    restarted = history()
+    restarted.available = lambda: mounted
+    queue = JobsQueue(middleware, history=restarted)
+    job = queue.add(make_job(middleware))
+
+    assert job.id > 3
+
+
+@pytest.mark.asyncio
+async def test__job__set_progress_coalesced():
+    middleware = Mock(job_progress_interval=0.1)
+    job = make_job(middleware)
+    job.set_id(1)
+    job.set_state('RUNNING')
+
+    for i in range(10):
+        job.set_progress(i)
+    await asyncio.sleep(0.01)
+
+    middleware.send_event.assert_called_once_with('core.get_jobs', 'CHANGED', id=1, fields={
+        'id': 1, 'state': 'RUNNING', 'progress': {'percent': 9, 'description': None, 'extra': None},
+    })
+    assert job.progress_suppressed == 9
+
+    for i in range(10, 20):
+        job.set_progress(i)
+    await asyncio.sleep(0.01)
+
+    assert middleware.send_event.call_count == 1
+
+    await asyncio.sleep(0.15)
+
+    assert middleware.send_event.call_count == 2
+    assert middleware.send_event.call_args[1]['fields']['progress']['percent'] == 19
+    assert job.progress_suppressed == 18
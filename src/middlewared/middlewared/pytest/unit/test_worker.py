@@ -0,0 +1,21 @@
+from mock import Mock
+import pytest
+
+from middlewared.worker import FakeMiddleware
+
+
+@pytest.mark.asyncio
+async def test__fake_middleware__call_waits_forever_by_default():
+    calls = []
+
+    async def call(method, *params, **kwargs):
+        calls.append(kwargs)
+
+    middleware = FakeMiddleware()
+    middleware.async_client = Mock(closed=False, call=call)
+
+    await middleware.call('update.apply', 1, timeout=None)
+    await middleware.call('update.get_trains')
+
+    # Like the middleware itself, calls without a timeout wait forever
+    assert calls == [{'timeout': None}, {'timeout': None}]
@@ -0,0 +1,87 @@
+import pytest
+
+from middlewared.utils import filter_list, IndexedList
+
+DATA = [
+    {'id': 1, 'name': 'tank', 'size': 30},
+    {'id': 2, 'name': 'data', 'size': 10},
+    {'id': 3, 'name': 'backup', 'size': 20},
+    {'id': 4, 'name': 'media', 'size': 40},
+]
+
+
+def test__filter_list__offset_limit():
+    assert filter_list(DATA, [], {'offset': 1, 'limit': 2}) == DATA[1:3]
+
+
+def test__filter_list__limit_after_order_by():
+    assert filter_list(DATA, [('size', '>', 10)], {'order_by': ['-size'], 'limit': 2}) == [DATA[3], DATA[0]]
+
+
+def test__filter_list__count_ignores_paging():
+    assert filter_list(DATA, [('size', '>', 10)], {'count': True, 'limit': 1}) == 3
+
+
+def test__filter_list__select():
+    assert filter_list(DATA, [('id', '=', 2)], {'select': ['name', 'missing']}) == [{'name': 'data'}]
+
+
+def test__filter_list__get_with_offset():
+    assert filter_list(DATA, [('size', '>=', 20)], {'get': True, 'offset': 1}) == DATA[2]
+
+
+def test__filter_list__get_select():
+    assert filter_list(DATA, [('size', '>=', 20)], {'get': True, 'select': ['id']}) == {'id': 1}
+
+
+def test__filter_list__get_not_found():
+    with pytest.raises(IndexError):
+        filter_list(DATA, [('size', '>', 100)], {'get': True})
+
+
+def test__filter_list__order_by_multiple_keys():
+    data = [{'a': 1, 'b': 1}, {'a': 0, 'b': 2}, {'a': 1, 'b': 0}]
+    assert filter_list(data, [], {'order_by': ['a', 'b']}) == [data[1], data[2], data[0]]
+    assert filter_list(data, [], {'order_by': ['-a', 'b']}) == [data[2], data[0], data[1]]
+
+
+def test__filter_list__get_with_order_by():
+    assert filter_list(DATA, [('size', '>=', 20)], {'get': True, 'order_by': ['size']}) == DATA[2]
+
+
+def test__filter_list__dotted_path():
+    data = [{'props': {'used': 1, 'a.b': 'x'}, 'tags': ['t1']}, {'props': {'used': 2}, 'tags': []}]
+    assert filter_list(data, [('props.used', '>', 1)]) == [data[1]]
+    assert filter_list(data, [('props.a\\.b', '=', 'x')]) == [data[0]]
+    assert filter_list(data, [('tags.0', '=', 't1')]) == [data[0]]
+    assert filter_list(data, [('tags.0', '=', None)]) == [data[1]]
+
+
+def test__filter_list__regex():
+    assert filter_list(DATA, [('name', '~', 'ba|me')]) == [DATA[2], DATA[3]]
+
+
+def test__filter_list__invalid_operation():
+    with pytest.raises(ValueError):
+        filter_list(DATA, [('name', '===', 'x')])
+
+
+def test__filter_list__indexed_list():
+    data = IndexedList(DATA, ['name'])
+    assert filter_list(data, [('size', '>', 10), ('name', '=', 'tank')]) == [DATA[0]]
+    assert filter_list(data, [('name', 'in', ['media', 'data'])]) == [DATA[1], DATA[3]]
+    assert filter_list(data, [('name', '=', 'missing')]) == []
+    assert filter_list(data, [('name', 'in', 'tank')]) == [DATA[0]]
+
+
+def test__filter_list__generator_consumed_lazily():
+    consumed = []
+
+    def items():
+        for i in DATA:
+            consumed.append(i['id'])
+            yield i
+
+    assert filter_list(items(), [('size', '>=', 20)], {'limit': 1}) == [DATA[0]]
+    assert consumed == [1]
+    assert filter_list(items(), [('size', '>=', 20)], {'count': True}) == 3
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from middlewared.utils.job_history import JobHistoryStore, split_filters
+
+
+def encoded_job(id, method='disk.sync', state='SUCCESS'):
+    return {
+        'id': id,
+        'method': method,
+        'arguments': ['ada0'],
+        'logs_path': None,
+        'logs_excerpt': None,
+        'progress': {'percent': 100, 'description': None, 'extra': None},
+        'result': None,
+        'error': None,
+        'exception': None,
+        'exc_info': None,
+        'state': state,
+        'time_started': datetime(2018, 1, 1) + timedelta(minutes=id),
+        'time_finished': datetime(2018, 1, 1) + timedelta(minutes=id + 1),
+    }
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = JobHistoryStore(str(tmpdir), max_rows=5)
+    store.available = lambda: True
+    return store
+
+
+def test__job_history__flush_and_query(store):
+    for i in range(1, 4):
+        store.add(encoded_job(i, state='FAILED' if i == 2 else 'SUCCESS'))
+
+    assert store.flush() == 3
+    assert store.pending() == []
+    assert store.max_id == 3
+
+    jobs = store.query([('state', '=', 'FAILED')])
+    assert jobs == [encoded_job(2, state='FAILED')]
+
+
+def test__job_history__keeps_pending_if_unavailable(store):
+    store.available = lambda: False
+    store.add(encoded_job(1))
+
+    assert store.flush() == 0
+    assert store.query() == []
+    assert len(store.pending()) == 1
+
+
+def test__job_history__max_rows(store):
+    for i in range(1, 11):
+        store.add(encoded_job(i))
+    store.flush()
+
+    assert [job['id'] for job in store.query()] == [6, 7, 8, 9, 10]
+
+
+def test__job_history__order_and_limit(store):
+    for i in range(1, 5):
+        store.add(encoded_job(i, method='cloudsync.sync' if i % 2 else 'disk.sync'))
+    store.flush()
+
+    jobs = store.query([('method', '=', 'cloudsync.sync')], ['-time_finished'], 1)
+    assert [job['id'] for job in jobs] == [3]
+
+
+def test__job_history__reads_max_id_on_open(store, tmpdir):
+    store.add(encoded_job(42))
+    store.flush()
+
+    another = JobHistoryStore(str(tmpdir))
+    another.available = lambda: True
+    another.flush()
+
+    assert another.max_id == 42
+
+
+def test__job_history__split_filters():
+    assert split_filters([
+        ('method', '=', 'disk.sync'),
+        ('time_finished', '>', datetime(2018, 1, 1)),
+        ('time_finished', '>', 0),
+        ('progress.percent', '=', 100),
+        ['OR', [('id', '=', 1), ('id', '=', 2)]],
+    ]) == (
+        [('method', '=', 'disk.sync'), ('time_finished', '>', datetime(2018, 1, 1))],
+        [('time_finished', '>', 0), ('progress.percent', '=', 100), ['OR', [('id', '=', 1), ('id', '=', 2)]]],
+    )
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from middlewared.utils.process_pool import ProcessPool
+
+
+@pytest.fixture
+def pool(request):
+    pool = ProcessPool('test', **request.param)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.parametrize('pool', [{'min_workers': 1, 'max_workers': 1}], indirect=True)
+def test__process_pool__keeps_worker_warm(pool):
+    pids = {pool.submit(os.getpid).result(30) for i in range(5)}
+
+    assert len(pids) == 1
+    assert pids != {os.getpid()}
+    assert pool.stats()['spawned'] == 1
+
+
+@pytest.mark.parametrize('pool', [{'min_workers': 1, 'max_workers': 1, 'max_calls': 2}], indirect=True)
+def test__process_pool__recycles_worker_after_max_calls(pool):
+    pids = [pool.submit(os.getpid).result(30) for i in range(4)]
+
+    assert pids[0] == pids[1]
+    assert pids[1] != pids[2]
+    assert pids[2] == pids[3]
+    assert pool.stats()['recycled'] >= 1
+
+
+@pytest.mark.parametrize('pool', [{'min_workers': 0, 'max_workers': 3}], indirect=True)
+def test__process_pool__scales_up_to_max_workers(pool):
+    futures = [pool.submit(pow, 2, i) for i in range(10)]
+
+    assert [f.result(30) for f in futures] == [2 ** i for i in range(10)]
+    assert pool.stats()['spawned'] <= 3
+
+
+@pytest.mark.parametrize('pool', [{'min_workers': 1, 'max_workers': 1}], indirect=True)
+def test__process_pool__propagates_exception(pool):
+    with pytest.raises(ValueError):
+        pool.submit(int, 'invalid').result(30)
+
+    assert pool.submit(int, '1').result(30) == 1
@@ -0,0 +1,55 @@
+from middlewared.utils.query_cache import QueryCache
+
+
+def test__query_cache__hit_returns_copy():
+    cache = QueryCache()
+    cache.put('key', {'table'}, [{'id': 1}], cache.token())
+
+    hit, value = cache.get('key')
+    assert hit
+    value[0]['id'] = 2
+
+    assert cache.get('key') == (True, [{'id': 1}])
+    assert cache.stats()['hits'] == 2
+
+
+def test__query_cache__miss():
+    cache = QueryCache()
+
+    assert cache.get('key') == (False, None)
+    assert cache.stats()['misses'] == 1
+
+
+def test__query_cache__invalidate_dependent_tables_only():
+    cache = QueryCache()
+    cache.put('users', {'users', 'groups'}, 1, cache.token())
+    cache.put('groups', {'groups'}, 2, cache.token())
+    cache.put('shares', {'shares'}, 3, cache.token())
+
+    cache.invalidate(['groups'])
+
+    assert cache.get('users') == (False, None)
+    assert cache.get('groups') == (False, None)
+    assert cache.get('shares') == (True, 3)
+
+
+def test__query_cache__put_after_invalidation_is_discarded():
+    cache = QueryCache()
+    token = cache.token()
+    cache.invalidate(['table'])
+    cache.put('key', {'table'}, 1, token)
+
+    assert cache.get('key') == (False, None)
+
+
+def test__query_cache__lru_eviction():
+    cache = QueryCache(max_entries=2)
+    cache.put('a', {'table'}, 1, cache.token())
+    cache.put('b', {'table'}, 2, cache.token())
+    cache.get('a')
+    cache.put('c', {'table'}, 3, cache.token())
+
+    assert cache.get('b') == (False, None)
+    assert cache.get('a') == (True, 1)
+    assert cache.get('c') == (True, 3)
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,59 @@
+from middlewared.utils.send_queue import SendQueue
+
+
+def changed(id, **fields):
+    return {'msg': 'changed', 'collection': 'core.get_jobs', 'id': id, 'fields': dict(fields, id=id)}
+
+
+def drain(queue):
+    rv = []
+    while True:
+        data = queue.get()
+        if data is None:
+            return rv
+        rv.append(data)
+
+
+def test__send_queue__merges_changed_events():
+    queue = SendQueue()
+    queue.put_event(changed(1, state='RUNNING', progress=1))
+    queue.put_event(changed(2, state='RUNNING', progress=1))
+    assert queue.put_event(changed(1, progress=2)) is False
+
+    assert drain(queue) == [
+        changed(1, state='RUNNING', progress=2),
+        changed(2, state='RUNNING', progress=1),
+    ]
+    assert queue.stats()['merged'] == 1
+
+
+def test__send_queue__does_not_merge_across_other_events():
+    queue = SendQueue()
+    queue.put_event(changed(1, progress=1))
+    queue.put_event({'msg': 'removed', 'collection': 'core.get_jobs', 'id': 1})
+    queue.put_event(changed(1, progress=2))
+
+    assert [i['msg'] for i in drain(queue)] == ['changed', 'removed', 'changed']
+
+
+def test__send_queue__does_not_merge_sent_events():
+    queue = SendQueue()
+    queue.put_event(changed(1, progress=1))
+    assert queue.get() == changed(1, progress=1)
+
+    assert queue.put_event(changed(1, progress=2)) is True
+
+
+def test__send_queue__drops_oldest_events_but_not_messages():
+    queue = SendQueue(max_events=2)
+    queue.put('result 1')
+    for i in range(1, 4):
+        queue.put_event(changed(i))
+    queue.put('result 2')
+
+    assert drain(queue) == ['result 1', changed(2), changed(3), 'result 2']
+
+    stats = queue.stats()
+    assert stats['dropped'] == 1
+    assert stats['sent'] == 4
+    assert stats['queued'] == 0
@@ -0,0 +1,68 @@
+import threading
+
+from middlewared.utils.thread_pool import IoThreadPoolExecutor, blocking
+
+
+def test__io_thread_pool__reuses_threads():
+    executor = IoThreadPoolExecutor('test', max_workers=4)
+    try:
+        idents = {executor.submit(threading.get_ident).result() for i in range(20)}
+
+        assert len(idents) == 1
+        assert executor.stats()['spawned'] == 1
+        assert executor.stats()['completed'] == 20
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__caps_threads():
+    executor = IoThreadPoolExecutor('test', max_workers=2)
+    event = threading.Event()
+    try:
+        futures = [executor.submit(event.wait, 5) for i in range(5)]
+
+        stats = executor.stats()
+        assert stats['threads'] == 2
+        assert stats['queued'] >= 3
+
+        event.set()
+        assert all(f.result() for f in futures)
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__propagates_exception():
+    executor = IoThreadPoolExecutor('test', max_workers=1)
+    try:
+        future = executor.submit(int, 'invalid')
+
+        assert isinstance(future.exception(), ValueError)
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__nested_blocking_call_does_not_deadlock():
+    executor = IoThreadPoolExecutor('test', max_workers=1)
+
+    def outer():
+        future = executor.submit(lambda: 'inner')
+        with blocking():
+            return future.result(5)
+
+    try:
+        assert executor.submit(outer).result(10) == 'inner'
+    finally:
+        executor.shutdown()
+
+
+def test__io_thread_pool__idle_threads_exit():
+    executor = IoThreadPoolExecutor('test', max_workers=1, idle_timeout=0.1)
+    try:
+        thread = executor.submit(threading.current_thread).result()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        assert executor.stats()['threads'] == 0
+        assert executor.submit(lambda: 1).result(5) == 1
+    finally:
+        executor.shutdown()
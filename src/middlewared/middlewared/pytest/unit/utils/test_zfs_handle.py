@@ -0,0 +1,49 @@
+import threading
+
+from mock import MagicMock
+
+from middlewared.utils.zfs_handle import ZFSHandles
+
+
+def test__zfs_handles__reused_by_thread():
+    handles = ZFSHandles(MagicMock)
+
+    with handles.get() as a:
+        with handles.get() as b:
+            assert a is b
+    with handles.get() as c:
+        assert c is a
+
+    other = []
+
+    def get():
+        with handles.get() as d:
+            other.append(d)
+
+    thread = threading.Thread(target=get)
+    thread.start()
+    thread.join()
+    assert other[0] is not a
+
+
+def test__zfs_handles__invalidated_handle_closed_once_unused():
+    handles = ZFSHandles(MagicMock)
+
+    with handles.get() as a:
+        handles.invalidate()
+        with handles.get() as b:
+            assert b is a
+        a.__exit__.assert_not_called()
+
+    with handles.get() as c:
+        assert c is not a
+    a.__exit__.assert_called_once_with(None, None, None)
+
+
+def test__zfs_handles__max_age():
+    handles = ZFSHandles(MagicMock, max_age=0)
+
+    with handles.get() as a:
+        pass
+    with handles.get() as b:
+        assert b is not a
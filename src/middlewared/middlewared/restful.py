@@ -194,6 +194,12 @@ class OpenAPIResource(object):
                         'required': False,
                         'schema': {'type': 'string'},
                     },
+                    {
+                        'name': 'select',
+                        'in': 'query',
+                        'required': False,
+                        'schema': {'type': 'string'},
+                    },
                 ]
             elif accepts:
                 opobject['requestBody'] = self._accepts_to_request(methodname, method, accepts)
@@ -415,7 +421,10 @@ class Resource(object):
                 options[key] = convert(val)
                 continue
             elif key == 'sort':
-                options[key] = [convert(v) for v in val.split(',')]
+                options['order_by'] = [convert(v) for v in val.split(',')]
+                continue
+            elif key == 'select':
+                options[key] = val.split(',')
                 continue
 
             op_map = {
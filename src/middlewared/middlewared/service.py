@@ -1,5 +1,6 @@
 from collections import defaultdict, namedtuple
 
+import asyncio
 import errno
 import inspect
 import json
@@ -29,12 +30,20 @@ def item_method(fn):
     return fn
 
 
-def job(lock=None, lock_queue_size=None, logs=False, process=False, pipes=None, check_pipes=True, transient=False):
-    """Flag method as a long running job."""
+def job(
+    lock=None, lock_queue_size=None, logs=False, process=False, pipes=None, check_pipes=True, transient=False,
+    priority=0, max_concurrency=None,
+):
+    """Flag method as a long running job.
+
+    Jobs with higher `priority` are started first, `max_concurrency` limits
+    the number of jobs of the method running at the same time."""
     def check_job(fn):
         fn._job = {
             'lock': lock,
             'lock_queue_size': lock_queue_size,
+            'priority': priority,
+            'max_concurrency': max_concurrency,
             'logs': logs,
             'process': process,
             'pipes': pipes or [],
@@ -52,6 +61,14 @@ def threaded(pool):
     return m
 
 
+def thread_limit(limit):
+    """Limit the number of concurrent threaded calls of the method."""
+    def m(fn):
+        fn._thread_limit = limit
+        return fn
+    return m
+
+
 def no_auth_required(fn):
     """Authentication is not required to use the given method."""
     fn._no_auth_required = True
@@ -99,8 +116,11 @@ class ServiceBase(type):
     Currently the following options are allowed:
       - datastore: name of the datastore mainly used in the service
       - datastore_extend: datastore `extend` option used in common `query` method
+      - datastore_extend_many: datastore `extend_many` option used in common `query` method
       - datastore_prefix: datastore `prefix` option used in helper methods
       - datastore_filters: datastore default filters to be used in `query` method
+      - datastore_raw_fields: fields (other than `id`) left untouched by `datastore_extend`/`datastore_extend_many`,
+        query filters and ordering on them are run by the database
       - service: system service `name` option used by `SystemServiceService`
       - service_model: system service datastore model option used by `SystemServiceService` (`service` if used if not provided)
       - service_verb: verb to be used on update (default to `reload`)
@@ -108,6 +128,7 @@ class ServiceBase(type):
       - private: whether or not the service is deemed private
       - verbose_name: human-friendly singular name for the service
       - thread_pool: thread pool to use for threaded methods
+      - thread_limit: maximum number of concurrent threaded calls for the service methods
       - process_pool: process pool to run service methods
 
     """
@@ -129,13 +150,16 @@ class ServiceBase(type):
             'datastore': None,
             'datastore_prefix': None,
             'datastore_extend': None,
+            'datastore_extend_many': None,
             'datastore_filters': None,
+            'datastore_raw_fields': None,
             'service': None,
             'service_model': None,
             'service_verb': 'reload',
             'namespace': namespace,
             'private': False,
             'thread_pool': None,
+            'thread_limit': None,
             'process_pool': None,
             'verbose_name': klass.__name__.replace('Service', ''),
         }
@@ -196,6 +220,8 @@ class ConfigService(ServiceChangeMixin, Service):
             options['prefix'] = self._config.datastore_prefix
         if self._config.datastore_extend:
             options['extend'] = self._config.datastore_extend
+        if self._config.datastore_extend_many:
+            options['extend_many'] = self._config.datastore_extend_many
         return await self._get_or_insert(self._config.datastore, options)
 
     async def update(self, data):
@@ -224,6 +250,7 @@ class SystemServiceService(ConfigService):
         return await self._get_or_insert(
             f'services.{self._config.service_model or self._config.service}', {
                 'extend': self._config.datastore_extend,
+                'extend_many': self._config.datastore_extend_many,
                 'prefix': self._config.datastore_prefix
             }
         )
@@ -258,19 +285,21 @@ class CRUDService(ServiceChangeMixin, Service):
             options['prefix'] = self._config.datastore_prefix
         if self._config.datastore_extend:
             options['extend'] = self._config.datastore_extend
+        if self._config.datastore_extend_many:
+            options['extend_many'] = self._config.datastore_extend_many
         if self._config.datastore_filters:
             if not filters:
                 filters = []
             filters += self._config.datastore_filters
         # In case we are extending which may transform the result in numerous ways
-        # we can only filter the final result.
-        if 'extend' in options:
-            datastore_options = options.copy()
-            datastore_options.pop('count', None)
-            datastore_options.pop('get', None)
+        # we can only filter the final result on fields changed by extend.
+        if 'extend' in options or 'extend_many' in options:
+            datastore_filters, filters, datastore_options, options = self._plan_datastore_query(filters, options)
             result = await self.middleware.call(
-                'datastore.query', self._config.datastore, [], datastore_options
+                'datastore.query', self._config.datastore, datastore_filters, datastore_options
             )
+            if not filters and not options:
+                return result
             return await self.middleware.run_in_thread(
                 filter_list, result, filters, options
             )
@@ -279,6 +308,43 @@ class CRUDService(ServiceChangeMixin, Service):
                 'datastore.query', self._config.datastore, filters, options,
             )
 
+    def _plan_datastore_query(self, filters, options):
+        """
+        Splits query `filters` and `options` of an extended datastore query into
+        those the database can handle and those to be applied to the extended result.
+        """
+        raw_fields = {'id'} | set(self._config.datastore_raw_fields or [])
+        datastore_filters = []
+        result_filters = []
+        for f in filters or []:
+            if f in (self._config.datastore_filters or []) or (
+                isinstance(f, (list, tuple)) and len(f) == 3 and f[0] in raw_fields and
+                f[1] in ('=', '!=', '>', '>=', '<', '<=', 'in', 'nin')
+            ):
+                datastore_filters.append(f)
+            else:
+                result_filters.append(f)
+
+        result_keys = ('count', 'get', 'offset', 'limit', 'select')
+        datastore_options = {k: v for k, v in options.items() if k not in result_keys + ('order_by',)}
+        result_options = {}
+
+        order_by = options.get('order_by')
+        if order_by:
+            # Extend keeps the order of rows so sorting by raw fields can be done by the database
+            if all(o.lstrip('-') in raw_fields for o in order_by):
+                datastore_options['order_by'] = order_by
+            else:
+                result_options['order_by'] = order_by
+
+        # Paging can only be done by the database if nothing is left to filter or sort
+        target = result_options if result_filters or result_options else datastore_options
+        for option in result_keys:
+            if options.get(option):
+                target[option] = options[option]
+
+        return datastore_filters, result_filters, datastore_options, result_options
+
     async def create(self, data):
         return await self.middleware._call(
             f'{self._config.namespace}.create', self, self.do_create, [data]
@@ -316,11 +382,20 @@ class CoreService(Service):
 
     @filterable
     def get_jobs(self, filters=None, options=None):
-        """Get the long running jobs."""
-        jobs = filter_list([
-            i.__encode__() for i in list(self.middleware.jobs.all().values())
-        ], filters, options)
-        return jobs
+        """
+        Get the long running jobs.
+
+        Finished jobs are archived on the system dataset so their history is kept across restarts.
+        The archive is only read by queries filtering by `id`, `method`, `state`, `time_started`
+        or `time_finished` or using `limit` and `offset` to page through it, at most 1000 archived
+        jobs are read if no `limit` is given.
+        """
+        return self.middleware.jobs.query(filters, options)
+
+    @periodic(10)
+    @private
+    async def job_history_flush(self):
+        await self.middleware.jobs.flush_history()
 
     @accepts(Int('id'), Dict(
         'job-update',
@@ -470,6 +545,41 @@ class CoreService(Service):
                 }
         return data
 
+    @accepts()
+    async def thread_pool_stats(self):
+        """
+        Returns statistics of the I/O thread pool (number of threads, queue depth,
+        calls submitted/completed) and of every service/method thread limit.
+        """
+        return self.middleware.get_thread_pool_stats()
+
+    @accepts()
+    async def process_pool_stats(self):
+        """
+        Returns utilisation of the worker process pool used by `process_pool` services
+        and jobs flagged with `process`: per worker pid, busy state, number of calls and RSS,
+        along with queue depth and number of spawned/recycled workers.
+        """
+        return self.middleware.get_process_pool_stats()
+
+    @accepts()
+    async def jobs_queue_stats(self):
+        """
+        Returns state of the job scheduler: number of jobs ready to run, running (in total
+        and per method), waiting for a shared lock or for their method `max_concurrency`,
+        number of coalesced progress updates which were not sent and state of the job history archive.
+        """
+        return self.middleware.jobs.stats()
+
+    @accepts()
+    async def event_stats(self):
+        """
+        Returns number of subscribed clients per event and, per connection, number of
+        messages waiting to be sent, sent, merged into a waiting event and dropped because
+        the client was not reading them fast enough.
+        """
+        return self.middleware.get_event_stats()
+
     @private
     async def event_send(self, name, event_type, kwargs):
         self.middleware.send_event(name, event_type, **kwargs)
@@ -592,6 +702,43 @@ class CoreService(Service):
             pydevd.stoptrace()
             pydevd.settrace(host=options['host'])
 
+    @accepts(List('calls', items=[
+        Dict(
+            'call',
+            Str('method', required=True),
+            List('params', default=[]),
+        ),
+    ]))
+    @pass_app
+    async def batch(self, app, calls):
+        """
+        Run a list of method calls concurrently within a single request/response
+        using the permissions of the current websocket session.
+
+        Returns a list in the same order as `calls`, each entry being a dict with
+        either a `result` key or an `error` key (same format as the error of a
+        `result` message).
+
+        .. examples(websocket)::
+
+          Query a disk and all pools in a single round trip:
+
+            :::javascript
+            {
+              "id": "6841f242-840a-11e6-a437-00e04d680384",
+              "msg": "method",
+              "method": "core.batch",
+              "params": [[
+                {"method": "disk.query", "params": [[["name", "=", "ada0"]]]},
+                {"method": "pool.query"}
+              ]]
+            }
+        """
+        if app is None:
+            raise CallError('core.batch can only be called from a websocket session')
+
+        return await asyncio.gather(*[app.run_method(call) for call in calls])
+
     @accepts(Str("method"), List("params", default=[]))
     @job(lock=lambda args: f"bulk:{args[0]}")
     async def bulk(self, job, method, params):
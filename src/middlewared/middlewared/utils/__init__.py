@@ -2,15 +2,16 @@ import asyncio
 import imp
 import inspect
 import os
-import re
 import sys
 import subprocess
 import threading
 from datetime import datetime, timedelta
-from itertools import chain
+from itertools import chain, islice
 from functools import wraps
 from threading import Lock
 
+from .filters import compile_filters, IndexedList, sort_items  # noqa
+
 
 # For freenasOS
 if '/usr/local/lib' not in sys.path:
@@ -20,7 +21,7 @@ BUILDTIME = None
 VERSION = None
 
 
-def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=None):
+def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=None, fields=None):
     from django.db.models.fields.related import ForeignKey, ManyToManyField
     from freenasUI.contrib.IPAddressField import (
         IPAddressField, IP4AddressField, IP6AddressField
@@ -28,16 +29,18 @@ def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=None):
     data = {}
     for field in chain(obj._meta.fields, obj._meta.many_to_many):
         name = field.name
+        if field_prefix and name.startswith(field_prefix):
+            name = name[len(field_prefix):]
+        if fields is not None and name not in fields:
+            continue
         try:
-            value = getattr(obj, name)
+            value = getattr(obj, field.name)
         except Exception as e:
             # If foreign key does not exist set it to None
             if isinstance(field, ForeignKey) and isinstance(e, field.rel.model.DoesNotExist):
                 data[name] = None
                 continue
             raise
-        if field_prefix and name.startswith(field_prefix):
-            name = name[len(field_prefix):]
         if isinstance(field, (
             IPAddressField, IP4AddressField, IP6AddressField
         )):
@@ -55,6 +58,60 @@ def django_modelobj_serialize(middleware, obj, extend=None, field_prefix=None):
     return data
 
 
+def django_model_relations(model, prefix='', seen=None):
+    """
+    Returns a tuple of lists of `select_related` and `prefetch_related` lookups
+    for every relation `django_modelobj_serialize` follows when serializing `model`.
+    """
+    from django.db.models.fields.related import ForeignKey, ManyToManyField
+    seen = (seen or set()) | {model}
+    select_related = []
+    prefetch_related = []
+    for field in chain(model._meta.fields, model._meta.many_to_many):
+        if isinstance(field, ForeignKey):
+            lookup = prefix + field.name
+            select_related.append(lookup)
+            if field.rel.to not in seen:
+                select, prefetch = django_model_relations(field.rel.to, lookup + '__', seen)
+                select_related += select
+                prefetch_related += prefetch
+        elif isinstance(field, ManyToManyField):
+            lookup = prefix + field.name
+            prefetch_related.append(lookup)
+            if field.rel.to not in seen:
+                # Anything behind a ManyToMany has to be prefetched as well
+                select, prefetch = django_model_relations(field.rel.to, lookup + '__', seen)
+                prefetch_related += select + prefetch
+    return select_related, prefetch_related
+
+
+def django_queryset_serialize(middleware, qs, field_prefix=None, fields=None):
+    """
+    Serializes every object of the queryset like `django_modelobj_serialize`
+    but loading all relations upfront with a fixed number of queries
+    instead of a few for each row.
+
+    If `fields` is provided only these fields (without prefix) are serialized
+    and only their relations loaded.
+    """
+    def selected(lookup):
+        name = lookup.split('__', 1)[0]
+        if field_prefix and name.startswith(field_prefix):
+            name = name[len(field_prefix):]
+        return fields is None or name in fields
+
+    select_related, prefetch_related = django_model_relations(qs.model)
+    select_related = list(filter(selected, select_related))
+    prefetch_related = list(filter(selected, prefetch_related))
+    if select_related:
+        qs = qs.select_related(*select_related)
+    if prefetch_related:
+        qs = qs.prefetch_related(*prefetch_related)
+    return [
+        django_modelobj_serialize(middleware, obj, field_prefix=field_prefix, fields=fields) for obj in qs
+    ]
+
+
 def Popen(args, **kwargs):
     kwargs.setdefault('encoding', 'utf8')
     shell = kwargs.pop('shell', None)
@@ -120,65 +177,49 @@ def get(obj, path):
 
 
 def filter_list(_list, filters=None, options=None):
+    """
+    Filters, sorts and pages a list of dicts (or objects) according to
+    `query-filters` and `query-options`.
+
+    `_list` can also be an iterable (e.g. a generator), it is only consumed
+    as far as needed when no sorting or count is requested.
 
-    opmap = {
-        '=': lambda x, y: x == y,
-        '!=': lambda x, y: x != y,
-        '>': lambda x, y: x > y,
-        '>=': lambda x, y: x >= y,
-        '<': lambda x, y: x < y,
-        '<=': lambda x, y: x <= y,
-        '~': lambda x, y: re.match(y, x),
-        'in': lambda x, y: x in y,
-        'nin': lambda x, y: x not in y,
-        'rin': lambda x, y: y in x,
-        'rnin': lambda x, y: y not in x,
-        '^': lambda x, y: x.startswith(y),
-        '$': lambda x, y: x.endswith(y),
-    }
-
-    if filters is None:
-        filters = {}
+    `_list` can be an `IndexedList` to avoid a full scan for `=`/`in` filters on indexed fields.
+    """
     if options is None:
         options = {}
 
-    rv = []
-    if filters:
-        for i in _list:
-            valid = True
-            for f in filters:
-                if len(f) == 3:
-                    name, op, value = f
-                    if op not in opmap:
-                        raise ValueError('Invalid operation: {}'.format(op))
-                    if isinstance(i, dict):
-                        source = get(i, name)
-                    else:
-                        source = getattr(i, name)
-                    if not opmap[op](source, value):
-                        valid = False
-                        break
-                else:
-                    raise ValueError("Invalid filter {0}".format(f))
-            if not valid:
-                continue
-            rv.append(i)
-            if options.get('get') is True:
-                return i
-    else:
-        rv = _list
+    if isinstance(_list, IndexedList):
+        candidates, filters = _list.lookup(filters)
+        if candidates is not None:
+            _list = candidates
+
+    match = compile_filters(filters)
+    order_by = options.get('order_by')
+
+    if options.get('get') is True and not order_by and not options.get('offset'):
+        # Short-circuit at the first match
+        rv = _list if match is None else filter(match, _list)
+        for i in rv:
+            if options.get('select'):
+                i = select_fields(i, options['select'])
+            return i
+        raise IndexError('list index out of range')
+
+    rv = _list if match is None else filter(match, _list)
 
     if options.get('count') is True:
-        return len(rv)
+        if isinstance(rv, (list, tuple)):
+            return len(rv)
+        return sum(1 for i in rv)
+
+    if order_by:
+        rv = sort_items(rv, order_by)
 
-    if options.get('order_by'):
-        for o in options.get('order_by'):
-            if o.startswith('-'):
-                o = o[1:]
-                reverse = True
-            else:
-                reverse = False
-            rv = sorted(rv, key=lambda x: x[o], reverse=reverse)
+    rv = paginate(rv, options.get('offset'), options.get('limit'))
+
+    if options.get('select'):
+        rv = [select_fields(i, options['select']) for i in rv]
 
     if options.get('get') is True:
         return rv[0]
@@ -186,6 +227,28 @@ def filter_list(_list, filters=None, options=None):
     return rv
 
 
+def paginate(_list, offset=None, limit=None):
+    """
+    Returns a list with at most `limit` items of `_list` starting at `offset`.
+    `_list` can be any iterable, it is only consumed up to the last item needed.
+    """
+    if not isinstance(_list, list):
+        offset = offset or 0
+        return list(islice(_list, offset, offset + limit if limit else None))
+    if offset:
+        _list = _list[offset:]
+    if limit:
+        _list = _list[:limit]
+    return _list
+
+
+def select_fields(obj, fields):
+    """
+    Returns a dict with only the `fields` of `obj`, fields not present are skipped.
+    """
+    return {field: obj[field] for field in fields if field in obj}
+
+
 def sw_buildtime():
     # Lazy import to avoid freenasOS configure logging for us
     from freenasOS import Configuration
@@ -14,3 +14,35 @@ async def asyncio_map(func, arguments, limit=None):
 
     futures = [func(arg) for arg in arguments]
     return await asyncio.gather(*futures)
+
+
+class ConcurrencyLimit(object):
+    """
+    Asynchronous context manager allowing at most `limit` coroutines inside it
+    at the same time while keeping track of how many are running and waiting.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.waiting = 0
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.running -= 1
+        self.semaphore.release()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'running': self.running,
+            'waiting': self.waiting,
+        }
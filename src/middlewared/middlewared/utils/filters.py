@@ -0,0 +1,177 @@
+"""
+Query plan used by `middlewared.utils.filter_list`.
+
+Filters are compiled once per call into plain functions (paths split, regular
+expressions compiled) instead of being interpreted again for every item.
+"""
+from collections import defaultdict
+from operator import itemgetter
+import re
+
+
+def _value_test(op, value):
+    if op == '=':
+        return lambda x: x == value
+    elif op == '!=':
+        return lambda x: x != value
+    elif op == '>':
+        return lambda x: x > value
+    elif op == '>=':
+        return lambda x: x >= value
+    elif op == '<':
+        return lambda x: x < value
+    elif op == '<=':
+        return lambda x: x <= value
+    elif op == '~':
+        match = re.compile(value).match
+        return lambda x: match(x)
+    elif op == 'in':
+        return lambda x: x in value
+    elif op == 'nin':
+        return lambda x: x not in value
+    elif op == 'rin':
+        return lambda x: value in x
+    elif op == 'rnin':
+        return lambda x: value not in x
+    elif op == '^':
+        return lambda x: x.startswith(value)
+    elif op == '$':
+        return lambda x: x.endswith(value)
+    raise ValueError('Invalid operation: {}'.format(op))
+
+
+def split_path(path):
+    """
+    Splits a dot notation path, `\\.` escapes a dot which is part of a key.
+    """
+    parts = []
+    current = ''
+    while path:
+        left, sep, path = path.partition('.')
+        if sep and left.endswith('\\'):
+            current += left[:-1] + sep
+            continue
+        parts.append(current + left)
+        current = ''
+    return parts
+
+
+def compile_path(path):
+    """
+    Returns a function getting `path` of an item the same way `middlewared.utils.get`
+    does for dicts. Other objects are accessed with `getattr`.
+    """
+    parts = split_path(path)
+    if len(parts) == 1:
+        key = parts[0]
+
+        def getter(obj):
+            if isinstance(obj, dict):
+                return obj.get(key)
+            return getattr(obj, path)
+    else:
+        def getter(obj):
+            if not isinstance(obj, dict):
+                return getattr(obj, path)
+            cur = obj
+            for part in parts:
+                if isinstance(cur, dict):
+                    cur = cur.get(part)
+                elif isinstance(cur, (list, tuple)):
+                    part = int(part)
+                    cur = cur[part] if part < len(cur) else None
+            return cur
+    return getter
+
+
+def compile_filter(f):
+    if not isinstance(f, (list, tuple)) or len(f) != 3:
+        raise ValueError('Invalid filter {0}'.format(f))
+    name, op, value = f
+    getter = compile_path(name)
+    test = _value_test(op, value)
+    return lambda obj: test(getter(obj))
+
+
+def compile_filters(filters):
+    """
+    Returns a function telling whether an item matches all `filters`
+    or None if there is nothing to filter.
+    """
+    checks = [compile_filter(f) for f in filters or []]
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+
+    def match(obj):
+        for check in checks:
+            if not check(obj):
+                return False
+        return True
+    return match
+
+
+def sort_items(items, order_by):
+    """
+    Sorts `items` by every `order_by` key (prefixed with `-` for descending order),
+    first key having the highest precedence.
+    """
+    keys = [(o[1:], True) if o.startswith('-') else (o, False) for o in order_by]
+    if len({reverse for key, reverse in keys}) == 1:
+        return sorted(items, key=itemgetter(*[key for key, reverse in keys]), reverse=keys[0][1])
+
+    # Mixed directions, rely on sort stability starting with the least significant key
+    items = list(items)
+    for key, reverse in reversed(keys):
+        items.sort(key=itemgetter(key), reverse=reverse)
+    return items
+
+
+class IndexedList(list):
+    """
+    List of items with hash indexes on some of their fields, used by `filter_list`
+    for `=` and `in` filters on these fields instead of a full scan.
+
+    Indexes are built on creation, the list must not be modified afterwards.
+    """
+
+    def __init__(self, items, keys):
+        super().__init__(items)
+        self.indexes = {}
+        for key in keys:
+            getter = compile_path(key)
+            index = defaultdict(list)
+            for i, item in enumerate(self):
+                try:
+                    index[getter(item)].append(i)
+                except TypeError:
+                    # Unhashable value, index can not be used for this field
+                    break
+            else:
+                self.indexes[key] = dict(index)
+
+    def lookup(self, filters):
+        """
+        Returns a tuple (candidates, remaining filters) where `candidates` is
+        an iterable of items to be checked against remaining filters, or
+        (None, filters) if no index can be used.
+        """
+        for i, f in enumerate(filters or []):
+            if not isinstance(f, (list, tuple)) or len(f) != 3:
+                continue
+            name, op, value = f
+            index = self.indexes.get(name)
+            if index is None:
+                continue
+            try:
+                if op == '=':
+                    positions = index.get(value, [])
+                elif op == 'in' and isinstance(value, (list, tuple, set)):
+                    positions = sorted(set().union(*[index.get(v, []) for v in value]))
+                else:
+                    continue
+            except TypeError:
+                continue
+            return [self[p] for p in positions], filters[:i] + filters[i + 1:]
+        return None, filters
@@ -0,0 +1,281 @@
+"""
+Persistent archive of finished jobs.
+
+Finished jobs are queued in memory and appended in batches to a SQLite database on the
+system dataset, so job history survives restarts and bursts of jobs larger than the
+in-memory `JobsDeque`. The database is only opened for the duration of a flush or a query
+so it never keeps the system dataset busy when it has to be moved to another pool.
+
+Job ids are reserved in blocks persisted on the boot device, so jobs started before the
+system dataset is mounted never reuse ids of archived jobs.
+"""
+from collections import deque
+from datetime import datetime
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+
+from middlewared.client import ejson
+
+logger = logging.getLogger(__name__)
+
+JOB_HISTORY_MOUNTPOINT = '/var/db/system'
+JOB_HISTORY_DB = 'middlewared/jobs.db'
+JOB_IDS_PATH = '/data/middlewared-job-ids'
+
+# Columns filters and sorting can be pushed down to
+COLUMNS = ('id', 'method', 'state', 'time_started', 'time_finished')
+TIME_COLUMNS = ('time_started', 'time_finished')
+OPERATORS = {'=': '=', '!=': '!=', '>': '>', '>=': '>=', '<': '<', '<=': '<=', 'in': 'IN', 'nin': 'NOT IN'}
+
+
+def _column_value(column, value):
+    if column in TIME_COLUMNS:
+        if not isinstance(value, datetime):
+            raise ValueError(value)
+        return value.timestamp()
+    if value is None:
+        raise ValueError(value)
+    return value
+
+
+def _where(filters):
+    """
+    Translates filters on indexed columns to an SQL WHERE clause.
+
+    Returns a tuple (where, params, remaining) where `remaining` are the filters which could
+    not be translated and have to be applied to the result.
+    """
+    clauses = []
+    params = []
+    remaining = []
+    for f in filters or []:
+        if not (isinstance(f, (list, tuple)) and len(f) == 3 and f[0] in COLUMNS and f[1] in OPERATORS):
+            remaining.append(f)
+            continue
+
+        column, op, value = f
+        try:
+            if op in ('in', 'nin'):
+                values = [_column_value(column, v) for v in value]
+                clause = f'{column} {OPERATORS[op]} ({", ".join("?" * len(values))})'
+            else:
+                values = [_column_value(column, value)]
+                clause = f'{column} {OPERATORS[op]} ?'
+        except (TypeError, ValueError):
+            remaining.append(f)
+            continue
+
+        clauses.append(clause)
+        params.extend(values)
+
+    return ' AND '.join(clauses) or '1', params, remaining
+
+
+def split_filters(filters):
+    """
+    Splits `filters` into those the database can evaluate and the remaining ones.
+    """
+    remaining = _where(filters)[2]
+    return [f for f in filters or [] if f not in remaining], remaining
+
+
+class JobHistoryStore(object):
+
+    def __init__(self, mountpoint=JOB_HISTORY_MOUNTPOINT, max_pending=10000, max_rows=100000,
+                 ids_path=JOB_IDS_PATH, ids_block=1000):
+        self.mountpoint = mountpoint
+        self.path = os.path.join(mountpoint, JOB_HISTORY_DB)
+        self.max_rows = max_rows
+        self.ids_path = ids_path
+        self.ids_block = ids_block
+
+        self.max_id = 0
+
+        # Protects `_pending`, never held while accessing the database
+        self._lock = threading.Lock()
+        # Serializes database access
+        self._db_lock = threading.Lock()
+        self._pending = deque(maxlen=max_pending)
+        self._initialized = False
+
+        self._added = 0
+        self._flushed = 0
+        self._dropped = 0
+
+    def available(self):
+        return os.path.ismount(self.mountpoint)
+
+    def add(self, encoded_job):
+        """
+        Queues `Job.__encode__()` of a finished job for the next `flush`.
+        Returns the number of pending jobs.
+        """
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self._dropped += 1
+            self._pending.append(encoded_job)
+            self._added += 1
+            return len(self._pending)
+
+    def reserve_ids(self, last_id=0):
+        """
+        Reserves a block of job ids following `last_id`, ids reserved by previous runs and
+        archived jobs. Returns a tuple (first id - 1, last reserved id).
+        """
+        with self._db_lock:
+            if not self._initialized:
+                try:
+                    with self._connect():
+                        pass
+                except sqlite3.Error:
+                    logger.warning('Failed to read job history database', exc_info=True)
+
+        start = max(last_id, self.max_id, self._read_reserved_id())
+        reserved = start + self.ids_block
+        try:
+            with open(f'{self.ids_path}.tmp', 'w') as f:
+                f.write(str(reserved))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(f'{self.ids_path}.tmp', self.ids_path)
+        except OSError:
+            logger.warning('Failed to save reserved job ids', exc_info=True)
+        return start, reserved
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending)
+
+    def flush(self):
+        """
+        Writes pending jobs to the database. Jobs stay pending if the system dataset is not available.
+        The first call opens the database (if available) even if no job is pending to read `max_id`.
+        """
+        with self._db_lock:
+            with self._lock:
+                jobs = list(self._pending)
+                added = self._added
+            if not jobs and self._initialized:
+                return 0
+
+            with self._connect() as conn:
+                if conn is None or not jobs:
+                    return 0
+
+                rows = [self._row(job) for job in jobs]
+                conn.executemany('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)', rows)
+                conn.execute(
+                    'DELETE FROM jobs WHERE id <= (SELECT id FROM jobs ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (self.max_rows,),
+                )
+                self.max_id = max(self.max_id, max(row[0] for row in rows))
+
+            with self._lock:
+                # Jobs finished while we were writing stay pending
+                for i in range(max(len(self._pending) - (self._added - added), 0)):
+                    self._pending.popleft()
+                self._flushed += len(rows)
+            return len(rows)
+
+    def query(self, filters=None, order_by=None, limit=None):
+        """
+        Returns archived jobs matching filters on indexed columns (`COLUMNS`).
+        Other filters are ignored and must be applied to the result by the caller.
+        """
+        where, params, _ = _where(filters)
+
+        order = []
+        for o in order_by or []:
+            column = o.lstrip('-')
+            if column not in COLUMNS:
+                raise ValueError(f'Can not sort by {column}')
+            order.append(f'{column} DESC' if o.startswith('-') else column)
+        order.append('id')
+
+        sql = f'SELECT * FROM jobs WHERE {where} ORDER BY {", ".join(order)}'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        with self._db_lock:
+            with self._connect() as conn:
+                if conn is None:
+                    return []
+                return [self._decode(row) for row in conn.execute(sql, params)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'available': self.available(),
+                'pending': len(self._pending),
+                'flushed': self._flushed,
+                'dropped': self._dropped,
+                'max_id': self.max_id,
+            }
+
+    def _read_reserved_id(self):
+        try:
+            with open(self.ids_path) as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError):
+            logger.warning('Failed to read reserved job ids', exc_info=True)
+            return 0
+
+    @contextlib.contextmanager
+    def _connect(self):
+        if not self.available():
+            yield None
+            return
+
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                if not self._initialized:
+                    self._create(conn)
+                yield conn
+        finally:
+            conn.close()
+
+    def _create(self, conn):
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, method TEXT, state TEXT, time_started REAL, time_finished REAL, data TEXT'
+            ')'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_method ON jobs (method, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS jobs_time_finished ON jobs (time_finished)')
+        self.max_id = max(self.max_id, conn.execute('SELECT MAX(id) FROM jobs').fetchone()[0] or 0)
+        self._initialized = True
+
+    def _row(self, job):
+        # Logs of jobs no longer in memory are removed
+        data = dict(job, logs_path=None, time_started=None, time_finished=None)
+        try:
+            data = ejson.dumps(data)
+        except (TypeError, ValueError):
+            data['result'] = repr(data['result'])
+            data = ejson.dumps(data)
+
+        return (
+            job['id'],
+            job['method'],
+            job['state'],
+            job['time_started'].timestamp() if job['time_started'] else None,
+            job['time_finished'].timestamp() if job['time_finished'] else None,
+            data,
+        )
+
+    def _decode(self, row):
+        job = ejson.loads(row[5])
+        job['time_started'] = datetime.fromtimestamp(row[3]) if row[3] is not None else None
+        job['time_finished'] = datetime.fromtimestamp(row[4]) if row[4] is not None else None
+        return job
@@ -0,0 +1,268 @@
+from collections import deque
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import threading
+import traceback
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerDiedError(Exception):
+    pass
+
+
+def _worker_main(conn, initializer):
+    """
+    Worker process loop: receive calls from the pool, run them and send the
+    result (or exception) back along with current RSS so the pool can decide
+    whether this process should be recycled.
+    """
+    if initializer is not None:
+        initializer()
+
+    process = psutil.Process()
+    while True:
+        try:
+            call = conn.recv()
+        except EOFError:
+            break
+        if call is None:
+            break
+
+        fn, args, kwargs = call
+        try:
+            reply = ('result', fn(*args, **kwargs))
+        except BaseException as e:
+            reply = ('exception', e)
+
+        rss = process.memory_info().rss
+        try:
+            conn.send(reply + (rss,))
+        except Exception as e:
+            # Result or exception could not be pickled
+            conn.send(('exception', RuntimeError(
+                f'Failed to send worker reply: {e!r}\n{traceback.format_exc()}'
+            ), rss))
+
+
+class Worker(object):
+
+    def __init__(self, pool, id):
+        self.pool = pool
+        self.id = id
+        self.calls = 0
+        self.rss = None
+        self.busy = False
+
+        self.conn, child_conn = pool.context.Pipe()
+        self.process = pool.context.Process(
+            target=_worker_main, args=(child_conn, pool.initializer), name=f'{pool.name}-{id}', daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+        self.thread = threading.Thread(target=self.run, name=f'{pool.name}-{id}', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                item = self.pool._get_work(self)
+                if item is None:
+                    break
+
+                future, fn, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    self.pool._done(self)
+                    continue
+
+                try:
+                    self.conn.send((fn, args, kwargs))
+                    status, value, self.rss = self.conn.recv()
+                except (EOFError, OSError) as e:
+                    future.set_exception(WorkerDiedError(f'Worker process {self.process.pid} died: {e!r}'))
+                    break
+                except Exception as e:
+                    # Call could not be pickled, worker is still usable
+                    future.set_exception(e)
+                else:
+                    self.calls += 1
+                    if status == 'result':
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+                finally:
+                    del future, fn, args, kwargs
+
+                if self.pool._done(self):
+                    break
+        finally:
+            self.stop()
+            self.pool._remove(self)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class ProcessPool(concurrent.futures.Executor):
+    """
+    Pool of worker processes scaling between `min_workers` and `max_workers`.
+
+    Workers are spawned on demand and terminated after being idle for `idle_timeout`
+    seconds (never going below `min_workers`), so they stay warm (modules imported,
+    connections open) between calls.
+    A worker is recycled after `max_calls` calls or once its RSS exceeds `max_rss` bytes.
+    """
+
+    def __init__(
+        self, name, min_workers, max_workers, initializer=None, max_calls=None, max_rss=None, idle_timeout=300,
+    ):
+        self.name = name
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.max_calls = max_calls
+        self.max_rss = max_rss
+        self.idle_timeout = idle_timeout
+        self.context = multiprocessing.get_context('spawn')
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._work = deque()
+        self._workers = set()
+        self._counter = itertools.count(1)
+        self._idle = 0
+        self._shutdown = False
+
+        self._submitted = 0
+        self._completed = 0
+        self._spawned = 0
+        self._recycled = 0
+        self._max_queue_depth = 0
+
+    def start(self):
+        with self._lock:
+            while len(self._workers) < self.min_workers:
+                self._spawn()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot schedule new calls after shutdown')
+
+            future = concurrent.futures.Future()
+            self._work.append((future, fn, args, kwargs))
+            self._submitted += 1
+            self._max_queue_depth = max(self._max_queue_depth, len(self._work))
+
+            if self._idle >= len(self._work):
+                self._cond.notify()
+            elif len(self._workers) < self.max_workers:
+                self._spawn()
+
+            return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            self._cond.notify_all()
+            workers = list(self._workers)
+
+        if wait:
+            for worker in workers:
+                worker.thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_workers': self.min_workers,
+                'max_workers': self.max_workers,
+                'workers': [
+                    {
+                        'pid': worker.process.pid,
+                        'busy': worker.busy,
+                        'calls': worker.calls,
+                        'rss': worker.rss,
+                    }
+                    for worker in self._workers
+                ],
+                'busy': len([worker for worker in self._workers if worker.busy]),
+                'queued': len(self._work),
+                'max_queued': self._max_queue_depth,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'spawned': self._spawned,
+                'recycled': self._recycled,
+            }
+
+    def _spawn(self):
+        # Must be called with `_lock` held
+        try:
+            worker = Worker(self, next(self._counter))
+        except Exception:
+            logger.error('Failed to spawn worker process', exc_info=True)
+            if not self._workers:
+                # No one else would ever pick up queued calls
+                while self._work:
+                    self._work.popleft()[0].set_exception(WorkerDiedError('Failed to spawn worker process'))
+            return
+        self._workers.add(worker)
+        self._spawned += 1
+
+    def _get_work(self, worker):
+        with self._lock:
+            while not self._work:
+                if not self._shutdown:
+                    self._idle += 1
+                    notified = self._cond.wait(self.idle_timeout)
+                    self._idle -= 1
+
+                    if notified or self._work or len(self._workers) <= self.min_workers:
+                        continue
+
+                # Worker has to be removed while still holding the lock so
+                # `submit` will not count on it to run queued calls
+                self._workers.discard(worker)
+                return None
+
+            worker.busy = True
+            return self._work.popleft()
+
+    def _done(self, worker):
+        """
+        Returns whether the worker process should be recycled.
+        """
+        with self._lock:
+            worker.busy = False
+            self._completed += 1
+
+            if (
+                (self.max_calls is not None and worker.calls >= self.max_calls) or
+                (self.max_rss is not None and worker.rss is not None and worker.rss > self.max_rss)
+            ):
+                self._recycled += 1
+                return True
+
+            return False
+
+    def _remove(self, worker):
+        with self._lock:
+            self._workers.discard(worker)
+            if self._shutdown:
+                return
+
+            # Keep minimum number of warm workers and make sure queued calls are not stranded
+            if len(self._workers) < self.min_workers or len(self._work) > self._idle:
+                self._spawn()
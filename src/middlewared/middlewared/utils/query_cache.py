@@ -0,0 +1,97 @@
+from collections import defaultdict, OrderedDict
+import pickle
+import threading
+
+
+class QueryCache(object):
+    """
+    LRU cache of query results tagged by the tables they were read from.
+
+    Results are stored pickled so every hit returns a fresh copy callers are
+    free to modify. Invalidating a table drops every entry depending on it.
+
+    Results computed concurrently with an invalidation are not stored: get a
+    `token()` before reading the data and pass it to `put()`.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_table = defaultdict(set)
+        self._generation = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    def token(self):
+        return self._generation
+
+    def get(self, key):
+        """
+        Returns a tuple (hit, value).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return True, pickle.loads(entry[1])
+
+    def put(self, key, tables, value, token):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if token != self._generation:
+                return
+
+            self._remove(key)
+            self._entries[key] = (tables, data)
+            for table in tables:
+                self._by_table[table].add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate(self, tables):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            for table in tables:
+                for key in self._by_table.pop(table, set()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._invalidations += 1
+            self._entries.clear()
+            self._by_table.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidations': self._invalidations,
+                'evictions': self._evictions,
+            }
+
+    def _remove(self, key):
+        # Must be called with `_lock` held
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for table in entry[0]:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
@@ -0,0 +1,115 @@
+from collections import deque
+import threading
+
+
+class SendQueue(object):
+    """
+    Outgoing messages of a websocket connection waiting to be written.
+
+    Messages (method results, errors, etc) are never dropped. Events are bounded so a slow
+    client can not make middlewared buffer an unbounded amount of data for it:
+
+      - a CHANGED event of an item (same collection and id) still waiting to be sent
+        is merged into the waiting one
+      - once `max_events` events are waiting the oldest one is dropped
+
+    `put` and `put_event` can be called from any thread.
+    """
+
+    def __init__(self, max_events=1000):
+        self.max_events = max_events
+
+        self._lock = threading.Lock()
+        # Entries are [payload, is_event, merge_key], payload is set to None when an event is dropped
+        self._queue = deque()
+        # Event entries waiting to be sent, oldest first
+        self._events = deque()
+        # (collection, id) -> waiting CHANGED event later CHANGED events of the item are merged into
+        self._changed = {}
+        # Dropped entries still in `_queue`
+        self._dead = 0
+
+        self._sent = 0
+        self._merged = 0
+        self._dropped = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue) - self._dead
+
+    def put(self, data):
+        with self._lock:
+            self._queue.append([data, False, None])
+
+    def put_event(self, event):
+        """
+        Queues `event` dict. Returns `False` if it was merged into a waiting event.
+        """
+        key = (event['collection'], event.get('id'))
+        mergeable = event['msg'] == 'changed' and 'id' in event and set(event) <= {'msg', 'collection', 'id', 'fields'}
+
+        with self._lock:
+            if mergeable:
+                entry = self._changed.get(key)
+                if entry is not None:
+                    entry[0]['fields'].update(event.get('fields') or {})
+                    self._merged += 1
+                    return False
+            else:
+                # Events of an item must not be reordered
+                self._changed.pop(key, None)
+
+            if len(self._events) >= self.max_events:
+                dropped = self._events.popleft()
+                self._discard(dropped)
+                dropped[0] = None
+                self._dead += 1
+                self._dropped += 1
+
+            if mergeable:
+                event = dict(event, fields=dict(event.get('fields') or {}))
+            entry = [event, True, key if mergeable else None]
+            if mergeable:
+                self._changed[key] = entry
+            self._queue.append(entry)
+            self._events.append(entry)
+            return True
+
+    def get(self):
+        """
+        Returns next message to send (data passed to `put` or an event dict) or `None`.
+        """
+        with self._lock:
+            while self._queue:
+                entry = self._queue.popleft()
+                if entry[0] is None:
+                    self._dead -= 1
+                    continue
+
+                if entry[1]:
+                    self._events.popleft()
+                    self._discard(entry)
+                self._sent += 1
+                return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._queue.clear()
+            self._events.clear()
+            self._changed.clear()
+            self._dead = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self._queue) - self._dead,
+                'queued_events': len(self._events),
+                'max_events': self.max_events,
+                'sent': self._sent,
+                'merged': self._merged,
+                'dropped': self._dropped,
+            }
+
+    def _discard(self, entry):
+        if entry[2] is not None and self._changed.get(entry[2]) is entry:
+            self._changed.pop(entry[2])
@@ -0,0 +1,155 @@
+from collections import deque
+import concurrent.futures
+import contextlib
+import itertools
+import threading
+
+_worker = threading.local()
+
+
+@contextlib.contextmanager
+def blocking():
+    """
+    Context manager to be used by a pool worker thread which is about to wait
+    for another call that may need a thread from the same pool (e.g. `call_sync`).
+
+    While inside the context the worker does not count towards `max_workers`
+    so a new thread can be spawned to run the nested call instead of deadlocking.
+    It is a no-op when not called from a `IoThreadPoolExecutor` worker.
+    """
+    executor = getattr(_worker, 'executor', None)
+    if executor is None:
+        yield
+        return
+
+    executor._block()
+    try:
+        yield
+    finally:
+        executor._unblock()
+
+
+class IoThreadPoolExecutor(concurrent.futures.Executor):
+    """
+    Executor for blocking (I/O bound) calls.
+
+    Threads are spawned on demand up to `max_workers` and kept alive for
+    `idle_timeout` seconds waiting for more work, so consecutive calls reuse
+    them instead of paying thread creation/teardown for each one.
+    Calls submitted when all workers are busy are queued.
+    """
+
+    def __init__(self, name, max_workers, idle_timeout=60):
+        self.name = name
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._work = deque()
+        self._threads = set()
+        self._counter = itertools.count(1)
+        self._idle = 0
+        self._blocked = 0
+        self._shutdown = False
+
+        self._submitted = 0
+        self._completed = 0
+        self._spawned = 0
+        self._max_queue_depth = 0
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('Cannot schedule new calls after shutdown')
+
+            future = concurrent.futures.Future()
+            self._work.append((future, fn, args, kwargs))
+            self._submitted += 1
+            self._max_queue_depth = max(self._max_queue_depth, len(self._work))
+
+            if self._idle >= len(self._work):
+                self._cond.notify()
+            else:
+                self._maybe_spawn()
+
+            return future
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+
+        if wait:
+            for t in threads:
+                t.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'threads': len(self._threads),
+                'idle': self._idle,
+                'blocked': self._blocked,
+                'queued': len(self._work),
+                'max_queued': self._max_queue_depth,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'spawned': self._spawned,
+            }
+
+    def _maybe_spawn(self):
+        # Must be called with `_lock` held
+        if len(self._threads) - self._blocked >= self.max_workers:
+            return
+
+        t = threading.Thread(
+            target=self._run_worker, name=f'{self.name}-{next(self._counter)}', daemon=True,
+        )
+        self._threads.add(t)
+        self._spawned += 1
+        t.start()
+
+    def _block(self):
+        with self._lock:
+            self._blocked += 1
+            if len(self._work) > self._idle:
+                self._maybe_spawn()
+
+    def _unblock(self):
+        with self._lock:
+            self._blocked -= 1
+
+    def _run_worker(self):
+        _worker.executor = self
+        while True:
+            with self._lock:
+                while not self._work:
+                    if not self._shutdown:
+                        self._idle += 1
+                        notified = self._cond.wait(self.idle_timeout)
+                        self._idle -= 1
+
+                        if notified or self._work:
+                            continue
+
+                    # Thread has to be removed while still holding the lock so
+                    # `submit` will not count on it to run queued calls
+                    self._threads.discard(threading.current_thread())
+                    return
+
+                future, fn, args, kwargs = self._work.popleft()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            # Do not keep references to the call while idle
+            del future, fn, args, kwargs
+
+            with self._lock:
+                self._completed += 1
@@ -0,0 +1,72 @@
+"""
+Long-lived libzfs handles shared by calls running in the same thread.
+
+Opening a handle opens /dev/zfs and initializes libzfs state, which used to be done by every
+call. libzfs handles are not thread safe, so each thread keeps its own handle and reuses it
+until it is invalidated, e.g. after a pool import or export, or gets older than
+`ZFS_HANDLE_MAX_AGE` seconds so that libzfs caches (e.g. mounted filesystems) never get stale.
+"""
+import contextlib
+import threading
+import time
+
+import libzfs
+
+ZFS_HANDLE_MAX_AGE = 60
+
+
+class ZFSHandles(object):
+
+    def __init__(self, factory=None, max_age=ZFS_HANDLE_MAX_AGE):
+        self.factory = factory or libzfs.ZFS
+        self.max_age = max_age
+        self.generation = 0
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def get(self):
+        """
+        Context manager returning the handle of the current thread, opening a new one if needed.
+        A handle is only closed when it is not in use anymore, calls can be nested.
+        """
+        local = self.local
+        if getattr(local, 'depth', 0) == 0 and getattr(local, 'handle', None) is not None and (
+            local.generation != self.generation or time.monotonic() - local.opened > self.max_age
+        ):
+            self._close()
+        if getattr(local, 'handle', None) is None:
+            local.handle = self.factory()
+            local.generation = self.generation
+            local.opened = time.monotonic()
+            local.depth = 0
+
+        local.depth += 1
+        try:
+            yield local.handle
+        finally:
+            local.depth -= 1
+
+    def invalidate(self):
+        """
+        Handles opened so far are reopened on their next use.
+        """
+        self.generation += 1
+
+    def _close(self):
+        handle = self.local.handle
+        self.local.handle = None
+        handle.__exit__(None, None, None)
+
+
+HANDLES = ZFSHandles()
+
+
+def zfs_handle():
+    """
+    Drop-in replacement for `libzfs.ZFS()` context manager reusing the handle of the current thread.
+    """
+    return HANDLES.get()
+
+
+def invalidate_zfs_handles():
+    HANDLES.invalidate()
@@ -1,8 +1,9 @@
 #!/usr/local/bin/python3
 from middlewared.client import Client
+from middlewared.client.asyncio_ import AsyncClient
+from middlewared.utils.thread_pool import IoThreadPoolExecutor
 
 import asyncio
-import concurrent.futures
 import functools
 import importlib
 import logging
@@ -21,44 +22,63 @@ class FakeMiddleware(object):
 
     def __init__(self):
         self.client = None
+        self.async_client = None
         self.logger = logging.getLogger('worker')
+        self.io_threadpool = IoThreadPoolExecutor('IoThread', max_workers=16)
+        self.services = {}
+
+    def _get_client(self):
+        """
+        Connection to middlewared is kept open between calls and only
+        established again if it has been closed.
+        """
+        if self.client is None or self.client._closed.is_set():
+            if self.client is not None:
+                try:
+                    self.client.close()
+                except Exception:
+                    pass
+            self.client = Client(py_exceptions=True)
+        return self.client
+
+    async def _get_async_client(self):
+        if self.async_client is None or self.async_client.closed:
+            if self.async_client is not None:
+                await self.async_client.close()
+            self.async_client = AsyncClient(py_exceptions=True)
+            await self.async_client.connect()
+        return self.async_client
 
     async def run_in_thread(self, method, *args, **kwargs):
-        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        try:
-            return await asyncio.get_event_loop().run_in_executor(
-                executor, functools.partial(method, *args, **kwargs)
-            )
-        finally:
-            # We need this because default behavior of PoolExecutor with
-            # context manager is to shutdown(wait=True) which would block
-            # the worker until thread finishes.
-            executor.shutdown(wait=False)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.io_threadpool, functools.partial(method, *args, **kwargs)
+        )
 
     async def _call(self, name, serviceobj, methodobj, params=None, app=None, pipes=None, io_thread=False, job=None):
-        with Client(py_exceptions=True) as c:
-            self.client = c
-            job_options = getattr(methodobj, '_job', None)
-            if job and job_options:
-                params = list(params) if params else []
-                params.insert(0, FakeJob(job['id'], self.client))
-            if asyncio.iscoroutinefunction(methodobj):
-                return await methodobj(*params)
-            else:
-                return methodobj(*params)
-        self.client = None
+        client = self._get_client()
+        job_options = getattr(methodobj, '_job', None)
+        if job and job_options:
+            params = list(params) if params else []
+            params.insert(0, FakeJob(job['id'], client))
+        if asyncio.iscoroutinefunction(methodobj):
+            return await methodobj(*params)
+        else:
+            return methodobj(*params)
 
     async def _run(self, service_mod, service_name, method, args, job=None):
-        module = importlib.import_module(service_mod)
-        serviceobj = getattr(module, service_name)(self)
+        # Service instances are kept around so their module is imported only once per worker
+        serviceobj = self.services.get((service_mod, service_name))
+        if serviceobj is None:
+            module = importlib.import_module(service_mod)
+            serviceobj = self.services[(service_mod, service_name)] = getattr(module, service_name)(self)
         methodobj = getattr(serviceobj, method)
         return await self._call(f'{service_name}.{method}', serviceobj, methodobj, params=args, job=job)
 
     async def call(self, method, *params, timeout=None, **kwargs):
         """
-        Calls a method using middleware client
+        Calls a method using asyncio middleware client so the worker event loop is not blocked
         """
-        return self.client.call(method, *params, timeout=timeout, **kwargs)
+        return await (await self._get_async_client()).call(method, *params, timeout=timeout, **kwargs)
 
     def call_sync(self, method, *params, timeout=None, **kwargs):
         """
@@ -15,6 +15,7 @@ install_requires = [
     'Flask',
     'setproctitle',
     'psutil',
+    'msgpack>=0.6.1',
 ]
 
 
@@ -2,7 +2,9 @@ from setuptools import setup
 
 
 install_requires = [
+    'aiohttp',
     'ws4py',
+    'msgpack>=0.6.1',
 ]
 
 setup(